@@ -28,8 +28,8 @@ import scsiutil
 import xml.dom.minidom
 import blktap2
 import vhdutil
-import json
 import inventory
+import rbdsr_backend
 
 CAPABILITIES = ["VDI_CREATE", "VDI_DELETE", "VDI_ATTACH", "VDI_DETACH", "VDI_CLONE", "VDI_SNAPSHOT",
                 "VDI_INTRODUCE", "VDI_RESIZE", "VDI_RESIZE_ONLINE", "VDI_UPDATE", "VDI_MIRROR",
@@ -40,6 +40,10 @@ CONFIGURATION = [['rbd-mode', 'SR mount mode (optional): kernel, fuse, nbd (defa
                  ['cephx-id', 'Cephx id to be used (optional): default is admin'],
                  ['use-rbd-meta', 'Store VDI params in rbd metadata (optional): True (default), False'],
                  ['vdi-update-existing', 'Update params of existing VDIs on scan (optional): True (default), False'],
+                 ['rbd-backend', 'Backend for rbd image operations (optional): librbd (default, falls back to cli if python-rbd is missing), cli'],
+                 ['nbds-max', 'Number of nbd devices on the host (optional): default is 64'],
+                 ['probe-details', 'Report the number of VDIs and their virtual allocation of each pool on probe (optional): True, False (default)'],
+                 ['pool-stats-ttl', 'Seconds the pool stats are shared by the SM commands of a host (optional): default is 10, 0 disables'],
                 ]
 
 DRIVER_INFO = {
@@ -64,6 +68,8 @@ MODE_DEFAULT = "nbd"
 USE_RBD_META_DEFAULT = True
 VDI_UPDATE_EXISTING_DEFAULT = True
 
+BACKEND_DEFAULT = rbdsr_backend.BACKEND_LIBRBD
+
 class RBDSR(SR.SR, cephutils.SR):
     """Ceph Block Devices storage repository"""
 
@@ -82,13 +88,16 @@ class RBDSR(SR.SR, cephutils.SR):
             return
 
         RBDVDIs = self._get_vdilist(self.CEPH_POOL_NAME)
+        # one bulk fetch instead of an image-meta call per image and per snapshot parent
+        self._load_vdi_metas(set([self._get_vdi_uuid(RBDVDIs[vdi_uuid]['image']) for vdi_uuid in RBDVDIs.keys()]))
 
         #xapi_session = self.session.xenapi
         #sm_config = xapi_session.SR.get_sm_config(self.sr_ref)
-        vdis = self.session.xenapi.SR.get_VDIs(self.sr_ref)
-        vdi_uuids = set([])
-        for vdi in vdis:
-            vdi_uuids.add(self.session.xenapi.VDI.get_uuid(vdi))
+        vdi_records = self._get_vdi_records()
+        vdi_refs = {}
+        for vdi_ref in vdi_records.keys():
+            vdi_refs[vdi_records[vdi_ref]['uuid']] = vdi_ref
+        vdi_uuids = set(vdi_refs.keys())
 
         for vdi_uuid in RBDVDIs.keys():
             #name = RBDVDIs[vdi_uuid]['image']
@@ -117,7 +126,7 @@ class RBDSR(SR.SR, cephutils.SR):
                             self.vdis[parent_vdi_uuid].size = str(RBDVDIs[parent_vdi_uuid]['size'])
                             self.vdis[parent_vdi_uuid].sm_config["vdi_type"] = 'aio'
                     else:
-                        base_vdi_ref = self.session.xenapi.VDI.get_by_uuid(parent_vdi_uuid)
+                        base_vdi_ref = vdi_refs[parent_vdi_uuid]
                         self.vdis[vdi_uuid].snapshot_of = base_vdi_ref
                     if parent_vdi_meta.has_key(RBDVDIs[vdi_uuid]['snapshot']):
                         self.vdis[vdi_uuid].snapshot_time = str(parent_vdi_meta[RBDVDIs[vdi_uuid]['snapshot']])
@@ -127,7 +136,7 @@ class RBDSR(SR.SR, cephutils.SR):
                     self.vdis[vdi_uuid].path = self._get_path(vdi_uuid)
                 else:
                     #VDI exists
-                    vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                    vdi_ref = vdi_refs[vdi_uuid]
                     if parent_vdi_uuid not in vdi_uuids:
                         self.vdis[parent_vdi_uuid] = RBDVDI(self, parent_vdi_uuid, label)
                         self.vdis[parent_vdi_uuid].description = description
@@ -138,7 +147,7 @@ class RBDSR(SR.SR, cephutils.SR):
                         except Exception:
                             continue
                     else:
-                        parent_vdi_ref = self.session.xenapi.VDI.get_by_uuid(parent_vdi_uuid)
+                        parent_vdi_ref = vdi_refs[parent_vdi_uuid]
                     if self.vdi_update_existing:
                         self.session.xenapi.VDI.set_virtual_size(vdi_ref, str(RBDVDIs[parent_vdi_uuid]['size']))
                         self.session.xenapi.VDI.set_physical_utilisation(vdi_ref, str(RBDVDIs[parent_vdi_uuid]['size']))
@@ -169,13 +178,31 @@ class RBDSR(SR.SR, cephutils.SR):
                         self.vdis[vdi_uuid].sm_config["vdi_type"] = 'aio'
                 else:
                     #VDI exists
-                    vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                    vdi_ref = vdi_refs[vdi_uuid]
                     if self.vdi_update_existing:
                         self.session.xenapi.VDI.set_virtual_size(vdi_ref, str(RBDVDIs[vdi_uuid]['size']))
                         self.session.xenapi.VDI.set_physical_utilisation(vdi_ref, str(RBDVDIs[vdi_uuid]['size']))
                         self.session.xenapi.VDI.set_name_description(vdi_ref, description)
                         #self.session.xenapi.VDI.add_to_sm_config(vdi_ref, 'vdi_type', 'aio')
 
+    def _get_vdi_records(self):
+        util.SMlog("RBDSR._get_vdi_records")
+        return self.session.xenapi.VDI.get_all_records_where('field "SR" = "%s"' % self.sr_ref)
+
+    def _get_vdi_children(self, vdi_records):
+        """Index VDI refs by the uuid in their 'snapshot-of' or 'clone-of' sm_config key"""
+        util.SMlog("RBDSR._get_vdi_children")
+        vdi_children = {'snapshot-of': {}, 'clone-of': {}}
+        for vdi_ref, vdi_record in vdi_records.iteritems():
+            if vdi_record['sm_config'].has_key('snapshot-of'):
+                relation = 'snapshot-of'
+            elif vdi_record['sm_config'].has_key('clone-of'):
+                relation = 'clone-of'
+            else:
+                continue
+            vdi_children[relation].setdefault(vdi_record['sm_config'][relation], []).append(vdi_ref)
+        return vdi_children
+
     def content_type(self, sr_uuid):
         """Returns the content_type XML"""
         return SR.SR.content_type(self, sr_uuid)
@@ -188,7 +215,8 @@ class RBDSR(SR.SR, cephutils.SR):
 
     def probe(self):
         util.SMlog("RBDSR.probe for %s" % self.uuid)
-        return self._srlist_toxml()
+        details = self.dconf.has_key('probe-details') and self.dconf['probe-details'].lower() == 'true'
+        return self._srlist_toxml(details)
 
     def load(self, sr_uuid):
         util.SMlog("RBDSR.load: sr_uuid=%s" % sr_uuid)
@@ -197,6 +225,9 @@ class RBDSR(SR.SR, cephutils.SR):
         self.mode = MODE_DEFAULT
         self.use_rbd_meta = USE_RBD_META_DEFAULT
         self.vdi_update_existing = VDI_UPDATE_EXISTING_DEFAULT
+        self.backend_type = BACKEND_DEFAULT
+        self.nbds_max = cephutils.NBDS_MAX
+        self.pool_stats_ttl = cephutils.POOL_STATS_TTL
         self.uuid = sr_uuid
         ceph_user = cephutils.DEFAULT_CEPH_USER
         if self.dconf.has_key('cephx-id'):
@@ -212,6 +243,27 @@ class RBDSR(SR.SR, cephutils.SR):
         if self.dconf.has_key('vdi-update-existing'):
             self.vdi_update_existing = self.dconf['vdi-update-existing']
 
+        if self.dconf.has_key('rbd-backend'):
+            self.backend_type = self.dconf['rbd-backend']
+            if self.backend_type not in rbdsr_backend.BACKEND_TYPES:
+                raise xs_errors.XenError('SRUnavailable', opterr='invalid rbd-backend: %s, must be one of %s' % (self.backend_type, ', '.join(rbdsr_backend.BACKEND_TYPES)))
+
+        if self.dconf.has_key('nbds-max'):
+            try:
+                self.nbds_max = int(self.dconf['nbds-max'])
+            except ValueError:
+                self.nbds_max = 0
+            if self.nbds_max < 2:
+                raise xs_errors.XenError('SRUnavailable', opterr='invalid nbds-max: %s, must be an integer of at least 2' % self.dconf['nbds-max'])
+
+        if self.dconf.has_key('pool-stats-ttl'):
+            try:
+                self.pool_stats_ttl = float(self.dconf['pool-stats-ttl'])
+            except ValueError:
+                self.pool_stats_ttl = -1
+            if not 0 <= self.pool_stats_ttl < float('inf'):
+                raise xs_errors.XenError('SRUnavailable', opterr='invalid pool-stats-ttl: %s, must be a number of seconds of at least 0' % self.dconf['pool-stats-ttl'])
+
         cephutils.SR.load(self,sr_uuid, ceph_user)
 
     def attach(self, sr_uuid):
@@ -220,24 +272,7 @@ class RBDSR(SR.SR, cephutils.SR):
         if not self.RBDPOOLs.has_key(self.uuid):
             raise xs_errors.XenError('SRUnavailable',opterr='no pool with uuid: %s' % sr_uuid)
 
-        host_uuid = inventory.get_localhost_uuid()
-
-        self.lock.acquire()
-
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr_ref)
-
-        if sr_sm_config.has_key("dev_instances"):
-            sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-            self.session.xenapi.SR.remove_from_sm_config(self.sr_ref, "dev_instances")
-        else:
-            sr_dev_instances={"hosts":{}}
-
-        sr_dev_instances["hosts"][host_uuid] = [None] * cephutils.NBDS_MAX
-        sr_dev_instances["hosts"][host_uuid][0] = "reserved"
-
-        self.session.xenapi.SR.add_to_sm_config(self.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-
-        self.lock.release()
+        self.slots.free_sr(sr_uuid)
 
         cephutils.SR.attach(self, sr_uuid)
 
@@ -248,20 +283,7 @@ class RBDSR(SR.SR, cephutils.SR):
     def detach(self, sr_uuid):
         util.SMlog("RBDSR.detach: sr_uuid=%s" % sr_uuid)
 
-        host_uuid = inventory.get_localhost_uuid()
-
-        self.lock.acquire()
-
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr_ref)
-
-        if sr_sm_config.has_key("dev_instances"):
-            sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-            self.session.xenapi.SR.remove_from_sm_config(self.sr_ref, "dev_instances")
-            sr_dev_instances["hosts"][host_uuid] = [None] * cephutils.NBDS_MAX
-            sr_dev_instances["hosts"][host_uuid][0] = "reserved"
-            self.session.xenapi.SR.add_to_sm_config(self.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-
-        self.lock.release()
+        self.slots.free_sr(sr_uuid)
 
         cephutils.SR.detach(self, sr_uuid)
 
@@ -326,7 +348,8 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
         if self.exists:
             raise xs_errors.XenError('VDIExists')
 
-        if not self.sr._isSpaceAvailable(size):
+        # stats shared within pool-stats-ttl are trusted for accepting the size, not for refusing it
+        if not self.sr._isSpaceAvailable(size) and not self.sr._isSpaceAvailable(size, force_refresh=True):
             util.SMlog('RBDVDI.create: vdi size is too big: ' + \
                     '(vdi size: %d, sr free space size: %d)' % (size, self.sr.RBDPOOLs[sr_uuid]['stats']['max_avail']))
             raise xs_errors.XenError('VDISize', opterr='vdi size is too big: vdi size: %d, sr free space size: %d'  % (size, self.sr.RBDPOOLs[sr_uuid]['stats']['max_avail']))
@@ -384,31 +407,21 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
     def delete(self, sr_uuid, vdi_uuid):
         util.SMlog("RBDVDI.delete: sr_uuid=%s, vdi_uuid=%s" % (sr_uuid, vdi_uuid))
 
-        vdis = self.session.xenapi.SR.get_VDIs(self.sr.sr_ref)
-        clones_uuids = set([])
-        has_a_snapshot = False
-        has_a_clone = False
-
-        for tmp_vdi in vdis:
-            tmp_vdi_uuid = self.session.xenapi.VDI.get_uuid(tmp_vdi)
-            tmp_sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi)
-            if tmp_sm_config.has_key("snapshot-of"):
-                if tmp_sm_config["snapshot-of"] == vdi_uuid:
-                    has_a_snapshot = True
-            elif tmp_sm_config.has_key("clone-of"):
-                if tmp_sm_config["clone-of"] == vdi_uuid:
-                    has_a_clone = True
-                    clones_uuids.add(tmp_vdi_uuid)
+        vdi_records = self.sr._get_vdi_records()
+        vdi_children = self.sr._get_vdi_children(vdi_records)
+        clones_refs = vdi_children['clone-of'].get(vdi_uuid, [])
+        has_a_snapshot = vdi_children['snapshot-of'].has_key(vdi_uuid)
+        has_a_clone = len(clones_refs) > 0
 
         if has_a_snapshot == True:
             # reverting of VM snapshot
             self_vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
             new_uuid = util.gen_uuid()
-            self.snaps = self.session.xenapi.VDI.get_snapshots(self_vdi_ref)
+            self.snaps = vdi_records[self_vdi_ref]['snapshots']
             # renaming base image
             self._rename_image(vdi_uuid, new_uuid)
             for snap in self.snaps:
-                util.SMlog("RBDVDI.delete set rollback for %s" % self.session.xenapi.VDI.get_uuid(snap))
+                util.SMlog("RBDVDI.delete set rollback for %s" % vdi_records[snap]['uuid'])
                 self.session.xenapi.VDI.add_to_sm_config(snap, 'new_uuid', new_uuid)
                 self.session.xenapi.VDI.add_to_sm_config(snap, 'rollback', 'true')
         else:
@@ -417,10 +430,9 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
             self_sm_config = self.session.xenapi.VDI.get_sm_config(self_vdi_ref)
             if self_sm_config.has_key("snapshot-of"):
                 if has_a_clone == True:
-                    for clone_uuid in clones_uuids:
-                        clone_vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+                    for clone_vdi_ref in clones_refs:
                         self.session.xenapi.VDI.remove_from_sm_config(clone_vdi_ref, "clone-of")
-                        self._flatten_clone(clone_uuid)
+                        self._flatten_clone(vdi_records[clone_vdi_ref]['uuid'])
                 if self_sm_config.has_key("compose"):
                     self._delete_snapshot(self_sm_config["compose_vdi1"], vdi_uuid)
                     self._delete_vdi(self_sm_config["compose_vdi1"])
@@ -441,23 +453,8 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
         host_uuid = inventory.get_localhost_uuid()
         self.size = int(self.session.xenapi.VDI.get_virtual_size(vdi_ref))
 
-        self.sr.lock.acquire()
-
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr.sr_ref)
-        sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-        self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-
-        first_free_instance = -1
-        for i in range(cephutils.NBDS_MAX):
-            if sr_dev_instances["hosts"][host_uuid][i] == None:
-                first_free_instance = i
-                break
-        sr_dev_instances["hosts"][host_uuid][first_free_instance] = vdi_uuid
-        self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-
-        if sm_config.has_key("dev_instance"):
-            self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
-        self.session.xenapi.VDI.add_to_sm_config(vdi_ref, "dev_instance", str(first_free_instance))
+        # the device slot is host state: mapping runs without the cluster lock
+        self._alloc_dev_instance(vdi_uuid)
 
         self.path = self.sr._get_path(vdi_uuid)
 
@@ -471,14 +468,8 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
 
         try:
             ##########
-            vdis = self.session.xenapi.SR.get_VDIs(self.sr.sr_ref)
-            has_a_snapshot = False
-            for tmp_vdi in vdis:
-                tmp_vdi_uuid = self.session.xenapi.VDI.get_uuid(tmp_vdi)
-                tmp_sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi)
-                if tmp_sm_config.has_key("snapshot-of"):
-                    if tmp_sm_config["snapshot-of"] == vdi_uuid:
-                        has_a_snapshot = True
+            vdi_children = self.sr._get_vdi_children(self.sr._get_vdi_records())
+            has_a_snapshot = vdi_children['snapshot-of'].has_key(vdi_uuid)
             #    if tmp_sm_config.has_key("sxm_mirror"):
             #            sxm_mirror_vdi = vdi_uuid
             ########## SXM VDIs
@@ -511,24 +502,17 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
             self.session.xenapi.VDI.add_to_sm_config(vdi_ref, 'attached', 'true')
 
         except Exception, e:
-            self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-            sr_dev_instances["hosts"][host_uuid][first_free_instance] = None
-            self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-            self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
+            self._free_dev_instance(vdi_uuid)
             raise xs_errors.XenError('VDIUnavailable', opterr='Failed to map RBD sr_uuid=%s, vdi_uuid=%s, \
                                                                host_uuid=%s (%s)' % (self.sr.uuid, vdi_uuid,
                                                                                      host_uuid, str(e)))
 
-        self.sr.lock.release()
-
         return VDI.VDI.attach(self, self.sr.uuid, self.uuid)
 
     def detach(self, sr_uuid, vdi_uuid):
         util.SMlog("RBDVDI.detach: sr_uuid=%s, vdi_uuid=%s" % (sr_uuid, vdi_uuid))
         vdi_ref = self.sr.srcmd.params['vdi_ref']
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr.sr_ref)
-        host_uuid = inventory.get_localhost_uuid()
 
         self.size = int(self.session.xenapi.VDI.get_virtual_size(vdi_ref))
 
@@ -544,19 +528,7 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
         self.attached = False
         self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'attached')
 
-        self.sr.lock.acquire()
-
-        sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-        self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-        if sr_dev_instances["hosts"].has_key(host_uuid):
-            for i in range(cephutils.NBDS_MAX):
-                if sr_dev_instances["hosts"][host_uuid][i] == vdi_uuid:
-                    sr_dev_instances["hosts"][host_uuid][i] = None
-                    break
-        self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-        self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
-
-        self.sr.lock.release()
+        self._free_dev_instance(vdi_uuid)
 
     def clone(self, sr_uuid, snap_uuid):
         util.SMlog("RBDVDI.clone: sr_uuid=%s, snap_uuid=%s" % (sr_uuid, snap_uuid))
@@ -591,14 +563,13 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
                 baseVDI.sm_config["reverted"] = 'true'
                 base_vdi_ref = baseVDI._db_introduce()
 
-                vdis = self.session.xenapi.SR.get_VDIs(self.sr.sr_ref)
-                for tmp_vdi in vdis:
-                    tmp_vdi_uuid = self.session.xenapi.VDI.get_uuid(tmp_vdi)
-                    tmp_sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi)
+                vdi_records = self.sr._get_vdi_records()
+                for tmp_vdi in vdi_records.keys():
+                    tmp_sm_config = vdi_records[tmp_vdi]['sm_config']
                     if tmp_sm_config.has_key("rollback"):
                         if tmp_sm_config.has_key("new_uuid"):
                             if tmp_sm_config["new_uuid"] == new_uuid:
-                                sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi)
+                                sm_config = tmp_sm_config
                                 del sm_config['snapshot-of']
                                 sm_config['snapshot-of'] = new_uuid
                                 del sm_config['rollback']
@@ -692,7 +663,8 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
 
         size = image_size_M * 1024 * 1024
 
-        if not self.sr._isSpaceAvailable(size):
+        # stats shared within pool-stats-ttl are trusted for accepting the size, not for refusing it
+        if not self.sr._isSpaceAvailable(size) and not self.sr._isSpaceAvailable(size, force_refresh=True):
             util.SMlog('vdi_resize: vdi size is too big: ' + \
                     '(vdi size: %d, sr free space size: %d)' % (size, self.sr.RBDPOOLs[sr_uuid]['stats']['max_avail']))
             raise xs_errors.XenError('VDISize', opterr='vdi size is too big')
@@ -730,14 +702,8 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
         #if not blktap2.VDI.tap_pause(self.session, sr_uuid, vdi2_uuid):
         #    raise util.SMException("failed to pause VDI %s" % vdi2_uuid)
 
-        vdis = self.session.xenapi.SR.get_VDIs(self.sr.sr_ref)
-        for tmp_vdi in vdis:
-            tmp_vdi_uuid = self.session.xenapi.VDI.get_uuid(tmp_vdi)
-            tmp_sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi)
-            if tmp_sm_config.has_key("snapshot-of"):
-                if tmp_sm_config["snapshot-of"] == vdi2_uuid:
-                    snap_vdi_ref = self.session.xenapi.VDI.get_by_uuid(tmp_vdi_uuid)
-                    snap_uuid = tmp_vdi_uuid
+        vdi_children = self.sr._get_vdi_children(self.sr._get_vdi_records())
+        snap_vdi_ref = vdi_children['snapshot-of'][vdi2_uuid][-1]
 
         self.session.xenapi.VDI.add_to_sm_config(snap_vdi_ref, 'compose', 'true')
         self.session.xenapi.VDI.add_to_sm_config(snap_vdi_ref, 'compose_vdi1', vdi1_uuid)
@@ -759,17 +725,16 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
         self_vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
 
         if not self.session.xenapi.VDI.get_is_a_snapshot(self_vdi_ref):
-            vdis = self.session.xenapi.SR.get_VDIs(self.sr.sr_ref)
+            vdi_records = self.sr._get_vdi_records()
+            vdi_children = self.sr._get_vdi_children(vdi_records)
             self.snaps = {}
-            has_snapshots = False
+            snaps_refs = {}
+            has_snapshots = vdi_children['snapshot-of'].has_key(vdi_uuid)
 
-            for tmp_vdi_ref in vdis:
-                tmp_vdi_uuid = self.session.xenapi.VDI.get_uuid(tmp_vdi_ref)
-                tmp_sm_config = self.session.xenapi.VDI.get_sm_config(tmp_vdi_ref)
-                if tmp_sm_config.has_key("snapshot-of"):
-                    if tmp_sm_config["snapshot-of"] == vdi_uuid:
-                        has_snapshots = True
-                        self.snaps[tmp_vdi_uuid]=self.session.xenapi.VDI.get_snapshot_time(tmp_vdi_ref)
+            for tmp_vdi_ref in vdi_children['snapshot-of'].get(vdi_uuid, []):
+                tmp_vdi_uuid = vdi_records[tmp_vdi_ref]['uuid']
+                snaps_refs[tmp_vdi_uuid] = tmp_vdi_ref
+                self.snaps[tmp_vdi_uuid] = vdi_records[tmp_vdi_ref]['snapshot_time']
 
             self.label = self.session.xenapi.VDI.get_name_label(self_vdi_ref)
             self.description = self.session.xenapi.VDI.get_name_description(self_vdi_ref)
@@ -785,9 +750,9 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
                 if has_snapshots == True:
                     for snapshot_uuid in self.snaps.keys():
                         util.SMlog("RBDVDI.update start setting snapshots")
-                        snapshot_vdi_ref = self.session.xenapi.VDI.get_by_uuid(snapshot_uuid)
-                        self.session.xenapi.VDI.set_name_label(snapshot_vdi_ref, self.session.xenapi.VDI.get_name_label(self_vdi_ref))
-                        self.session.xenapi.VDI.set_name_description(snapshot_vdi_ref, self.session.xenapi.VDI.get_name_description(self_vdi_ref))
+                        snapshot_vdi_ref = snaps_refs[snapshot_uuid]
+                        self.session.xenapi.VDI.set_name_label(snapshot_vdi_ref, self.label)
+                        self.session.xenapi.VDI.set_name_description(snapshot_vdi_ref, self.description)
                         util.SMlog("RBDVDI.update finish setting snapshots")
         else:
             self_vdi_sm_config = self.session.xenapi.VDI.get_sm_config(self_vdi_ref)
@@ -834,7 +799,7 @@ class RBDVDI(VDI.VDI, cephutils.VDI):
                 pass
             elif self.mode == "nbd":
                 self._disable_rbd_caching()
-                cmdout = util.pread2(["rbd-nbd", "--device", "/dev/nbd0", "--nbds_max", str(cephutils.NBDS_MAX), "-c", "/etc/ceph/ceph.conf.nocaching", "map", "%s/%s" % (self.sr.CEPH_POOL_NAME, _vdi_name), "--name", self.sr.CEPH_USER]).rstrip('\n')
+                cmdout = util.pread2(["rbd-nbd", "--device", "/dev/nbd0", "--nbds_max", str(self.sr.nbds_max), "-c", "/etc/ceph/ceph.conf.nocaching", "map", "%s/%s" % (self.sr.CEPH_POOL_NAME, _vdi_name), "--name", self.sr.CEPH_USER]).rstrip('\n')
                 util.pread2(["ln", "-s", cmdout, _dev_name])
             util.pread2(["ln", "-s", cmdout, dev_name])
 
@@ -138,6 +138,39 @@ def _unmap(session, arg_dict):
         util.pread2(["rbd", "nbd", "unmap", dev, "--name", CEPH_USER])
     return "unmapped"
 
+def _cleanup(session, arg_dict):
+    """Undoes what a failed map did on this host, whatever step it stopped at"""
+    mode = arg_dict['mode']
+    dev_name = arg_dict['dev_name']
+    _dev_name = arg_dict['_dev_name']
+    _dmdev_name = arg_dict['_dmdev_name']
+    _dm_name = arg_dict['_dm_name']
+    CEPH_USER = arg_dict['CEPH_USER']
+    dm = arg_dict['dm']
+
+    if os.path.islink(dev_name):
+        util.pread2(["unlink", dev_name])
+
+    if dm == "mirror":
+        dm_devs = [(_dm_name, _dmdev_name), ("%s%s" % (_dm_name, "-zero"), "%s%s" % (_dmdev_name, "-zero"))]
+    elif dm == "linear" or dm == "base":
+        dm_devs = [(_dm_name, _dmdev_name)]
+    else:
+        dm_devs = []
+    for (name, path) in dm_devs:
+        if os.path.exists(path):
+            util.pread2(["dmsetup", "remove", name])
+
+    # the link to the device is there once the image is mapped, so that no device of another image is unmapped
+    if os.path.islink(_dev_name):
+        dev = os.path.realpath(_dev_name)
+        if mode == "kernel":
+            util.pread2(["rbd", "unmap", dev, "--name", CEPH_USER])
+        elif mode == "nbd":
+            util.pread2(["unlink", _dev_name])
+            util.pread2(["rbd", "nbd", "unmap", dev, "--name", CEPH_USER])
+    return "cleaned"
+
 def __map(session, arg_dict):
     mode = arg_dict['mode']
     _dev_name = arg_dict['_dev_name']
@@ -196,6 +229,7 @@ def __unmap(session, arg_dict):
 if __name__ == "__main__":
     XenAPIPlugin.dispatch({"map": _map,
                            "unmap": _unmap,
+                           "cleanup": _cleanup,
                            "_map": __map,
                            "_unmap": __unmap,
                            "merge": _merge})
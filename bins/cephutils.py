@@ -15,16 +15,20 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import xml.dom.minidom
 import util
 import re
 import json
 import sys
 import os
+import time
 import blktap2
 import XenAPI
 import inventory
 import xs_errors
+import StringIO
+from xml.sax.saxutils import XMLGenerator
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 DEFAULT_CEPH_USER = 'admin'
 
@@ -41,20 +45,40 @@ NBD_PREFIX = "/dev/nbd"
 DM_PREFIX = "/dev/mapper"
 
 NBDS_MAX = 64
+# seconds the stats of the pools are shared by the SM commands of a host for
+POOL_STATS_TTL = 10
+NBD_MODULE_NBDS_MAX = "/sys/module/nbd/parameters/nbds_max"
 BLOCK_SIZE = 21 #2097152 bytes
 OBJECT_SIZE_IN_B = 2097152
 
 IMAGE_FORMAT = 2
 
+# pools listed at once by a detailed probe
+PROBE_WORKERS = 8
+
+# seconds the hosts of a VDI have to run a plugin call, all together
+PLUGIN_DEADLINE = 600
+# plugin calls undoing the ones which failed part way on a host, with the same arguments:
+# cleanup goes through whatever state map left; a failed _map leaves the host paused, as it was
+PLUGIN_ROLLBACK = {'map': 'cleanup'}
+
 import rbdsr_lock
+import rbdsr_backend
+import rbdsr_slots
+import rbdsr_scan
 
-class SR:
+class SR(object):
 
     def __init__(self):
         util.SMlog("Calling cephutils.SR.__init___")
         self.mode = ''
         self.uuid = ''
         self.SR_ROOT = ''
+        self.backend_type = rbdsr_backend.BACKEND_LIBRBD
+        self.nbds_max = NBDS_MAX
+        self.pool_stats_ttl = POOL_STATS_TTL
+        self.vdi_metas = {}
+        self.vdilist = None
 
     def _get_vdi_uuid(self, vdi):
         util.SMlog("Calling cephutils.SR._get_vdi_uuid: vdi=%s" % vdi)
@@ -70,21 +94,36 @@ class SR:
         util.SMlog("Calling cephutils.SR._get_vdi_info: vdi_uuid=%s" % vdi_uuid)
         VDI_NAME = "%s%s" % (VDI_PREFIX, vdi_uuid)
         if self.use_rbd_meta:
-            cmdout = util.pread2(["rbd", "image-meta", "list", VDI_NAME, "--pool", self.CEPH_POOL_NAME, "--format", "json", "--name", self.CEPH_USER])
-            if len(cmdout) != 0:
-                decoded = json.loads(cmdout)
-                return decoded
-            else:
-                return {}
+            if not self.vdi_metas.has_key(vdi_uuid):
+                self.vdi_metas[vdi_uuid] = self.backend.image_meta_list(VDI_NAME)
+            return self.vdi_metas[vdi_uuid]
         else:
              return {}
 
+    def _load_vdi_metas(self, vdi_uuids):
+        util.SMlog("Calling cephutils.SR._load_vdi_metas: %d vdis" % len(vdi_uuids))
+        if self.use_rbd_meta:
+            missing = {}
+            for vdi_uuid in vdi_uuids:
+                if not self.vdi_metas.has_key(vdi_uuid):
+                    missing["%s%s" % (VDI_PREFIX, vdi_uuid)] = vdi_uuid
+            for vdi_name, vdi_meta in self.backend.images_meta_list(missing.keys()).iteritems():
+                self.vdi_metas[missing[vdi_name]] = vdi_meta
+
     def _get_vdilist(self, pool):
         util.SMlog("Calling cephutils.SR._get_vdilist: pool=%s" % pool)
+        # listed once per command, and reused from the previous scan while the pool is unchanged
+        if self.vdilist is None:
+            generation = self.scan_cache.generation()
+            decoded = self.scan_cache.load(generation)
+            if decoded is None:
+                decoded = self.backend.list_images()
+                self.scan_cache.save(generation, decoded)
+            self.vdilist = self._parse_vdilist(decoded)
+        return self.vdilist
+
+    def _parse_vdilist(self, decoded):
         RBDVDIs = {}
-        cmd = ["rbd", "ls", "-l", "--format", "json", "--pool", pool, "--name", self.CEPH_USER]
-        cmdout = util.pread2(cmd)
-        decoded = json.loads(cmdout)
         for vdi in decoded:
             if vdi['image'].find("SXM") == -1:
                 if vdi.has_key('snapshot'):
@@ -96,46 +135,75 @@ class SR:
                     RBDVDIs[vdi_uuid] = vdi
         return RBDVDIs
 
-    def _srlist_toxml(self):
-        util.SMlog("Calling cephutils.SR._srlist_toxml")
+    def _images_changed(self):
+        """To be called after every change of the images of the pool or of their snapshots"""
+        util.SMlog("Calling cephutils.SR._images_changed")
+        self.vdilist = None
+        self.scan_cache.bump()
+
+    def _get_pool_details(self, sr_uuid):
+        """Number of VDIs and bytes provisioned for them in the pool of sr_uuid, None if it can't be listed"""
+        pool = "%s%s" % (RBDPOOL_PREFIX, sr_uuid)
+        try:
+            backend = rbdsr_backend.get_backend(pool, self.CEPH_USER, self.backend_type)
+            try:
+                rbdvdis = self._parse_vdilist(backend.list_images())
+            finally:
+                backend.close()
+        except Exception, e:
+            util.SMlog("cephutils.SR._get_pool_details: pool=%s: %s" % (pool, str(e)))
+            return None
+        return (len(rbdvdis), sum([vdi['size'] for vdi in rbdvdis.values()]))
+
+    def _srlist_toxml(self, details=False):
+        util.SMlog("Calling cephutils.SR._srlist_toxml: details=%s" % details)
         self.RBDPOOLs = self._get_srlist()
-        dom = xml.dom.minidom.Document()
-        element = dom.createElement("SRlist")
-        dom.appendChild(element)
-
-        for sr_uuid in self.RBDPOOLs.keys():
-            entry = dom.createElement('SR')
-            element.appendChild(entry)
-
-            subentry = dom.createElement("UUID")
-            entry.appendChild(subentry)
-            textnode = dom.createTextNode(sr_uuid)
-            subentry.appendChild(textnode)
-
-            subentry = dom.createElement("PoolName")
-            entry.appendChild(subentry)
-            textnode = dom.createTextNode(self.RBDPOOLs[sr_uuid]["name"])
-            subentry.appendChild(textnode)
-
-            subentry = dom.createElement("Size")
-            entry.appendChild(subentry)
-            size = str(self.RBDPOOLs[sr_uuid]["stats"]["max_avail"] + self.RBDPOOLs[sr_uuid]["stats"]["bytes_used"])
-            textnode = dom.createTextNode(size)
-            subentry.appendChild(textnode)
-
-            subentry = dom.createElement("BytesUses")
-            entry.appendChild(subentry)
-            bytesused = str(self.RBDPOOLs[sr_uuid]["stats"]["bytes_used"])
-            textnode = dom.createTextNode(bytesused)
-            subentry.appendChild(textnode)
-
-            subentry = dom.createElement("Objects")
-            entry.appendChild(subentry)
-            objects = str(self.RBDPOOLs[sr_uuid]["stats"]["objects"])
-            textnode = dom.createTextNode(objects)
-            subentry.appendChild(textnode)
-
-        return dom.toprettyxml()
+        sr_uuids = sorted(self.RBDPOOLs.keys())
+
+        pools_details = {}
+        if details and sr_uuids:
+            workers = ThreadPool(min(PROBE_WORKERS, len(sr_uuids)))
+            try:
+                pools_details = dict(zip(sr_uuids, workers.map(self._get_pool_details, sr_uuids)))
+            finally:
+                workers.close()
+                workers.join()
+
+        out = StringIO.StringIO()
+        writer = XMLGenerator(out, "utf-8")
+        writer.startDocument()
+        writer.startElement("SRlist", {})
+        writer.ignorableWhitespace("\n")
+
+        def element(name, value):
+            writer.ignorableWhitespace("\t\t")
+            writer.startElement(name, {})
+            writer.characters(str(value))
+            writer.endElement(name)
+            writer.ignorableWhitespace("\n")
+
+        for sr_uuid in sr_uuids:
+            stats = self.RBDPOOLs[sr_uuid]["stats"]
+            writer.ignorableWhitespace("\t")
+            writer.startElement("SR", {})
+            writer.ignorableWhitespace("\n")
+            element("UUID", sr_uuid)
+            element("PoolName", self.RBDPOOLs[sr_uuid]["name"])
+            element("Size", stats["max_avail"] + stats["bytes_used"])
+            element("BytesUses", stats["bytes_used"])
+            element("Objects", stats["objects"])
+            if pools_details.get(sr_uuid) is not None:
+                (vdis, provisioned) = pools_details[sr_uuid]
+                element("VDIs", vdis)
+                element("VirtualAllocation", provisioned)
+            writer.ignorableWhitespace("\t")
+            writer.endElement("SR")
+            writer.ignorableWhitespace("\n")
+
+        writer.endElement("SRlist")
+        writer.ignorableWhitespace("\n")
+        writer.endDocument()
+        return out.getvalue()
 
     def _get_path(self, vdi_uuid):
         util.SMlog("Calling cephutils.SR._get_path: vdi_uuid=%s" % vdi_uuid)
@@ -162,16 +230,80 @@ class SR:
             allocated_bytes += rbdvdis[vdi_uuid]['size']
         return allocated_bytes
 
-    def _isSpaceAvailable(self, size):
-        util.SMlog("Calling cephutils.SR._isSpaceAvailable: size=%s" % size)
+    def _isSpaceAvailable(self, size, force_refresh=False):
+        util.SMlog("Calling cephutils.SR._isSpaceAvailable: size=%s, force_refresh=%s" % (size, force_refresh))
+        if force_refresh:
+            self.RBDPOOLs = self._get_srlist(force_refresh=True)
         sr_free_space = self.RBDPOOLs[self.uuid]['stats']['max_avail']
         if size > sr_free_space:
             return False
         else:
             return True
 
-    def _get_srlist(self):
-        util.SMlog("Calling cephutils.SR._get_srlist")
+    def _get_rbdpools(self):
+        # ceph df is run by the commands reading the stats of the pools only
+        if self._rbdpools is None:
+            self._rbdpools = self._get_srlist()
+        return self._rbdpools
+
+    def _set_rbdpools(self, rbdpools):
+        self._rbdpools = rbdpools
+
+    RBDPOOLs = property(_get_rbdpools, _set_rbdpools)
+
+    def _get_backend(self):
+        # librbd connects to the cluster for the commands running rbd operations only
+        if self._backend is None:
+            self._backend = rbdsr_backend.get_backend(self.CEPH_POOL_NAME, self.CEPH_USER, self.backend_type)
+        return self._backend
+
+    def _set_backend(self, backend):
+        self._backend = backend
+
+    backend = property(_get_backend, _set_backend)
+
+    def _get_scan_cache(self):
+        if self._scan_cache is None:
+            self._scan_cache = rbdsr_scan.ScanCache(self._get_sr_uuid_by_name(self.CEPH_POOL_NAME), self.backend)
+        return self._scan_cache
+
+    def _set_scan_cache(self, scan_cache):
+        self._scan_cache = scan_cache
+
+    scan_cache = property(_get_scan_cache, _set_scan_cache)
+
+    def _get_lock(self):
+        # the lock image is probed by the commands taking the lock only
+        if self._lock is None:
+            self._lock = rbdsr_lock.Lock(self._get_sr_uuid_by_name(self.CEPH_POOL_NAME), cephx_id=self.CEPH_USER,
+                                         backend=self.backend)
+        return self._lock
+
+    def _set_lock(self, lock):
+        self._lock = lock
+
+    lock = property(_get_lock, _set_lock)
+
+    def _dev_instance_in_use(self, vdi_uuid):
+        """False once vdi_uuid is gone, or neither attached nor mapped as a SXM base, so that its device slot can be reclaimed"""
+        util.SMlog("Calling cephutils.SR._dev_instance_in_use: vdi_uuid=%s" % vdi_uuid)
+        try:
+            vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+        except XenAPI.Failure, e:
+            if e.details[0] == 'UUID_INVALID':
+                return False
+            raise
+        sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
+        return sm_config.has_key('attached') or sm_config.has_key('dm')
+
+    def _get_srlist(self, force_refresh=False):
+        util.SMlog("Calling cephutils.SR._get_srlist: force_refresh=%s" % force_refresh)
+        pool_stats = rbdsr_scan.PoolStatsCache(self.CEPH_USER, self.pool_stats_ttl)
+        if not force_refresh:
+            RBDPOOLs = pool_stats.load()
+            if RBDPOOLs is not None:
+                return RBDPOOLs
+
         RBDPOOLs = {}
 
         cmdout = util.pread2(["ceph", "df", "--format", "json", "--name", self.CEPH_USER])
@@ -181,13 +313,15 @@ class SR:
             if regex.search(poolinfo['name']):
                 sr_uuid = self._get_sr_uuid_by_name(poolinfo['name'])
                 RBDPOOLs[sr_uuid] = poolinfo
+        pool_stats.save(RBDPOOLs)
         return RBDPOOLs
 
     def load(self, sr_uuid, ceph_user):
         util.SMlog("Calling cephutils.SR.load: sr_uuid=%s, ceph_user=%s" % (sr_uuid,ceph_user))
         self.CEPH_USER = ( "client.%s" % ceph_user )
         self.CEPH_POOL_NAME = "%s%s" % (RBDPOOL_PREFIX, sr_uuid)
-        self.RBDPOOLs = self._get_srlist()
+        # the backend, pools stats and the lock are set up on first use, see backend, RBDPOOLs and lock
+        self.RBDPOOLs = None
 
         # Fallback to kernel mode if mode is fuse with different than admin
         # => --name arg not compatible with fuse mode
@@ -204,7 +338,12 @@ class SR:
         self.SR_ROOT = "%s/%s" % (SR_PREFIX, sr_uuid)
         self.DM_ROOT = "%s/%s-" % (DM_PREFIX, self.CEPH_POOL_NAME)
 
-        self.lock = rbdsr_lock.Lock(sr_uuid, cephx_id=self.CEPH_USER)
+        self.backend = None
+        self.vdi_metas = {}
+        self.vdilist = None
+        self.lock = None
+        self.scan_cache = None
+        self.slots = rbdsr_slots.SlotAllocator(self.nbds_max, self._dev_instance_in_use)
 
     def scan(self, sr_uuid):
         util.SMlog("Calling cephutils.SR.scan: sr_uuid=%s" % sr_uuid)
@@ -225,6 +364,18 @@ class SR:
             util.pread2(["ln -s", "-p", self.DEV_ROOT, self.SR_ROOT])
         elif self.mode == "nbd":
             util.pread2(["mkdir", "-p", self.DEV_ROOT])
+            self._load_nbd_module()
+
+    def _load_nbd_module(self):
+        """Load nbd with all its devices now rather than on the first rbd-nbd map"""
+        util.SMlog("Calling cephutils.SR._load_nbd_module: nbds_max=%s" % self.nbds_max)
+        if os.path.exists(NBD_MODULE_NBDS_MAX):
+            # nbds_max can't be changed while the module is loaded
+            loaded_nbds_max = int(open(NBD_MODULE_NBDS_MAX).read())
+            if loaded_nbds_max < self.nbds_max:
+                util.SMlog("nbd module is loaded with nbds_max=%s, less than the %s configured" % (loaded_nbds_max, self.nbds_max))
+        else:
+            util.pread2(["modprobe", "nbd", "nbds_max=%s" % self.nbds_max])
 
     def detach(self, sr_uuid):
         util.SMlog("Calling cephutils.SR.detach: sr_uuid=%s" % sr_uuid)
@@ -255,12 +406,13 @@ class VDI:
         util.SMlog("Calling cephutils.VDI.create: sr_uuid=%s, vdi_uuid=%s, size=%sMB" % (sr_uuid, vdi_uuid, image_size_M))
         # image_size_M = (size + OBJECT_SIZE_IN_B)/ 1024 / 1024
         # before JEWEL: util.pread2(["rbd", "create", self.CEPH_VDI_NAME, "--size", str(image_size), "--order", str(BLOCK_SIZE), "--image-format", str(IMAGE_FORMAT), "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
-        util.pread2(["rbd", "create", self.CEPH_VDI_NAME, "--size", str(image_size_M), "--object-size", str(OBJECT_SIZE_IN_B), "--image-format", str(IMAGE_FORMAT), "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+        self.sr.backend.create(self.CEPH_VDI_NAME, image_size_M, OBJECT_SIZE_IN_B, IMAGE_FORMAT)
+        self.sr._images_changed()
         if self.sr.use_rbd_meta:
             if self.label:
-                util.pread2(["rbd", "image-meta", "set", self.CEPH_VDI_NAME, "VDI_LABEL", self.label, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+                self.sr.backend.image_meta_set(self.CEPH_VDI_NAME, "VDI_LABEL", self.label)
             if self.description:
-                util.pread2(["rbd", "image-meta", "set", self.CEPH_VDI_NAME, "VDI_DESCRIPTION", self.description, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+                self.sr.backend.image_meta_set(self.CEPH_VDI_NAME, "VDI_DESCRIPTION", self.description)
 
     def resize(self, sr_uuid, vdi_uuid, image_size_M):
         util.SMlog("Calling cephutils.VDI.resize: sr_uuid=%s, vdi_uuid=%s, size=%sMB" % (sr_uuid, vdi_uuid, image_size_M))
@@ -273,7 +425,8 @@ class VDI:
             self.__unmap_VHD(vdi_uuid)
         #---
         ##image_size = size / 1024 / 1024
-        util.pread2(["rbd", "resize", "--size", str(image_size_M), "--allow-shrink", self.CEPH_VDI_NAME, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+        self.sr.backend.resize(self.CEPH_VDI_NAME, image_size_M)
+        self.sr._images_changed()
         #---
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
             self.__map_VHD(vdi_uuid)
@@ -291,12 +444,12 @@ class VDI:
                 self.__unmap_VHD(vdi_uuid)
 
             if self.label:
-                util.pread2(["rbd", "image-meta", "set", vdi_name, "VDI_LABEL", self.label, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+                self.sr.backend.image_meta_set(vdi_name, "VDI_LABEL", self.label)
             if self.description:
-                util.pread2(["rbd", "image-meta", "set", vdi_name, "VDI_DESCRIPTION", self.description, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+                self.sr.backend.image_meta_set(vdi_name, "VDI_DESCRIPTION", self.description)
             for snapshot_uuid in self.snaps.keys():
                 snapshot_name = "%s%s" % (SNAPSHOT_PREFIX, snapshot_uuid)
-                util.pread2(["rbd", "image-meta", "set", vdi_name, snapshot_name, str(self.snaps[snapshot_uuid]), "--pool",self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+                self.sr.backend.image_meta_set(vdi_name, snapshot_name, str(self.snaps[snapshot_uuid]))
 
             if sm_config.has_key('attached') and not sm_config.has_key('paused'):
                 self.__map_VHD(vdi_uuid)
@@ -312,8 +465,8 @@ class VDI:
                 raise util.SMException("failed to pause VDI %s" % clone_uuid)
             self.__unmap_VHD(clone_uuid)
         #--- ?????? CHECK For running VM. What if flattening takes a long time and vdi is paused during this process
-        clone_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, CLONE_PREFIX, clone_uuid)
-        util.pread2(["rbd", "flatten", clone_name, "--name", self.sr.CEPH_USER])
+        clone_name = "%s%s" % (CLONE_PREFIX, clone_uuid)
+        self.sr.backend.flatten(clone_name)
         #--- ??????
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
             self.__map_VHD(clone_uuid)
@@ -322,7 +475,6 @@ class VDI:
     def _delete_snapshot(self, vdi_uuid, snap_uuid):
         util.SMlog("Calling cephutils.VDI._delete_snapshot: vdi_uuid=%s, snap_uuid=%s" % (vdi_uuid, snap_uuid))
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
-        snapshot_name = "%s@%s%s" % (vdi_name, SNAPSHOT_PREFIX, snap_uuid)
         short_snap_name = "%s%s" % (SNAPSHOT_PREFIX, snap_uuid)
         vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
@@ -331,10 +483,11 @@ class VDI:
                 raise util.SMException("failed to pause VDI %s" % vdi_uuid)
             self.__unmap_VHD(vdi_uuid)
         #---
-        util.pread2(["rbd", "snap", "unprotect", snapshot_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
-        util.pread2(["rbd", "snap", "rm", snapshot_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+        self.sr.backend.snap_unprotect(vdi_name, short_snap_name)
+        self.sr.backend.snap_remove(vdi_name, short_snap_name)
+        self.sr._images_changed()
         if self.sr.use_rbd_meta:
-            util.pread2(["rbd", "image-meta", "remove", vdi_name, short_snap_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+            self.sr.backend.image_meta_remove(vdi_name, short_snap_name)
         #---
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
             self.__map_VHD(vdi_uuid)
@@ -345,35 +498,39 @@ class VDI:
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
         fuse_vdi_path = "%s/%s%s" % (self.sr.DEV_ROOT, VDI_PREFIX, vdi_uuid)
         if self.mode == "kernel":
-            util.pread2(["rbd", "rm", vdi_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+            self.sr.backend.remove(vdi_name)
         elif self.mode == "fuse":
             util.pread2(["rm", "-f", fuse_vdi_path])
         elif self.mode == "nbd":
-            util.pread2(["rbd", "rm", vdi_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+            self.sr.backend.remove(vdi_name)
+        self.sr._images_changed()
 
     def _change_image_prefix_to_SXM(self, vdi_uuid):
         util.SMlog("Calling cephutils.VDI._change_image_prefix_to_SXM: vdi_uuid=%s" % vdi_uuid)
-        orig_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, VDI_PREFIX, vdi_uuid)
-        new_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, SXM_PREFIX, vdi_uuid)
-        util.pread2(["rbd", "mv", orig_name, new_name, "--name", self.sr.CEPH_USER])
+        orig_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
+        new_name = "%s%s" % (SXM_PREFIX, vdi_uuid)
+        self.sr.backend.rename(orig_name, new_name)
+        self.sr._images_changed()
 
     def _change_image_prefix_to_VHD(self, vdi_uuid):
         util.SMlog("Calling cephutils.VDI._change_image_prefix_to_VHD: vdi_uuid=%s" % vdi_uuid)
-        orig_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, SXM_PREFIX, vdi_uuid)
-        new_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, VDI_PREFIX, vdi_uuid)
-        util.pread2(["rbd", "mv", orig_name, new_name, "--name", self.sr.CEPH_USER])
+        orig_name = "%s%s" % (SXM_PREFIX, vdi_uuid)
+        new_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
+        self.sr.backend.rename(orig_name, new_name)
+        self.sr._images_changed()
 
     def _rename_image(self, orig_uuid, new_uuid):
         util.SMlog("Calling cephutils.VDI._rename_image: orig_uuid=%s, new_uuid=%s" % (orig_uuid, new_uuid))
-        orig_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, VDI_PREFIX, orig_uuid)
-        new_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, VDI_PREFIX, new_uuid)
-        util.pread2(["rbd", "mv", orig_name, new_name, "--name", self.sr.CEPH_USER])
+        orig_name = "%s%s" % (VDI_PREFIX, orig_uuid)
+        new_name = "%s%s" % (VDI_PREFIX, new_uuid)
+        self.sr.backend.rename(orig_name, new_name)
+        self.sr._images_changed()
 
     def _do_clone(self, vdi_uuid, snap_uuid, clone_uuid, vdi_label):
         util.SMlog("Calling cephutils.VDI._do_clone: vdi_uuid=%s, snap_uuid=%s, clone_uuid=%s, vdi_label=%s" % (vdi_uuid, snap_uuid, clone_uuid, vdi_label))
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
-        snapshot_name = "%s/%s@%s%s" % (self.sr.CEPH_POOL_NAME, vdi_name, SNAPSHOT_PREFIX, snap_uuid)
-        clone_name = "%s/%s%s" % (self.sr.CEPH_POOL_NAME, CLONE_PREFIX, clone_uuid)
+        snap_name = "%s%s" % (SNAPSHOT_PREFIX, snap_uuid)
+        clone_name = "%s%s" % (CLONE_PREFIX, clone_uuid)
         vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
@@ -381,10 +538,11 @@ class VDI:
                 raise util.SMException("failed to pause VDI %s" % vdi_uuid)
             self.__unmap_VHD(vdi_uuid)
         #---
-        util.pread2(["rbd", "clone", snapshot_name, clone_name, "--name", self.sr.CEPH_USER])
+        self.sr.backend.clone(vdi_name, snap_name, clone_name)
+        self.sr._images_changed()
         if self.sr.use_rbd_meta:
-            util.pread2(["rbd", "image-meta", "set", clone_name, "VDI_LABEL", vdi_label, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
-            util.pread2(["rbd", "image-meta", "set", clone_name, "CLONE_OF", snap_uuid, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+            self.sr.backend.image_meta_set(clone_name, "VDI_LABEL", vdi_label)
+            self.sr.backend.image_meta_set(clone_name, "CLONE_OF", snap_uuid)
         #---
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
             self.__map_VHD(vdi_uuid)
@@ -393,7 +551,7 @@ class VDI:
     def _do_snapshot(self, vdi_uuid, snap_uuid):
         util.SMlog("Calling cephutils.VDI._do_snapshot: vdi_uuid=%s, snap_uuid=%s" % (vdi_uuid, snap_uuid))
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
-        snapshot_name = "%s@%s%s" % (vdi_name, SNAPSHOT_PREFIX, snap_uuid)
+        snap_name = "%s%s" % (SNAPSHOT_PREFIX, snap_uuid)
         vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
@@ -401,8 +559,9 @@ class VDI:
                 raise util.SMException("failed to pause VDI %s" % vdi_uuid)
             self.__unmap_VHD(vdi_uuid)
         #---
-        util.pread2(["rbd", "snap", "create", snapshot_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
-        util.pread2(["rbd", "snap", "protect", snapshot_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+        self.sr.backend.snap_create(vdi_name, snap_name)
+        self.sr.backend.snap_protect(vdi_name, snap_name)
+        self.sr._images_changed()
         #---
         if sm_config.has_key('attached') and not sm_config.has_key('paused'):
             self.__map_VHD(vdi_uuid)
@@ -411,19 +570,15 @@ class VDI:
     def _rollback_snapshot(self, base_uuid, snap_uuid):
         util.SMlog("Calling cephutils.VDI._rollback_snapshot: base_uuid=%s, snap_uuid=%s" % (base_uuid, snap_uuid))
         vdi_name = "%s%s" % (VDI_PREFIX, base_uuid)
-        snapshot_name = "%s@%s%s" % (vdi_name, SNAPSHOT_PREFIX, snap_uuid)
-        util.pread2(["rbd", "snap", "rollback", snapshot_name, "--pool", self.sr.CEPH_POOL_NAME, "--name", self.sr.CEPH_USER])
+        snap_name = "%s%s" % (SNAPSHOT_PREFIX, snap_uuid)
+        self.sr.backend.snap_rollback(vdi_name, snap_name)
+        self.sr._images_changed()
 
     def _get_vdi_meta(self, vdi_uuid):
         util.SMlog("Calling cephutils.VDI._get_vdi_meta: vdi_uuid=%s" % vdi_uuid)
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
         if self.sr.use_rbd_meta:
-            cmdout = util.pread2(["rbd", "image-meta", "list", vdi_name, "--pool", self.sr.CEPH_POOL_NAME, "--format", "json", "--name", self.sr.CEPH_USER])
-            if len(cmdout) != 0:
-                decoded = json.loads(cmdout)
-                return decoded
-            else:
-                return {}
+            return self.sr.backend.image_meta_list(vdi_name)
         else:
             return {}
 
@@ -431,23 +586,59 @@ class VDI:
         util.SMlog("Calling cephutils.VDI._get_vdi_info: vdi_uuid=%s" % vdi_uuid)
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
         if self.sr.use_rbd_meta:
-            cmdout = util.pread2(["rbd", "info", vdi_name, "--pool", self.sr.CEPH_POOL_NAME, "--format", "json", "--name", self.sr.CEPH_USER])
-            if len(cmdout) != 0:
-                decoded = json.loads(cmdout)
-                return decoded
-            else:
-                return {}
+            return self.sr.backend.image_info(vdi_name)
         else:
             return {}
 
     def _if_vdi_exist(self, vdi_uuid):
         util.SMlog("Calling cephutils.VDI._if_vdi_exist: vdi_uuid=%s" % vdi_uuid)
         vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
+        return self.sr.backend.image_exists(vdi_name)
+
+    def _call_host_plugin(self, host_ref, op, args):
+        """op of ceph_plugin run on host_ref, over a xapi session of its own"""
+        util.SMlog("Calling '%s' on host %s" % (op, host_ref))
+        session = util.get_localAPI_session()
         try:
-            cmdout = util.pread2(["rbd", "info", vdi_name, "--pool", self.sr.CEPH_POOL_NAME, "--format", "json", "--name", self.sr.CEPH_USER])
-            return True
-        except Exception:
-            return False
+            return session.xenapi.host.call_plugin(host_ref, "ceph_plugin", op, args)
+        finally:
+            session.xenapi.session.logout()
+
+    def _call_hosts_plugin(self, host_refs, op, args):
+        """
+        Runs op of ceph_plugin on all host_refs at once, within PLUGIN_DEADLINE seconds.
+        Returns the errors by host of the calls which failed, and the hosts whose
+        call is still running past the deadline, which are among them.
+        """
+        if len(host_refs) == 1:
+            # nothing to overlap, the call runs over the session of the command
+            util.SMlog("Calling '%s' on host %s" % (op, host_refs[0]))
+            try:
+                if self.session.xenapi.host.call_plugin(host_refs[0], "ceph_plugin", op, args):
+                    return ({}, [])
+                return ({host_refs[0]: "no result"}, [])
+            except Exception, e:
+                return ({host_refs[0]: str(e)}, [])
+
+        workers = ThreadPool(len(host_refs))
+        calls = [(host_ref, workers.apply_async(self._call_host_plugin, (host_ref, op, args))) for host_ref in host_refs]
+        workers.close()
+        deadline = time.time() + PLUGIN_DEADLINE
+        errors = {}
+        running = []
+        for (host_ref, call) in calls:
+            try:
+                if not call.get(max(deadline - time.time(), 0)):
+                    errors[host_ref] = "no result"
+            except TimeoutError:
+                errors[host_ref] = "no result within %s seconds" % PLUGIN_DEADLINE
+                running.append(host_ref)
+            except Exception, e:
+                errors[host_ref] = str(e)
+        # calls past the deadline are left running in the daemon threads of the pool
+        if not running:
+            workers.join()
+        return (errors, running)
 
     def _call_plugin(self, op, args):
         util.SMlog("Calling cephutils.VDI._call_plugin: op=%s" % op)
@@ -456,20 +647,31 @@ class VDI:
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
         util.SMlog("Calling ceph_plugin")
 
-        if filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-                host_ref = key[len('host_'):]
-                util.SMlog("Calling '%s' on host %s" % (op, host_ref))
-                if not self.session.xenapi.host.call_plugin(host_ref, "ceph_plugin", op, args):
-                    # Failed to pause node
-                    raise util.SMException("failed to %s VDI %s" % (op, vdi_uuid))
-        else:
+        host_refs = [key[len('host_'):] for key in sm_config.keys() if key.startswith('host_')]
+        if not host_refs:
             host_uuid = inventory.get_localhost_uuid()
             host_ref = self.session.xenapi.host.get_by_uuid(host_uuid)
             util.SMlog("Calling '%s' on localhost %s" % (op, host_ref))
             if not self.session.xenapi.host.call_plugin(host_ref, "ceph_plugin", op, args):
                 # Failed to pause node
                 raise util.SMException("failed to %s VDI %s" % (op, vdi_uuid))
+            return
+
+        (errors, running) = self._call_hosts_plugin(host_refs, op, args)
+        for host_ref in host_refs:
+            util.SMlog("'%s' on host %s: %s" % (op, host_ref, errors.get(host_ref, "done")))
+        if errors:
+            # the hosts where op went through are left as they are, the others are undone,
+            # except those still running it: undoing could finish before op does
+            failed = [host_ref for host_ref in host_refs if host_ref in errors]
+            rollback = [host_ref for host_ref in failed if host_ref not in running]
+            if op in PLUGIN_ROLLBACK and rollback:
+                (rollback_errors, rollback_running) = self._call_hosts_plugin(rollback, PLUGIN_ROLLBACK[op], args)
+                for host_ref in rollback:
+                    util.SMlog("'%s' rolled back on host %s: %s" % (op, host_ref, rollback_errors.get(host_ref, "done")))
+            if running:
+                raise util.SMException("failed to %s VDI %s on hosts %s, still running on hosts %s" % (op, vdi_uuid, ", ".join(failed), ", ".join(running)))
+            raise util.SMException("failed to %s VDI %s on hosts %s" % (op, vdi_uuid, ", ".join(failed)))
 
     def __map_VHD(self, vdi_uuid):
         _vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
@@ -497,7 +699,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm, "dev":dev}
         self._call_plugin('_map',args)
@@ -526,7 +728,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm}
         self._call_plugin('_unmap',args)
@@ -555,7 +757,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm, "dev":dev,
                 "size":str(size)}
@@ -589,7 +791,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm,
                 "size":str(size)}
@@ -622,7 +824,7 @@ class VDI:
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "_snap_name":_snap_name, "__snap_name":__snap_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm, "dev":dev,
                 "size":str(size)}
@@ -658,7 +860,7 @@ class VDI:
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "_snap_name":_snap_name, "__snap_name":__snap_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm,
                 "size":str(size)}
@@ -690,7 +892,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm, "dev":dev,
                 "size":str(size)}
@@ -719,13 +921,36 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm,
                 "size":str(size)}
         self._call_plugin('unmap',args)
         self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'dm')
 
+    def _alloc_dev_instance(self, vdi_uuid):
+        util.SMlog("Calling cephutils.VDI._alloc_dev_instance: vdi_uuid=%s" % vdi_uuid)
+
+        try:
+            dev_instance = self.sr.slots.alloc(self.sr.uuid, vdi_uuid)
+        except util.SMException, e:
+            raise xs_errors.XenError('VDIUnavailable', opterr=str(e))
+
+        vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+        sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
+        if sm_config.has_key("dev_instance"):
+            self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
+        self.session.xenapi.VDI.add_to_sm_config(vdi_ref, "dev_instance", str(dev_instance))
+        return dev_instance
+
+    def _free_dev_instance(self, vdi_uuid):
+        util.SMlog("Calling cephutils.VDI._free_dev_instance: vdi_uuid=%s" % vdi_uuid)
+
+        self.sr.slots.free(vdi_uuid)
+
+        vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+        self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
+
     def _map_sxm_base(self, vdi_uuid, size):
         _vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
         _dev_name = "%s/%s" % (self.sr.DEV_ROOT, _vdi_name)
@@ -736,31 +961,12 @@ class VDI:
 
         host_uuid = inventory.get_localhost_uuid()
         vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
-        sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
         dm="base"
 
-        self.sr.lock.acquire()
-
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr.sr_ref)
-        sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-        self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-
-        first_free_instance = -1
-        for i in range(NBDS_MAX):
-            if sr_dev_instances["hosts"][host_uuid][i] == None:
-                first_free_instance = i
-                break
-        sr_dev_instances["hosts"][host_uuid][first_free_instance] = vdi_uuid
-        self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-
-        if sm_config.has_key("dev_instance"):
-            self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
-        self.session.xenapi.VDI.add_to_sm_config(vdi_ref, "dev_instance", str(first_free_instance))
+        dev = str(self._alloc_dev_instance(vdi_uuid))
 
         self.session.xenapi.VDI.add_to_sm_config(vdi_ref, 'dm', dm)
 
-        dev = str(first_free_instance)
-
         if self.session.xenapi.VDI.get_sharable(vdi_ref):
             sharable="true"
         else:
@@ -773,7 +979,7 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm, "dev":dev,
                 "size":str(size)}
@@ -781,17 +987,12 @@ class VDI:
         try:
            self._call_plugin('map',args)
         except Exception, e:
-            self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-            sr_dev_instances["hosts"][host_uuid][first_free_instance] = None
-            self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-            self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
+            self._free_dev_instance(vdi_uuid)
             self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'dm')
             raise xs_errors.XenError('VDIUnavailable', opterr='Failed to map RBD sr_uuid=%s, vdi_uuid=%s, \
                                                                host_uuid=%s (%s)' % (self.sr.uuid, vdi_uuid,
                                                                                      host_uuid, str(e)))
 
-        self.sr.lock.release()
-
     def _unmap_sxm_base(self, vdi_uuid, size):
         _vdi_name = "%s%s" % (VDI_PREFIX, vdi_uuid)
         _dev_name = "%s/%s" % (self.sr.DEV_ROOT, _vdi_name)
@@ -802,7 +1003,6 @@ class VDI:
 
         vdi_ref = self.session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
-        sr_sm_config = self.session.xenapi.SR.get_sm_config(self.sr.sr_ref)
 
         dm="base"
         if self.session.xenapi.VDI.get_sharable(vdi_ref):
@@ -817,27 +1017,14 @@ class VDI:
                 "_vdi_name":_vdi_name,  "_dev_name":_dev_name,
                 "_dmdev_name":_dmdev_name, "_dm_name":_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,"sharable":sharable,
                 "dm":dm,
                 "size":str(size)}
         self._call_plugin('unmap',args)
         self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'dm')
 
-        self.sr.lock.acquire()
-
-        sr_dev_instances = json.loads(sr_sm_config["dev_instances"])
-        self.session.xenapi.SR.remove_from_sm_config(self.sr.sr_ref, "dev_instances")
-        host_uuid = inventory.get_localhost_uuid()
-        if sr_dev_instances["hosts"].has_key(host_uuid):
-            for i in range(NBDS_MAX):
-                if sr_dev_instances["hosts"][host_uuid][i] == vdi_uuid:
-                    sr_dev_instances["hosts"][host_uuid][i] = None
-                    break
-        self.session.xenapi.SR.add_to_sm_config(self.sr.sr_ref, "dev_instances", json.dumps(sr_dev_instances))
-        self.session.xenapi.VDI.remove_from_sm_config(vdi_ref, "dev_instance")
-
-        self.sr.lock.release()
+        self._free_dev_instance(vdi_uuid)
 
     def _merge_sxm_diffs(self, mirror_uuid, base_uuid, size):
         util.SMlog("Calling cephutills.VDI._merge_sxm_diffs: mirror_uuid=%s, base_uuid=%s, size=%s" % (mirror_uuid, base_uuid, size))
@@ -888,7 +1075,7 @@ class VDI:
                 "_base_vdi_name":_base_vdi_name,  "_base_dev_name":_base_dev_name,
                 "_base_dmdev_name":_base_dmdev_name, "_base_dm_name":_base_dm_name,
                 "CEPH_POOL_NAME":self.sr.CEPH_POOL_NAME,
-                "NBDS_MAX":str(NBDS_MAX),
+                "NBDS_MAX":str(self.sr.nbds_max),
                 "CEPH_USER":self.sr.CEPH_USER,
                 "size":str(size)}
         self._call_plugin('merge',args)
@@ -897,9 +1084,14 @@ class VDI:
         self._unmap_sxm_base(base_uuid, size)
         #---
         tmp_uuid = "temporary"  # util.gen_uuid()
-        self._rename_image(mirror_uuid, tmp_uuid)
-        self._rename_image(base_uuid, mirror_uuid)
-        self._rename_image(tmp_uuid, base_uuid)
+        # the temporary image name is shared by the hosts of the pool, the cluster lock keeps their swaps apart
+        self.sr.lock.acquire()
+        try:
+            self._rename_image(mirror_uuid, tmp_uuid)
+            self._rename_image(base_uuid, mirror_uuid)
+            self._rename_image(tmp_uuid, base_uuid)
+        finally:
+            self.sr.lock.release()
         #---
         self._map_VHD(mirror_uuid, size, "linear")
         #---
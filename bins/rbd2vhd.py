@@ -18,12 +18,18 @@
 from __future__ import print_function
 from struct import *
 import uuid
+import os
+import stat
 import sys, getopt
 import re
 import time
 import socket
 import select
 import threading
+import json
+sys.path.append("/opt/xensource/sm/")
+import rbddiff
+import vhdfile
 
 verbose = False
 debug = False
@@ -35,98 +41,7 @@ VHD_DIFF_HARDDISK_TYPE = 0x00000004# Differencing hard disk
 
 VDI_PREFIX = "VHD-"
 SNAPSHOT_PREFIX = "SNAP-"
-
-#-- VHD FOOTTER FIELDs --#
-_vhd_footter_cookie_                 = 0
-_vhd_footter_features_               = 1
-_vhd_footter_file_format_version_    = 2
-_vhd_footter_data_offset_            = 3
-_vhd_footter_time_stamp_             = 4
-_vhd_footter_creator_application_    = 5
-_vhd_footter_creator_version_        = 6
-_vhd_footter_creator_host_os_        = 7
-_vhd_footter_original_size_          = 8
-_vhd_footter_current_size_           = 9
-_vhd_footter_disk_geometry_          = 10
-_vhd_footter_disk_type_              = 11
-_vhd_footter_checksum_               = 12
-_vhd_footter_unique_iq_              = 13
-_vhd_footter_saved_state_            = 14
-_vhd_footter_hidden_                 = 15
-_vhd_footter_rbd_image_uuid_         = 16
-#-- VHD FOOTTER FIELDs --#
-
-#-- VHD DISK GEOMETRY FIELs --#
-_vhd_disk_geometry_cylinders_            = 0
-_vhd_disk_geometry_heads_                = 1
-_vhd_disk_geometry_sectors_per_cylinder_ = 2
-#-- VHD DISK GEOMETRY FIELs --#
-
-#-- DYNAMIC DISK HEADER FIELDs --#
-_dynamic_disk_header_cookie_                    = 0
-_dynamic_disk_header_data_offset_               = 1
-_dynamic_disk_header_table_offset_              = 2
-_dynamic_disk_header_header_version_            = 3
-_dynamic_disk_header_max_table_entries_         = 4
-_dynamic_disk_header_block_size_                = 5
-_dynamic_disk_header_checksum_                  = 6
-_dynamic_disk_header_parent_unique_id_          = 7
-_dynamic_disk_header_parent_time_stamp_         = 8
-_dynamic_disk_header_parent_unicode_name_       = 10
-_dynamic_disk_header_parent_locator_entry_1_    = 11
-_dynamic_disk_header_parent_locator_entry_2_    = 12
-_dynamic_disk_header_parent_locator_entry_3_    = 13
-_dynamic_disk_header_parent_locator_entry_4_    = 14
-_dynamic_disk_header_parent_locator_entry_5_    = 15
-_dynamic_disk_header_parent_locator_entry_6_    = 16
-_dynamic_disk_header_parent_locator_entry_7_    = 17
-_dynamic_disk_header_parent_locator_entry_8_    = 18
-#-- DYNAMIC DISK HEADER FIELDs --#
-
-#-- BATMAP FIELDs --#
-_batmap_cookie_      = 0
-_batmap_offset_      = 1
-_batmap_size_        = 2
-_batmap_version_     = 3
-_batmap_checksum_    = 4
-_batmap_marker_      = 5
-#-- BATMAP FIELDs --#
-
-#-- PARENT LOCATOR ENTRY FIELD --#
-_parent_locator_platform_code_          = 0
-_parent_locator_platform_data_space_    = 1
-_parent_locator_platform_data_length_   = 2
-_parent_locator_platform_data_offset_   = 4
-#-- PARENT LOCATOR ENTRY FIELD --#_
-
-#-- DISK TYPES --#
-_disk_type_none                     = 0
-_disk_type_fixed_hard_disk          = 2
-_disk_type_dynamic_hard_disk        = 3
-_disk_type_differencing_hard_disk   = 4
-#-- DISK TYPES --#
-
-#-- PLATFORM CODEs --#
-_platform_code_None_    = 0x0
-_platform_code_Wi2r_    = 0x57693272
-_platform_code_Wi2k_    = 0x5769326B
-_platform_code_W2ru_    = 0x57327275
-_platform_code_W2ku_    = 0x57326B75
-_platform_code_Mac_     = 0x4D616320
-_platform_code_MacX_    = 0x4D616358
-#-- PLATFORM CODEs --#
-
-VHD_FOTTER_FORMAT = "!8sIIQI4sIIQQ4sII16sBB16s410s"
-VHD_FOTTER_RECORD_SIZE = 512
-VHD_DISK_GEOMETRY_FORMAT = "!HBB"
-VHD_DISK_GEOMETRY_RECORD_SIZE = 4
-VHD_DYNAMIC_DISK_HEADER_FORMAT = "!8sQQIIII16sII512s24s24s24s24s24s24s24s24s256s"
-VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE = 1024
-VHD_PARENT_LOCATOR_ENTRY_FORMAT = "!IIIIQ"
-VHD_PARENT_LOCATOR_ENTRY_RECORD_SIZE = 24
-VHD_PARENT_LOCATORS_COUNT = 9
-VHD_BATMAP_HEADER_FORMAT = "!8sQIIIB483s"
-VHD_BATMAP_HEADER_SIZE = 512
+_snapshot_prefix_ = re.compile(SNAPSHOT_PREFIX)
 
 #-- RBD DIFF v1 META AND DATA FIELDs --#
 RBD_HEADER = "rbd diff v1\n"
@@ -156,7 +71,38 @@ NBD_REQUEST_HEADER_SIZE = 28
 NBD_REPLY_HEADER_FORMAT = "!LLQ"
 NBD_REPLY_HEADER_SIZE = 16
 
-NBD_CHUNK_SIZE = SECTOR_SIZE*1024
+# size of the nbd requests data records are sent and coalesced in, and its upper bound,
+# the largest request the nbd servers commonly accept
+NBD_CHUNK_SIZE = SECTOR_SIZE*8192
+NBD_MAX_CHUNK_SIZE = SECTOR_SIZE*65536
+# zero records up to this size are sent as data when it saves a request
+NBD_INLINE_ZEROES_SIZE = SECTOR_SIZE*128
+# write zeroes requests are split to fit their 32 bits length
+NBD_ZEROES_CHUNK_SIZE = 1024*1024*1024
+
+# zeroes written to devices and to nbd servers without write zeroes go out from one
+# zero page of at least this size
+ZERO_PAGE_SIZE = SECTOR_SIZE*2048
+ZERO_PAGE = memoryview('')
+
+# data records are read in slices of at most this size, into one reused buffer
+RBD_READ_CHUNK_SIZE = VHD_DEFAULT_BLOCK_SIZE
+# requests sent to the nbd server without waiting for their replies
+NBD_WINDOW = 64
+# payloads up to this size are sent along with their request header in one call
+NBD_COPY_SIZE = 65536
+# connections opened to servers advertising NBD_FLAG_CAN_MULTI_CONN, requests go to
+# them by offset in slices of NBD_SHARD_SIZE, or of the chunk size if larger
+NBD_CONNECTIONS = 4
+NBD_SHARD_SIZE = SECTOR_SIZE*8192
+
+# threads writing the data blocks of rbd2vhd to a regular file, 0 to write it sequentially,
+# and the buffers of blocks being written by them
+VHD_WRITER_THREADS = 4
+VHD_WRITER_BUFFERS = 8
+
+# vhd2rbd merges data of adjacent blocks into one rbd diff record up to this size
+VHD2RBD_MAX_RECORD_SIZE = VHD_DEFAULT_BLOCK_SIZE*16
 
 _nbd_negotiation_init_passwd_        = 0
 _nbd_negotiation_cliserver_magic_    = 1
@@ -256,167 +202,78 @@ def MROUTPUT(string):
        print(pack("!B",0),end="")
        print(pack("!3B",0,0,0),end="")
 
-def modTupleByIndex(tup, index, ins):
-    return tuple(tup[0:index]) + (ins,) + tuple(tup[index+1:])
-
-def checksum(vhd_record):
-    checksum = 0
-    b = bytearray()
-    b.extend(vhd_record)
-    for index in range(len(vhd_record)):
-        checksum += b[index]
-    checksum = ~checksum + 2**32
-    return checksum
-
-def get_size_aligned_to_sector_boundary(size):
-    if size%SECTOR_SIZE>0:
-        aligned_size = ((size//SECTOR_SIZE)+1)*SECTOR_SIZE
+def gen_zero_page(size):
+    global ZERO_PAGE
+    if len(ZERO_PAGE) < size:
+        ZERO_PAGE = memoryview('\0'*max(size, ZERO_PAGE_SIZE))
+    return ZERO_PAGE
+
+def write_zeroes(fh, length):
+    zero_page = gen_zero_page(ZERO_PAGE_SIZE)
+    while length > 0:
+        fh.write(zero_page[:min(length, len(zero_page))])
+        length -= len(zero_page)
+
+def pwrite(fd, data, offset):
+    # descriptors are not shared between threads, so that lseek and write pair up
+    os.lseek(fd, offset, os.SEEK_SET)
+    data = memoryview(data)
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+def gen_vhd_metadata(image_size, rbd_image_uuid, from_snap_name, to_snap_name):
+    """
+    Footer, dynamic disk header, empty BAT and the sectors following the BAT (batmap
+    header, batmap and parent locators) of the vhd of an rbd diff
+    """
+    if to_snap_name:
+        vhd_uuid = uuid.UUID(to_snap_name)
     else:
-        aligned_size = size
-    return aligned_size
-
-def get_bitmap_size(dynamic_disk_header):
-    sectors_in_block = dynamic_disk_header[_dynamic_disk_header_block_size_]/SECTOR_SIZE
-    bitmap_size = sectors_in_block/8
-    return get_size_aligned_to_sector_boundary(bitmap_size)
-
-def gen_empty_bitarray_for_bitmap(bitmap_size):
-    bitarray = []
-    for bitmap_index in range(bitmap_size):
-        for bit_index in range(8):
-            bitarray.append(0)
-    return bitarray
-
-def gen_bitmap_from_bitarray(bitarray):
-    _bytearray_ = {}
-    bitmap = ''
-    for bitarray_index in range(len(bitarray)):
-        bit = 0
-        byte_index = bitarray_index//8
-        bit_in_byte = bitarray_index%8
-        if bitarray[bitarray_index] == 1:
-            bit = 128 >> bit_in_byte
-        if _bytearray_.has_key(byte_index):
-            _bytearray_[byte_index] = _bytearray_[byte_index] | bit
-        else:
-            _bytearray_[byte_index] = bit
-    for byte_index in range(len(_bytearray_)):
-        bitmap = bitmap + pack('!c', chr(_bytearray_[byte_index]))
-    return bitmap
-
-def get_bitarray_from_bitmap(bitmap, bitmap_size):
-    bitarray = []
-    _bitmap_ = bytearray()
-    _bitmap_.extend(bitmap)
-    for bitmap_index in range(bitmap_size):
-        for bit_index in range(8):
-            offset = 128 >> bit_index
-            if (_bitmap_[bitmap_index] & offset) > 0:
-                bitarray.append(1)
-            else:
-                bitarray.append(0)
-    return bitarray
-
-def gen_empty_vhd_bat(image_size):
-    bat_list = []
-    max_tab_entries = image_size / VHD_DEFAULT_BLOCK_SIZE
-    for bat_index in range(max_tab_entries):
-        bat_list.append(0xffffffff)
-    return bat_list
-
-def gen_empty_batmap():
-    return pack("!%ds" % (SECTOR_SIZE*2), '')
-
-def gen_batmap_header(batmap):
-    reserved = ''
-    for i in range(483):
-        reserved = reserved + pack('!c', chr(0))
-    batmap_header_struct = ('tdbatmap', 0, 0, 0x00010002, 0, 0, reserved) #empty
-    return batmap_header_struct
-
-def pack_vhd_bat(bat_list):
-    max_tab_entries = len(bat_list)
-    bat = ''
-    for bat_index in range(max_tab_entries):
-        bat = bat + pack("!I", bat_list[bat_index])
-    if max_tab_entries < SECTOR_SIZE/4:
-        bat = bat + pack("!%ds" % (SECTOR_SIZE - max_tab_entries*4), '')
-    return bat
-
-def gen_vhd_geometry_struct(image_size):
-    totalSectors = image_size / SECTOR_SIZE
-    if totalSectors > 65535*16*255:
-        totalSectors = 65535*16*255
-    if totalSectors >= 65535*16*255:
-        sectorsPerTrack = 255
-        heads = 16
-        cylinderTimesHeads = totalSectors / sectorsPerTrack
+        vhd_uuid = uuid.UUID(rbd_image_uuid)
+    rbd_uuid = uuid.UUID(rbd_image_uuid)
+
+    table_offset = vhdfile.FOOTER_SIZE + vhdfile.DYNAMIC_DISK_HEADER_SIZE
+    vhd_bat = vhdfile.gen_empty_bat(image_size / VHD_DEFAULT_BLOCK_SIZE)
+    parent_locators = []
+    if from_snap_name:
+        parent_uuid = uuid.UUID(from_snap_name)
+        vhd_footer = vhdfile.gen_footer(VHD_DIFF_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, time.time())
+        vhd_dynamic_disk_header = vhdfile.gen_dynamic_disk_header(table_offset, image_size, parent_uuid.bytes, "%s.vhd" % parent_uuid, time.time())
+        parent_locators = [(vhdfile.PLATFORM_CODE_MACX, "file://./%s.vhd" % parent_uuid),
+                           (vhdfile.PLATFORM_CODE_W2KU, (".\\%s.vhd" % parent_uuid).encode("UTF-16LE")),
+                           (vhdfile.PLATFORM_CODE_W2RU, (".\\%s.vhd" % parent_uuid).encode("UTF-16LE"))]
     else:
-        sectorsPerTrack = 17
-        cylinderTimesHeads = totalSectors / sectorsPerTrack
-        heads = (cylinderTimesHeads + 1023) / 1024
-        if heads < 4:
-            heads = 4
-        if (cylinderTimesHeads >= (heads * 1024)) or (heads > 16):
-            sectorsPerTrack = 31
-            heads = 16
-            cylinderTimesHeads = totalSectors / sectorsPerTrack
-        if cylinderTimesHeads >= (heads * 1024):
-            sectorsPerTrack = 63
-            heads = 16
-            cylinderTimesHeads = totalSectors / sectorsPerTrack
-    cylinders = cylinderTimesHeads / heads
-    geometry_struct = (cylinders, heads, sectorsPerTrack)
-    #INFO("[gen_vhd_geometry_struct]: totalSectors = %d, Cyliders = %d, heads = %d, sectors per track = %d" % (totalSectors, cylinders, heads, sectorsPerTrack))
-    return geometry_struct
-
-def gen_vhd_footer_struct(disk_type, image_size, vhd_uuid, rbd_uuid, checksum):
-    vhd_geometry_struct = gen_vhd_geometry_struct(image_size)
-    vhd_geometry = pack(VHD_DISK_GEOMETRY_FORMAT, vhd_geometry_struct[0], vhd_geometry_struct[1], vhd_geometry_struct[2])
-    reserved = ''
-    for i in range(410):
-        reserved = reserved + pack('!c', chr(0))
-    vhd_footer_struct = ('conectix', 0x00000002, 0x00010000, 0x00000200, time.time()-946684800, 'tap', 0x00010003,
-                         0x00000000, image_size, image_size, vhd_geometry, disk_type, checksum, vhd_uuid, 0, 0,
-                         rbd_uuid, reserved)
-    return vhd_footer_struct
-
-def gen_vhd_dynamic_disk_header_struct(table_offset, image_size, checksum, parent_uuid, parent_unicode_name):
-    max_tab_entries = image_size / VHD_DEFAULT_BLOCK_SIZE
-    reserved = ''
-    for i in range(256):
-        reserved = reserved + pack('!c', chr(0))
-    parent_locator_entry_empty_struct = (0x00000000, 0, 0, 0, 0) #empty
-    parent_locator_entry_empty = pack(VHD_PARENT_LOCATOR_ENTRY_FORMAT, *parent_locator_entry_empty_struct)
-    dynamic_disk_header_struct = ('cxsparse', 0xffffffffffffffff, table_offset, 0x00010000, max_tab_entries,
-                    VHD_DEFAULT_BLOCK_SIZE, checksum, parent_uuid, 0, 0x00000000, parent_unicode_name.encode("UTF-16BE"),
-                    parent_locator_entry_empty, parent_locator_entry_empty, parent_locator_entry_empty,
-                    parent_locator_entry_empty, parent_locator_entry_empty, parent_locator_entry_empty,
-                    parent_locator_entry_empty, parent_locator_entry_empty,
-                    reserved)
-    return dynamic_disk_header_struct
-
-def get_sector_bitmap_and_data(vhdfile, data_block_offset, block_size):
-    sectors_in_block = block_size/SECTOR_SIZE
-    bitmap_size = sectors_in_block/8
-    if bitmap_size%512>0:
-        bitmap_size=((bitmap_size//512)+1)*512
-    _format_ = "!%is%is" % (bitmap_size,block_size)
-    vhdfile.seek((data_block_offset)*512, 0)
-    BUFFER=vhdfile.read(bitmap_size+block_size)
-    bitmap_and_data=unpack(_format_,BUFFER)
-    _format_ = "!"
-    for i in range(sectors_in_block):
-        _format_ = _format_ + "512s"
-    data = unpack(_format_,bitmap_and_data[1])
-    return [bitmap_and_data[0],data]
-
-def get_raw_byte_offset_of_sector(block_number, sector_in_block, block_size, sector_size):
-    return block_number*block_size+sector_in_block*sector_size
-
-def get_raw_sector_offset_of_sector(block_number, sector_in_block, block_size, sector_size):
-    sector_per_block = block_size / sector_size
-    return block_number*sector_per_block+sector_in_block
+        vhd_footer = vhdfile.gen_footer(VHD_DYNAMIC_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, time.time())
+        vhd_dynamic_disk_header = vhdfile.gen_dynamic_disk_header(table_offset, image_size)
+
+    vhd_file_offset = table_offset + len(vhdfile.pack_bat(vhd_bat))
+    VHD_BATMAP = '\0' * (SECTOR_SIZE*2)
+    metadata = [vhdfile.gen_batmap_header(vhd_file_offset + vhdfile.BATMAP_HEADER_SIZE, VHD_BATMAP).pack(), VHD_BATMAP]
+    vhd_file_offset += vhdfile.BATMAP_HEADER_SIZE + len(VHD_BATMAP)
+
+    # a sector is kept for each parent locator entry, and one more
+    for index in range(vhdfile.PARENT_LOCATORS_COUNT + 1):
+        if index < len(parent_locators):
+            (platform_code, parent_locator) = parent_locators[index]
+            parent_locator_space = vhdfile.get_size_aligned_to_sector_boundary(len(parent_locator))
+            vhd_dynamic_disk_header.set_parent_locator_entry(index, vhdfile.ParentLocatorEntry(platform_code, parent_locator_space, len(parent_locator), 0, vhd_file_offset))
+        else:
+            parent_locator = ''
+            parent_locator_space = SECTOR_SIZE
+        metadata.append(parent_locator + '\0' * (parent_locator_space - len(parent_locator)))
+        vhd_file_offset += parent_locator_space
+
+    return (vhd_footer.pack(), vhd_dynamic_disk_header, vhd_bat, ''.join(metadata))
+
+def nbd_recv(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise socket.error("Connection closed by server")
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
 
 def nbd_close_channel(sock, handle):
     INFO("NBD: Going to send disconnect request with handle %d" % handle)
@@ -453,12 +310,14 @@ def nbd_open_channel(uri):
         ERROR("NBD: Unsupported protocol '%s'" % proto)
         sys.exit(3)
 
-    # Create a TCP/IP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    re_result = re.match("\[?(.+?)\]?:(\d+)$", server)
+    if re_result:
+        server = re_result.group(1)
+        port = int(re_result.group(2))
 
-    # Connect the socket to the port on server
+    # Connect a TCP/IP socket to the port on server
     INFO("NBD: Going to connect to server %s port %s" % (server, port))
-    sock.connect((server, port))
+    sock = socket.create_connection((server, port))
 
     DEBUG("NBD: Going to send HTTP PUT request")
 
@@ -483,7 +342,13 @@ def nbd_open_channel(uri):
         else:
             DEBUG("NBD: Socket isn't ready for reading")
 
-    reply = sock.recv(102)
+    # up to the end of the headers only, the negotiation follows them
+    reply = ''
+    while not reply.endswith("\r\n\r\n"):
+        chunk = sock.recv(1)
+        if not chunk:
+            break
+        reply += chunk
     DEBUG("NBD: Reply has been received")
     #eprint(reply)
 
@@ -512,7 +377,7 @@ def nbd_negotiate(sock):
         else:
             DEBUG("NBD: Socket isn't ready for reading")
 
-    reply = sock.recv(NBD_NEGOTIATION_SIZE+1)
+    reply = nbd_recv(sock, NBD_NEGOTIATION_SIZE)
     negotiate_reply = unpack(NBD_NEGOTIATION_FORMAT, reply)
     DEBUG("NBD: Negotiation reply size = %d" % len(reply))
     DEBUG("NBD: Size = %d" % negotiate_reply[_nbd_negotiation_export_size_])
@@ -535,65 +400,384 @@ def nbd_negotiate(sock):
 
     return (negotiate_reply[_nbd_negotiation_export_size_], negotiate_reply[_nbd_negotiation_transmission_flags_])
 
-def nbd_send_write(sock, handle, request_handles, offset, length, data):
-    INFO("NBD: Going to send write data request(s) with handle %d" % handle)
-    DEBUG("NBD: Length from rbd = %d, length of data to send = %d" % (length, len(data)))
-    flags = 0
-    buffer_offset = 0
-    while length > 0:
-        DEBUG("NBD: Going to send request with handle = %d" % handle)
-        if length >= NBD_CHUNK_SIZE:
-            _buffer_ = data[buffer_offset:buffer_offset+NBD_CHUNK_SIZE]
-            request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE, handle, offset+buffer_offset, NBD_CHUNK_SIZE)
-            DEBUG("NBD: buffer_offset = %d, offset = %d, length = %d, calculated length of data to send = %d,length of _buffer_ %d" % (buffer_offset, offset, length, NBD_CHUNK_SIZE, len(_buffer_)))
-        else:
-            _buffer_ = data[buffer_offset:]
-            request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE, handle, offset+buffer_offset, length)
-            DEBUG("NBD: buffer_offset = %d, offset = %d, length = %d, calculated length of data to send = %d,length of _buffer_ %d" % (buffer_offset, offset, length, length, len(_buffer_)))
-
-        DEBUG("NBD: Request header: %s" % hexdump(request_header))
-        while True:
-            ready = select.select([],[sock],[])
-            if ready[1]:
-                DEBUG("NBD: Socket ready for writing request header")
-                break
-            else:
-                DEBUG("NBD: Socket isn't ready for writing request header")
-        sock.sendall(request_header)
-
-        INFO("NBD: Going to send body for request with handle %d" % handle)
-        while True:
-            ready = select.select([],[sock],[])
-            if ready[1]:
-                DEBUG("NBD: Socket ready for writing body")
-                break
-            else:
-                DEBUG("NBD: Socket isn't ready for writing body")
-        sock.sendall(_buffer_)
-        INFO("NBD: Write data request with handle %d has been sent" % handle)
-
-        buffer_offset += NBD_CHUNK_SIZE
-        length -= NBD_CHUNK_SIZE
-        request_handles[handle] = True
-        handle += 1
-
-    return (handle, request_handles)
+def nbd_connect(uri):
+    (sock, encoding) = nbd_open_channel(uri)
+    if (encoding != 'nbd'):
+        ERROR("NBD: Unsupported encoding `%s`" % encoding)
+        nbd_close_channel(sock, 0)
+        sys.exit(5)
+    else:
+        INFO("NBD: Encoding: `%s`" % encoding)
+    (nbd_size, nbd_trans_flags) = nbd_negotiate(sock)
+    return (sock, nbd_size, nbd_trans_flags)
+
+class NBDError(Exception):
+    pass
+
+class NBDClient(object):
+    """
+    Pipelined NBD writer over a negotiated channel: requests are sent by the caller
+    while a reply thread retires them, with at most `window` of them in flight.
+    Replies are checked against the handles in flight, and failed requests are kept
+    in `errors` as (handle, command, offset, length, error).
+    """
+
+    def __init__(self, sock, trans_flags, window=NBD_WINDOW, chunk_size=NBD_CHUNK_SIZE):
+        self.sock = sock
+        self.trans_flags = trans_flags
+        self.window = window
+        self.chunk_size = chunk_size
+        self.handle = 10
+        self.inflight = {}
+        self.errors = []
+        self.failure = None
+        self.closing = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._receive_replies)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _receive_replies(self):
+        INFO("NBD: Replies reciver thread has been started")
+        try:
+            while True:
+                with self.cond:
+                    while not self.inflight and not self.closing:
+                        self.cond.wait()
+                    if not self.inflight:
+                        break
+                reply = unpack(NBD_REPLY_HEADER_FORMAT, nbd_recv(self.sock, NBD_REPLY_HEADER_SIZE))
+                if reply[_nbd_reply_magic_] != NBD_REPLY_MAGIC:
+                    raise NBDError("Bad magic 0x%08x in received reply" % reply[_nbd_reply_magic_])
+                handle = reply[_nbd_reply_handle_]
+                error = reply[_nbd_reply_error_]
+                with self.cond:
+                    if handle not in self.inflight:
+                        raise NBDError("Received reply for unknown handle %d" % handle)
+                    (cmd, offset, length) = self.inflight.pop(handle)
+                    if error:
+                        ERROR("NBD: Request with handle %d (command %d, offset %d, length %d) failed: %s" % (handle, cmd, offset, length, os.strerror(error)))
+                        self.errors.append((handle, cmd, offset, length, error))
+                    else:
+                        DEBUG("NBD: Recived reply for handle %d" % handle)
+                    self.cond.notify_all()
+        except (socket.error, NBDError), e:
+            ERROR("NBD: %s" % e)
+            with self.cond:
+                self.failure = e
+                self.cond.notify_all()
+        INFO("NBD: Replies reciver thread has been finished")
 
-def nbd_send_write_zeros(sock, handle, offset, length):
-    INFO("NBD: Going to send write zeros request with handle %d" % handle)
-    flags = 0
-    request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE_ZEROES, handle, offset, length)
-    DEBUG("NBD: Request header: %s" % hexdump(request_header))
-    while True:
-        ready = select.select([],[sock],[])
-        if ready[1]:
-            DEBUG("NBD: Socket ready for writing request header")
-            break
+    def _send(self, cmd, offset, length, payload=None):
+        with self.cond:
+            while len(self.inflight) >= self.window and self.failure is None:
+                self.cond.wait()
+            if self.failure is not None:
+                raise NBDError("Replies receiving has failed: %s" % self.failure)
+            handle = self.handle
+            self.handle += 1
+            # registered before sending, the reply may come back before sendall returns
+            self.inflight[handle] = (cmd, offset, length)
+            self.cond.notify_all()
+        request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, 0, cmd, handle, offset, length)
+        DEBUG("NBD: Request with handle %d: command %d, offset %d, length %d" % (handle, cmd, offset, length))
+        if payload is None:
+            self.sock.sendall(request_header)
+        elif len(payload) <= NBD_COPY_SIZE:
+            self.sock.sendall(request_header + payload.tobytes())
+        else:
+            self.sock.sendall(request_header)
+            self.sock.sendall(payload)
+
+    def write(self, offset, data):
+        """Write data at offset, in requests of at most chunk_size"""
+        data = memoryview(data)
+        for data_offset in xrange(0, len(data), self.chunk_size):
+            chunk = data[data_offset:data_offset+self.chunk_size]
+            self._send(NBD_CMD_WRITE, offset+data_offset, len(chunk), chunk)
+
+    def write_zeroes(self, offset, length):
+        """Zero length bytes at offset, without NBD_CMD_FLAG_NO_HOLE so that the server may punch a hole"""
+        if self.trans_flags & NBD_FLAG_SEND_WRITE_ZEROES:
+            for zeroes_offset in xrange(0, length, NBD_ZEROES_CHUNK_SIZE):
+                self._send(NBD_CMD_WRITE_ZEROES, offset+zeroes_offset, min(length-zeroes_offset, NBD_ZEROES_CHUNK_SIZE))
         else:
-            DEBUG("NBD: Socket isn't ready for writing request header")
+            zero_page = gen_zero_page(self.chunk_size)
+            for zeroes_offset in xrange(0, length, self.chunk_size):
+                chunk_length = min(length-zeroes_offset, self.chunk_size)
+                self._send(NBD_CMD_WRITE, offset+zeroes_offset, chunk_length, zero_page[:chunk_length])
+
+    def flush(self):
+        """Wait for the replies of all requests in flight"""
+        with self.cond:
+            while self.inflight and self.failure is None:
+                self.cond.wait()
+            if self.failure is not None:
+                raise NBDError("Replies receiving has failed: %s" % self.failure)
+
+    def close(self):
+        try:
+            self.flush()
+            with self.cond:
+                self.closing = True
+                self.cond.notify_all()
+            self.thread.join()
+        finally:
+            self.abort()
+
+    def abort(self):
+        nbd_close_channel(self.sock, self.handle)
+
+class NBDMultiClient(object):
+    """
+    NBDClients over several connections to the same export, which the server allows
+    with NBD_FLAG_CAN_MULTI_CONN. Requests go to the connections by offset, in slices
+    of NBD_SHARD_SIZE, so that each of them carries its share of a sequential diff.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.shard_size = max([NBD_SHARD_SIZE] + [client.chunk_size for client in clients])
+
+    def _shards(self, offset, length):
+        end = offset + length
+        while offset < end:
+            shard = offset//self.shard_size
+            shard_end = min(end, (shard + 1)*self.shard_size)
+            yield (self.clients[shard % len(self.clients)], offset, shard_end - offset)
+            offset = shard_end
+
+    def write(self, offset, data):
+        data = memoryview(data)
+        for (client, shard_offset, shard_length) in self._shards(offset, len(data)):
+            data_offset = shard_offset - offset
+            client.write(shard_offset, data[data_offset:data_offset+shard_length])
+
+    def write_zeroes(self, offset, length):
+        # no data to spread, records of a diff don't overlap so any connection will do
+        self.clients[(offset//self.shard_size) % len(self.clients)].write_zeroes(offset, length)
+
+    @property
+    def errors(self):
+        return [error for client in self.clients for error in client.errors]
+
+    def close(self):
+        failure = None
+        for client in self.clients:
+            try:
+                client.close()
+            except (socket.error, NBDError), e:
+                failure = failure or e
+        if failure is not None:
+            raise failure
+
+    def abort(self):
+        for client in self.clients:
+            client.abort()
+
+class NBDCoalescer(object):
+    """
+    Merges the records of a diff into requests of up to max_size before passing them
+    on to nbd: data records following each other, zero records likewise, and zero
+    records of up to NBD_INLINE_ZEROES_SIZE as zero data between data records. Records
+    apart from each other are never merged, what lies between them is left as it is.
+    """
+
+    def __init__(self, nbd, max_size):
+        self.nbd = nbd
+        self.max_size = max_size
+        self.offset = 0
+        self.length = 0
+        # data of the pending request, or None for a zeroes one
+        self.data = None
+
+    def _end(self, offset):
+        return self.length > 0 and self.offset + self.length == offset
+
+    def write(self, offset, data):
+        length = len(data)
+        if self.data is None and self._end(offset) and self.length <= NBD_INLINE_ZEROES_SIZE:
+            self.data = ['\0'*self.length]
+        if not (self.data is not None and self._end(offset) and self.length + length <= self.max_size):
+            self.flush()
+            if length >= self.max_size:
+                self.nbd.write(offset, data)
+                return
+            self.offset = offset
+            self.data = []
+        # data may be a slice of a buffer which is reused as soon as this returns
+        self.data.append(data.tobytes() if isinstance(data, memoryview) else data)
+        self.length += length
+
+    def write_zeroes(self, offset, length):
+        if self.data is not None and self._end(offset) and \
+           length <= NBD_INLINE_ZEROES_SIZE and self.length + length <= self.max_size:
+            self.data.append('\0'*length)
+        elif not (self.data is None and self._end(offset)):
+            self.flush()
+            self.offset = offset
+        self.length += length
+
+    def flush(self):
+        if self.length == 0:
+            return
+        if self.data is None:
+            self.nbd.write_zeroes(self.offset, self.length)
+        elif len(self.data) == 1:
+            self.nbd.write(self.offset, self.data[0])
+        else:
+            self.nbd.write(self.offset, ''.join(self.data))
+        self.length = 0
+        self.data = None
 
-    sock.sendall(request_header)
-    INFO("NBD: Wrire zeros request with handle %d has been sent" % handle)
+    @property
+    def errors(self):
+        return self.nbd.errors
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.nbd.close()
+
+    def abort(self):
+        self.nbd.abort()
+
+class VHDWriter(object):
+    """
+    Writes slices of a vhd at their offsets from `threads` threads, each with its own
+    descriptor of path, so that the caller goes on parsing while they write. Data is
+    read into buffers taken with get_buffer, which come back once written; the first
+    write error is raised by the next call.
+    """
+
+    def __init__(self, path, threads=VHD_WRITER_THREADS, buffers=VHD_WRITER_BUFFERS, buffer_size=VHD_DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self.jobs = []
+        self.buffers = [memoryview(bytearray(buffer_size)) for _ in range(buffers)]
+        self.failure = None
+        self.closing = False
+        self.cond = threading.Condition()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._write_jobs, args=(os.open(path, os.O_WRONLY),))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _write_jobs(self, fd):
+        try:
+            while True:
+                with self.cond:
+                    while not self.jobs and not self.closing:
+                        self.cond.wait()
+                    if not self.jobs:
+                        break
+                    (offset, data, buffer) = self.jobs.pop(0)
+                    failed = self.failure is not None
+                failure = None
+                try:
+                    if not failed:
+                        pwrite(fd, data, offset)
+                except Exception, e:
+                    # the thread goes on giving buffers back, so that get_buffer can't wait forever
+                    ERROR("VHD: Write of %d bytes at offset 0x%08x failed: %s" % (len(data), offset, e))
+                    failure = e
+                with self.cond:
+                    if failure is not None and self.failure is None:
+                        self.failure = failure
+                    if buffer is not None:
+                        self.buffers.append(buffer)
+                    self.cond.notify_all()
+        finally:
+            os.close(fd)
+
+    def _check(self):
+        if self.failure is not None:
+            raise self.failure
+
+    def get_buffer(self):
+        with self.cond:
+            while not self.buffers and self.failure is None:
+                self.cond.wait()
+            self._check()
+            return self.buffers.pop()
+
+    def write(self, offset, data, buffer=None):
+        """Write data at offset, then give buffer back to the pool"""
+        with self.cond:
+            self._check()
+            self.jobs.append((offset, data, buffer))
+            self.cond.notify()
+
+    def close(self):
+        """Wait for the writes queued and stop the threads"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self._check()
+
+class VHDBlockMap(object):
+    """
+    Sector bitmaps of the blocks written by an rbd diff, known before its data is read
+    so that the vhd can be written forward only. Extents come from a pre-scan of the
+    diff or from the output of `rbd diff --format json`. Bitmaps of full blocks, the
+    most common ones, are one shared string.
+    """
+
+    def __init__(self, block_size=VHD_DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.bitmap_size = vhdfile.get_size_aligned_to_sector_boundary(block_size/SECTOR_SIZE/8)
+        full_bitmap = vhdfile.gen_empty_bitmap(self.bitmap_size)
+        vhdfile.set_bitmap_range(full_bitmap, 0, block_size/SECTOR_SIZE)
+        self.full_bitmap = str(full_bitmap)
+        self.bitmaps = {}
+
+    def add(self, offset, length):
+        """Mark the sectors of an extent of data or zeroes"""
+        while length > 0:
+            block = offset // self.block_size
+            offset_in_block = offset % self.block_size
+            extent_length = min(length, self.block_size - offset_in_block)
+            bitmap = self.bitmaps.get(block)
+            if bitmap is not self.full_bitmap:
+                if bitmap is None:
+                    bitmap = self.bitmaps[block] = vhdfile.gen_empty_bitmap(self.bitmap_size)
+                vhdfile.set_bitmap_range(bitmap, offset_in_block/SECTOR_SIZE, extent_length/SECTOR_SIZE)
+                if offset_in_block + extent_length == self.block_size and bitmap == self.full_bitmap:
+                    self.bitmaps[block] = self.full_bitmap
+            offset += extent_length
+            length -= extent_length
+
+    def blocks(self):
+        return sorted(self.bitmaps)
+
+    def bitmap(self, block):
+        return str(self.bitmaps[block])
+
+def load_vhd_block_map(path):
+    """VHDBlockMap of the extents listed by `rbd diff --format json`"""
+    block_map = VHDBlockMap()
+    try:
+        with open(path) as f:
+            extents = json.load(f, object_hook=lambda extent: (int(extent['offset']), int(extent['length'])))
+        for (offset, length) in extents:
+            block_map.add(offset, length)
+    except (IOError, ValueError, KeyError, TypeError), e:
+        # e.g. left empty by a failed rbd diff
+        raise rbddiff.DiffError("Can't read the map of the diff from %s: %s" % (path, e))
+    return block_map
+
+def scan_vhd_block_map(fh):
+    """VHDBlockMap of the diff in the seekable fh, which is rewound afterwards"""
+    block_map = VHDBlockMap()
+    for record in rbddiff.Reader(fh):
+        if isinstance(record, (rbddiff.Data, rbddiff.Zero)):
+            block_map.add(record.offset, record.length)
+    fh.seek(0, 0)
+    return block_map
 
 def nbd_send_read(sock, handle, offset, length):
     INFO("NBD: Going to send read request with handle %d" % handle)
@@ -611,7 +795,7 @@ def nbd_send_read(sock, handle, offset, length):
     sock.sendall(request_header)
     INFO("NBD: Read request with handle %d has been sent" % handle)
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def rbd2nbd(rbd, uri, progress, mrout):
+def rbd2nbd(rbd, uri, progress, mrout, window=NBD_WINDOW, connections=NBD_CONNECTIONS, chunk_size=NBD_CHUNK_SIZE):
     if rbd == "-":
         RBDDIFF_FH = sys.stdin
     else:
@@ -620,41 +804,9 @@ def rbd2nbd(rbd, uri, progress, mrout):
     rbd_meta_read_finished = 0
     _prev_percent_ = 0
     _offset_ = 0
-    handle_index = 10
-    finished = False
 
-    request_handles = {}
-    #request_handles_lock = threading.Lock()
-
-    (sock, encoding) = nbd_open_channel(uri)
-    if (encoding != 'nbd'):
-        ERROR("NBD: Unsupported encoding `%s`" % encoding)
-        nbd_close_channel(sock, 0)
-        sys.exit(5)
-    else:
-        INFO("NBD: Encoding: `%s`" % encoding)
-
-    def nbd_receive_reply(sock):
-        INFO("NBD: Replies reciver thread has been started")
-        DEBUG("NBD: len(request_handles)=%d, finished=%s" % (len(request_handles), finished))
-        while (len(request_handles)>0 or (finished == False & len(request_handles)==0)):
-            while True:
-                ready = select.select([sock],[],[])
-                if ready[0]:
-                    DEBUG("NBD: Socket ready for reading")
-                    break
-                else:
-                    DEBUG("NBD: Socket isn't ready for reading")
-            reply = unpack(NBD_REPLY_HEADER_FORMAT, sock.recv(NBD_REPLY_HEADER_SIZE))
-            if reply[_nbd_reply_magic_] != NBD_REPLY_MAGIC:
-                ERROR("NBD: Bad magic in received reply")
-            INFO("NBD: Recived reply for handle %d" % reply[_nbd_reply_handle_])
-            #request_handles_lock.acquire()
-            request_handles.pop(reply[_nbd_reply_handle_])
-            #request_handles_lock.release()
-        INFO("NBD: Replies reciver thread has been finished")
-
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
+    diff = rbddiff.Reader(RBDDIFF_FH)
+    records = iter(diff)
 
     if (progress):
         if (mrout):
@@ -662,84 +814,70 @@ def rbd2nbd(rbd, uri, progress, mrout):
         else:
             eprint("Progress: 0")
 
-    (nbd_size, nbd_trans_flags) = nbd_negotiate(sock)
-
-    DEBUG("NBD: Prepare replies reciver thread")
-    t = threading.Thread(target=nbd_receive_reply, args=(sock,))
-    t.start()
+    (sock, nbd_size, nbd_trans_flags) = nbd_connect(uri)
+    # the oldstyle negotiation advertises no block size limits, only the export size
+    chunk_size = min(chunk_size, NBD_MAX_CHUNK_SIZE, nbd_size)
+    chunk_size = max(SECTOR_SIZE, chunk_size - chunk_size%SECTOR_SIZE)
+    clients = [NBDClient(sock, nbd_trans_flags, window, chunk_size)]
+    if not (nbd_trans_flags & NBD_FLAG_CAN_MULTI_CONN):
+        connections = 1
+    INFO("NBD: Using %d connection(s), requests of up to %d bytes" % (connections, chunk_size))
+    while len(clients) < connections:
+        (sock, size, trans_flags) = nbd_connect(uri)
+        clients.append(NBDClient(sock, trans_flags, window, chunk_size))
+    nbd = NBDCoalescer(NBDMultiClient(clients), chunk_size)
+    read_buffer = bytearray(chunk_size)
 
     DEBUG("RBD: Start RBD diff reading")
 
     while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
+        record = next(records, None)
+        if record is None:
             INFO("RBD: Unexpected EOF")
             break
         else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
+            INFO("RBD: Record %s" % (record,))
+            if isinstance(record, rbddiff.End):
                 INFO("RBD: Got EOF record TAG")
                 break
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
+            if isinstance(record, rbddiff.FromSnap):
+                from_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
+            elif isinstance(record, rbddiff.ToSnap):
+                to_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
+            elif isinstance(record, rbddiff.Size):
+                image_size = record.size
                 INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Data):
+                record_tag = "w"
+                (offset, length) = record
                 INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Zero):
+                record_tag = "z"
+                (offset, length) = record
                 INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
-            else:
-                ERROR("RBD: Error while reading rbd_diff file")
-                nbd_close_channel(sock, 0)
-                sys.exit(2)
 
             if (rbd_meta_read_finished == 1):
-                #request_handles_lock.acquire()
-
-                if record_tag == "w":
-                    _buffer_ = RBDDIFF_FH.read(length)
-                    (handle_index, request_handles) = nbd_send_write(sock, handle_index, request_handles, offset, length, _buffer_)
-                elif record_tag == "z":
-                    if (nbd_trans_flags & NBD_FLAG_SEND_WRITE_ZEROES):
-                        nbd_send_write_zeros(sock, handle_index, offset, length)
-                    else:
-                        _buffer_ = pack("!%ds" % length, '')
-                        (handle_index, request_handles) = nbd_send_write(sock, handle_index, request_handles, offset, length, _buffer_)
+                try:
+                    if record_tag == "w":
+                        chunk_offset = offset
+                        for _buffer_ in diff.read_chunks(read_buffer):
+                            nbd.write(chunk_offset, _buffer_)
+                            chunk_offset += len(_buffer_)
+                    elif record_tag == "z":
+                        nbd.write_zeroes(offset, length)
+                except (socket.error, NBDError), e:
+                    ERROR("NBD: Error while sending requests: %s" % e)
+                    nbd.abort()
+                    sys.exit(8)
 
-                #request_handles_lock.release()
                 _offset_ = offset + length
 
-                #time.sleep(0.05)
-
                 if (progress):
                     _percent_ = (100*_offset_)//image_size
                     if _prev_percent_ != _percent_ :
@@ -749,8 +887,15 @@ def rbd2nbd(rbd, uri, progress, mrout):
                         else:
                             eprint("Progress: %d" % _percent_)
 
-    finished = True
-    t.join()
+    try:
+        nbd.close()
+    except (socket.error, NBDError), e:
+        ERROR("NBD: Error while waiting for replies: %s" % e)
+        sys.exit(8)
+
+    if nbd.errors:
+        ERROR("NBD: %d request(s) failed" % len(nbd.errors))
+        sys.exit(9)
 
     if (progress):
         if (mrout):
@@ -762,13 +907,14 @@ def rbd2nbd(rbd, uri, progress, mrout):
     if RBDDIFF_FH is not sys.stdin:
         RBDDIFF_FH.close
 
-    nbd_close_channel(sock, handle_index)
-
     return 0
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
 def rbd2raw(rbd, raw, progress, mrout):
     RAW_FH = open(raw, "wb")
+    # a regular file is emptied by open, zero records are left as holes in it
+    sparse = stat.S_ISREG(os.fstat(RAW_FH.fileno()).st_mode)
+    read_buffer = bytearray(RBD_READ_CHUNK_SIZE)
     if rbd == "-":
         RBDDIFF_FH = sys.stdin
     else:
@@ -778,7 +924,8 @@ def rbd2raw(rbd, raw, progress, mrout):
     _prev_percent_ = 0
     _offset_ = 0
 
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
+    diff = rbddiff.Reader(RBDDIFF_FH)
+    records = iter(diff)
 
     if (progress):
         if (mrout):
@@ -787,71 +934,47 @@ def rbd2raw(rbd, raw, progress, mrout):
             eprint("Progress: 0")
 
     while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
+        record = next(records, None)
+        if record is None:
             INFO("RBD: Unexpected EOF")
             break
         else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
+            INFO("RBD: Record %s" % (record,))
+            if isinstance(record, rbddiff.End):
                 INFO("RBD: Got EOF record TAG")
                 break
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
+            if isinstance(record, rbddiff.FromSnap):
+                from_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
+            elif isinstance(record, rbddiff.ToSnap):
+                to_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
+            elif isinstance(record, rbddiff.Size):
+                image_size = record.size
                 INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Data):
+                record_tag = "w"
+                (offset, length) = record
                 INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Zero):
+                record_tag = "z"
+                (offset, length) = record
                 INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
-            else:
-                ERROR("RBD: Error while reading rbd_diff file")
-                sys.exit(2)
 
             if (rbd_meta_read_finished == 1):
 
                 if record_tag == "w":
-                    _buffer_ = RBDDIFF_FH.read(length)
-                elif record_tag == "z":
-                    _buffer_ = pack("!%ds" % length, '')
-
-                if (_offset_ == 0):
-                    RAW_FH.seek(offset,1)
-                    _offset_ = offset + length
-                    RAW_FH.write(_buffer_)
-                else:
-                    RAW_FH.seek(offset-_offset_,1)
-                    _offset_ = offset + length
-                    RAW_FH.write(_buffer_)
+                    RAW_FH.seek(offset)
+                    for _buffer_ in diff.read_chunks(read_buffer):
+                        RAW_FH.write(_buffer_)
+                elif not sparse:
+                    RAW_FH.seek(offset)
+                    write_zeroes(RAW_FH, length)
+                _offset_ = offset + length
 
                 if (progress):
                     _percent_ = (100*_offset_)//image_size
@@ -869,187 +992,102 @@ def rbd2raw(rbd, raw, progress, mrout):
         else:
             eprint("Progress: 100")
 
+    if sparse:
+        RAW_FH.truncate(image_size)
     RAW_FH.close
     if RBDDIFF_FH is not sys.stdin:
         RBDDIFF_FH.close
 
     return 0
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
+def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout, threads=VHD_WRITER_THREADS, rbd_map=''):
 
     VHD_FH = open(vhd, "wb")
+    vhd_mode = os.fstat(VHD_FH.fileno()).st_mode
+    if not (stat.S_ISREG(vhd_mode) or stat.S_ISBLK(vhd_mode)):
+        return rbd2vhd_stream(rbd, VHD_FH, rbd_image_uuid, progress, mrout, rbd_map)
+    # blocks of a regular file can be written out of order, so by writer threads
+    vhd_regular_file = stat.S_ISREG(vhd_mode)
+    writer = None
+    block_in_progress = None
+    # data of the block in progress, assembled in a buffer of the writer from
+    # block_data_start to block_data_end
+    block_buffer = None
+    block_data_start = 0
+    block_data_end = 0
     if rbd == "-":
         RBDDIFF_FH = sys.stdin
     else:
         RBDDIFF_FH = open(rbd, "rb")
 
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
+    diff = rbddiff.Reader(RBDDIFF_FH)
+    records = iter(diff)
 
     rbd_meta_read_finished = 0
     vhd_headers_written = 0
     blocks_bitmaps = {}
     from_snap_name = ''
     to_snap_name = ''
-    parent_exists = False
     rbd_eof = False
     rbd_data_exists = False
     allocated_block_count=0
     last_written_sector_in_block = 0
     _prev_percent_ = 0
+    # a record is read and written by block, so no slice of it is larger than a block
+    read_buffer = memoryview(bytearray(VHD_DEFAULT_BLOCK_SIZE))
+    zero_page = gen_zero_page(VHD_DEFAULT_BLOCK_SIZE)
 
     while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
+        record = next(records, None)
+        if record is None:
             INFO("RBD: Unexpected EOF")
             break
         else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
+            INFO("RBD: Record %s" % (record,))
+            if isinstance(record, rbddiff.End):
                 INFO("RBD: Got EOF record TAG")
                 rbd_eof = True
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
+            if isinstance(record, rbddiff.FromSnap):
+                from_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
+            elif isinstance(record, rbddiff.ToSnap):
+                to_snap_name = _snapshot_prefix_.sub('', record.name)
                 INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
+            elif isinstance(record, rbddiff.Size):
+                image_size = record.size
                 INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Data):
+                record_tag = "w"
+                (offset, length) = record
                 INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
                 rbd_data_exists = True
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
+            elif isinstance(record, rbddiff.Zero):
+                record_tag = "z"
+                (offset, length) = record
                 INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
                 if rbd_meta_read_finished == 0:
                     rbd_meta_read_finished = 1
                 rbd_data_exists = True
-            elif (rbd_eof == False):
-                ERROR("RBD: Error while reading rbd_diff file")
-                sys.exit(2)
 
             if (rbd_meta_read_finished == 1) & (vhd_headers_written == 0):
                 if rbd_image_uuid == '':
                     ERROR("RBD: RBD image UUID is not specified")
                     sys.exit(1)
-                if from_snap_name:
-                        parent_uuid = uuid.UUID(from_snap_name)
-                        parent_exists = True
-                else:
-                        parent_uuid = uuid.UUID('00000000-0000-0000-0000-000000000000')
-                        parent_exists = False
-                if to_snap_name:
-                    vhd_uuid = uuid.UUID(to_snap_name)
-                    rbd_uuid = uuid.UUID(rbd_image_uuid)
-                else:
-                    vhd_uuid = uuid.UUID(rbd_image_uuid)
-                    rbd_uuid = uuid.UUID(rbd_image_uuid)
-
-                if parent_exists:
-                    vhd_footer_struct = gen_vhd_footer_struct(VHD_DIFF_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
-                else:
-                    vhd_footer_struct = gen_vhd_footer_struct(VHD_DYNAMIC_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
-                VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
-                vhd_footer_struct = modTupleByIndex(vhd_footer_struct, _vhd_footter_checksum_, checksum(VHD_FOOTER))
-                VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
-
-                if parent_exists:
-                    vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, parent_uuid.bytes, "%s.vhd" % str(parent_uuid))
-                    vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_time_stamp_, time.time()-946684800) #????
-                else:
-                    vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, '', '')
-                VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-                vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, checksum(VHD_DYNAMIC_DISK_HEADER))
-                VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-
-                vhd_bat_list = gen_empty_vhd_bat(image_size)
-                VHD_BAT = pack_vhd_bat(vhd_bat_list)
-
-                vhd_file_offset = 0
+                (VHD_FOOTER, vhd_dynamic_disk_header, vhd_bat, VHD_METADATA) = gen_vhd_metadata(image_size, rbd_image_uuid, from_snap_name, to_snap_name)
+                VHD_BAT = vhdfile.pack_bat(vhd_bat)
 
                 VHD_FH.write(VHD_FOOTER)
-                vhd_file_offset += VHD_FOTTER_RECORD_SIZE
-
-                VHD_FH.write(VHD_DYNAMIC_DISK_HEADER)
-                vhd_file_offset += VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE
-
+                VHD_FH.write(vhd_dynamic_disk_header.pack())
                 VHD_FH.write(VHD_BAT)
-                vhd_file_offset += len(VHD_BAT)
-
-                VHD_BATMAP = gen_empty_batmap()
-                vhd_batmap_header_struct = gen_batmap_header(VHD_BATMAP)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_offset_, vhd_file_offset+VHD_BATMAP_HEADER_SIZE)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_size_, len(VHD_BATMAP)/SECTOR_SIZE)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_checksum_, checksum(VHD_BATMAP))
-                VHD_BATMAP_HEADER = pack(VHD_BATMAP_HEADER_FORMAT, *vhd_batmap_header_struct)
-
-                VHD_FH.write(VHD_BATMAP_HEADER)
-                vhd_file_offset += VHD_BATMAP_HEADER_SIZE
-
-                VHD_FH.write(VHD_BATMAP)
-                vhd_file_offset += len(VHD_BATMAP)
-
-                for index in range(VHD_PARENT_LOCATORS_COUNT):
-                    if parent_exists:
-                        if index == 0:
-                            parent_locator = "file://./%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator
-                            parent_locator_entry_struct = (_platform_code_MacX_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #MacX
-                        elif index == 1:
-                            parent_locator = ".\%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator.encode("UTF-16LE")
-                            parent_locator_entry_struct = (_platform_code_W2ku_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ku
-                        elif index == 2:
-                            parent_locator = ".\%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator.encode("UTF-16LE")
-                            parent_locator_entry_struct = (_platform_code_W2ru_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ru
-                        else:
-                            parent_locator_encoded = ''
-                            parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
-                    else:
-                        parent_locator_encoded = ''
-                        parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
-
-                    if len(parent_locator_encoded) > 0:
-                        parent_locator_packed = pack("!%ds" % get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), parent_locator_encoded)
-                    else:
-                        parent_locator_packed = pack("!%ds" % SECTOR_SIZE, parent_locator_encoded)
-
-                    parent_locator_entry = pack(VHD_PARENT_LOCATOR_ENTRY_FORMAT, *parent_locator_entry_struct)
-                    vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_locator_entry_1_ + index, parent_locator_entry)
-
-                    VHD_FH.write(parent_locator_packed)
-                    vhd_file_offset += len(parent_locator_packed)
-
-                #print_vhd_footer(vhd_footer_struct)
-                #print_dynamic_disk_header(dynamic_disk_header_struct)
+                VHD_FH.write(VHD_METADATA)
+                vhd_file_offset = vhdfile.FOOTER_SIZE + vhdfile.DYNAMIC_DISK_HEADER_SIZE + len(VHD_BAT) + len(VHD_METADATA)
 
                 vhd_headers_written = 1
-                block_bitmap_size = get_bitmap_size(vhd_dynamic_disk_header_struct)
+                block_bitmap_size = vhdfile.get_bitmap_size(VHD_DEFAULT_BLOCK_SIZE)
                 data_offset = vhd_file_offset
 
                 if (rbd_eof == True):
@@ -1058,6 +1096,11 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
                 DEBUG("VHD: Begining of data - offset 0x%08x" % data_offset)
                 DEBUG("VHD: Begining of data - real offset 0x%08x" % VHD_FH.tell())
 
+                if vhd_regular_file and threads > 0:
+                    INFO("VHD: Write data blocks with %d threads" % threads)
+                    VHD_FH.flush()
+                    writer = VHDWriter(vhd, threads)
+
             if (rbd_meta_read_finished == 1) & (vhd_headers_written == 1) & (rbd_eof == False):
                 _offset_ = offset
                 _total_blocks_ = image_size / VHD_DEFAULT_BLOCK_SIZE
@@ -1067,67 +1110,79 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
                     BlockNumber = RawSectorNumber // (VHD_DEFAULT_BLOCK_SIZE//SECTOR_SIZE)
                     SectorInBlock = RawSectorNumber % SectorsPerBlock
 
-                    if vhd_bat_list[BlockNumber] == 0xffffffff:
-                        if last_written_sector_in_block != 0:
+                    if vhd_bat[BlockNumber] == vhdfile.BAT_ENTRY_UNUSED:
+                        if writer is not None:
+                            # records come by offset, the block in progress is complete
+                            if block_buffer is not None:
+                                DEBUG("VHD: Write %d bytes of block %d data" % (block_data_end - block_data_start, block_in_progress))
+                                writer.write(vhd_bat[block_in_progress]*SECTOR_SIZE + block_bitmap_size + block_data_start,
+                                             block_buffer[block_data_start:block_data_end], block_buffer)
+                                block_buffer = None
+                            if block_in_progress is not None:
+                                DEBUG("VHD: Write block %d sector bitmap" % block_in_progress)
+                                writer.write(vhd_bat[block_in_progress]*SECTOR_SIZE, str(blocks_bitmaps.pop(block_in_progress)))
+                            block_in_progress = BlockNumber
+                        elif last_written_sector_in_block != 0:
                             DEBUG("VHD: Write %d zero sectors to the end of block" % (SectorsPerBlock - SectorInBlock - read_sectors))
-                            _buffer_ = pack("!%ds" % ((SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE), '')
-                            VHD_FH.write(_buffer_)
+                            write_zeroes(VHD_FH, (SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE)
                             vhd_file_offset += (SectorsPerBlock - SectorInBlock - read_sectors)*SECTOR_SIZE
                         INFO("VHD: New block %d allocated" % BlockNumber)
                         block_offset_in_bytes = data_offset+allocated_block_count*VHD_DEFAULT_BLOCK_SIZE + block_bitmap_size*allocated_block_count
                         block_offset_in_sectors = block_offset_in_bytes / SECTOR_SIZE
-                        vhd_bat_list[BlockNumber] = block_offset_in_sectors
+                        vhd_bat[BlockNumber] = block_offset_in_sectors
                         DEBUG("VHD: New block offset in bytes 0x%08x" % block_offset_in_bytes)
                         DEBUG("VHD: New block offset in sectors %d" % block_offset_in_sectors)
                         allocated_block_count = allocated_block_count + 1
-                        DEBUG("VHD: Write %d bytes of empty sectors bitmap" % len(gen_bitmap_from_bitarray(gen_empty_bitarray_for_bitmap(block_bitmap_size))))
-                        VHD_FH.write(gen_bitmap_from_bitarray(gen_empty_bitarray_for_bitmap(block_bitmap_size)))
-                        DEBUG("VHD: Skeep %d bytes (%d sectors)" % (SectorInBlock*SECTOR_SIZE, SectorInBlock))
-                        VHD_FH.seek(SectorInBlock*SECTOR_SIZE,1)
-                        vhd_file_offset += block_bitmap_size + SectorInBlock*SECTOR_SIZE
-                        last_written_sector_in_block = 0
-
-                    if length < (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE:
+                        blocks_bitmaps[BlockNumber] = vhdfile.gen_empty_bitmap(block_bitmap_size)
+                        if writer is None:
+                            DEBUG("VHD: Write %d bytes of empty sectors bitmap" % block_bitmap_size)
+                            VHD_FH.write(blocks_bitmaps[BlockNumber])
+                            DEBUG("VHD: Skeep %d bytes (%d sectors)" % (SectorInBlock*SECTOR_SIZE, SectorInBlock))
+                            VHD_FH.seek(SectorInBlock*SECTOR_SIZE,1)
+                            vhd_file_offset += block_bitmap_size + SectorInBlock*SECTOR_SIZE
+                            last_written_sector_in_block = 0
+
+                    read_length = min(length, (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE)
+                    length = length - read_length
+
+                    if writer is not None:
+                        vhdfile.set_bitmap_range(blocks_bitmaps[BlockNumber], SectorInBlock, read_length/SECTOR_SIZE)
+                        # blocks are new to the file and read as zeroes, so zero records are only
+                        # written where they lie between data of the block
                         if record_tag == "w":
-                            _buffer_ = RBDDIFF_FH.read(length)
-                        elif record_tag == "z":
-                            _buffer_ = pack("!%ds" % length, '')
-                        read_length = length
-                        length = 0
+                            data_offset_in_block = SectorInBlock*SECTOR_SIZE
+                            if block_buffer is None:
+                                block_buffer = writer.get_buffer()
+                                block_data_start = block_data_end = data_offset_in_block
+                            INFO("RBD->VHD: Read %d bytes of data into block %d buffer" % (read_length, BlockNumber))
+                            block_buffer[block_data_end:data_offset_in_block] = zero_page[:data_offset_in_block - block_data_end]
+                            diff.read_into(block_buffer[data_offset_in_block:data_offset_in_block + read_length])
+                            block_data_end = data_offset_in_block + read_length
+                        _offset_ += read_length
                     else:
                         if record_tag == "w":
-                            _buffer_ = RBDDIFF_FH.read((SectorsPerBlock-SectorInBlock)*SECTOR_SIZE)
+                            _buffer_ = diff.read_into(read_buffer[:read_length])
                         elif record_tag == "z":
-                            _buffer_ = pack("!%ds" % ((SectorsPerBlock-SectorInBlock)*SECTOR_SIZE), '')
-                        read_length = (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE
-                        length = length - read_length
+                            _buffer_ = zero_page[:read_length]
 
-                    read_sectors = read_length/SECTOR_SIZE
+                        read_sectors = read_length/SECTOR_SIZE
 
-                    for sector_index in range(read_length/SECTOR_SIZE):
-                        if blocks_bitmaps.has_key(BlockNumber):
-                            if blocks_bitmaps[BlockNumber][SectorInBlock+sector_index] == 0:
-                                del blocks_bitmaps[BlockNumber][SectorInBlock+sector_index]
-                                blocks_bitmaps[BlockNumber].insert(SectorInBlock+sector_index, 1)
-                        else:
-                            blocks_bitmaps[BlockNumber] = gen_empty_bitarray_for_bitmap(block_bitmap_size)
-                            del blocks_bitmaps[BlockNumber][SectorInBlock+sector_index]
-                            blocks_bitmaps[BlockNumber].insert(SectorInBlock+sector_index, 1)
+                        vhdfile.set_bitmap_range(blocks_bitmaps[BlockNumber], SectorInBlock, read_sectors)
 
-                    DEBUG("VHD: SectorsPerBlock %d, SectorInBlock %d, read_sectors %d" % (SectorsPerBlock, SectorInBlock, read_sectors))
+                        DEBUG("VHD: SectorsPerBlock %d, SectorInBlock %d, read_sectors %d" % (SectorsPerBlock, SectorInBlock, read_sectors))
 
-                    if last_written_sector_in_block != 0:
-                        sectors_to_skeep = SectorInBlock - last_written_sector_in_block
-                        DEBUG("VHD: Skeep %d sectors to the next sector with data" % sectors_to_skeep)
-                        VHD_FH.seek(sectors_to_skeep*SECTOR_SIZE,1)
-                        vhd_file_offset += sectors_to_skeep*SECTOR_SIZE
+                        if last_written_sector_in_block != 0:
+                            sectors_to_skeep = SectorInBlock - last_written_sector_in_block
+                            DEBUG("VHD: Skeep %d sectors to the next sector with data" % sectors_to_skeep)
+                            VHD_FH.seek(sectors_to_skeep*SECTOR_SIZE,1)
+                            vhd_file_offset += sectors_to_skeep*SECTOR_SIZE
 
-                    INFO("RBD->VHD: Write %d bytes of data" % len(_buffer_))
-                    VHD_FH.write(_buffer_)
-                    vhd_file_offset += read_length
-                    _offset_ += read_length
+                        INFO("RBD->VHD: Write %d bytes of data" % len(_buffer_))
+                        VHD_FH.write(_buffer_)
+                        vhd_file_offset += read_length
+                        _offset_ += read_length
 
-                    last_written_sector_in_block = SectorInBlock + read_sectors
+                        last_written_sector_in_block = SectorInBlock + read_sectors
 
                     if (progress):
                         _percent_ = (100*BlockNumber)//_total_blocks_
@@ -1140,33 +1195,43 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
 
     if last_written_sector_in_block != 0:
         DEBUG("VHD: Write %d zero sectors to the end of block" % (SectorsPerBlock - SectorInBlock - read_sectors))
-        _buffer_ = pack("!%ds" % ((SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE), '')
-        VHD_FH.write(_buffer_)
+        write_zeroes(VHD_FH, (SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE)
         vhd_file_offset += (SectorsPerBlock - SectorInBlock - read_sectors)*SECTOR_SIZE
 
+    if writer is not None:
+        if block_buffer is not None:
+            DEBUG("VHD: Write %d bytes of block %d data" % (block_data_end - block_data_start, block_in_progress))
+            writer.write(vhd_bat[block_in_progress]*SECTOR_SIZE + block_bitmap_size + block_data_start,
+                         block_buffer[block_data_start:block_data_end], block_buffer)
+        if block_in_progress is not None:
+            DEBUG("VHD: Write block %d sector bitmap" % block_in_progress)
+            writer.write(vhd_bat[block_in_progress]*SECTOR_SIZE, str(blocks_bitmaps.pop(block_in_progress)))
+        writer.close()
+        INFO("VHD: Data blocks have been written")
+        # the footer follows the last block, whose unwritten sectors are a hole
+        vhd_file_offset = data_offset + allocated_block_count*(VHD_DEFAULT_BLOCK_SIZE + block_bitmap_size)
+        VHD_FH.seek(vhd_file_offset, 0)
+
     VHD_FH.write(VHD_FOOTER)
     if (rbd_data_exists == True):
-        VHD_FH.seek(VHD_FOTTER_RECORD_SIZE,0)
-        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, 0)
-        VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, checksum(VHD_DYNAMIC_DISK_HEADER))
-        VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-        VHD_FH.write(VHD_DYNAMIC_DISK_HEADER)
-        vhd_file_offset = VHD_FOTTER_RECORD_SIZE + VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE
-        VHD_BAT = pack_vhd_bat(vhd_bat_list)
+        VHD_FH.seek(vhdfile.FOOTER_SIZE,0)
+        VHD_FH.write(vhd_dynamic_disk_header.pack())
+        vhd_file_offset = vhdfile.FOOTER_SIZE + vhdfile.DYNAMIC_DISK_HEADER_SIZE
+        VHD_BAT = vhdfile.pack_bat(vhd_bat)
         VHD_FH.write(VHD_BAT)
         vhd_file_offset += len(VHD_BAT)
-        INFO("VHD: Rewrite BAT (write %d entries, %d bytes)" % (vhd_dynamic_disk_header_struct[_dynamic_disk_header_max_table_entries_], vhd_dynamic_disk_header_struct[_dynamic_disk_header_max_table_entries_]*4))
+        INFO("VHD: Rewrite BAT (write %d entries, %d bytes)" % (vhd_dynamic_disk_header.max_table_entries, vhd_dynamic_disk_header.max_table_entries*4))
 
         DEBUG("VHD: Current offset in VHD file is 0x%08x" % vhd_file_offset)
 
-        for BlockNumber in range(len(vhd_bat_list)):
-            if vhd_bat_list[BlockNumber] != 0xffffffff:
-                DEBUG("VHD: Block %d offset is 0x%08x, skeep 0x%08x bytes from last offest 0x%08x" % (BlockNumber, vhd_bat_list[BlockNumber]*SECTOR_SIZE, (vhd_bat_list[BlockNumber]*SECTOR_SIZE-vhd_file_offset), vhd_file_offset))
-                VHD_FH.seek((vhd_bat_list[BlockNumber]*SECTOR_SIZE-vhd_file_offset),1)
-                vhd_file_offset = vhd_bat_list[BlockNumber]*SECTOR_SIZE
+        for BlockNumber in range(len(vhd_bat)):
+            # the writer threads have written the bitmaps already
+            if vhd_bat[BlockNumber] != vhdfile.BAT_ENTRY_UNUSED and BlockNumber in blocks_bitmaps:
+                DEBUG("VHD: Block %d offset is 0x%08x, skeep 0x%08x bytes from last offest 0x%08x" % (BlockNumber, vhd_bat[BlockNumber]*SECTOR_SIZE, (vhd_bat[BlockNumber]*SECTOR_SIZE-vhd_file_offset), vhd_file_offset))
+                VHD_FH.seek((vhd_bat[BlockNumber]*SECTOR_SIZE-vhd_file_offset),1)
+                vhd_file_offset = vhd_bat[BlockNumber]*SECTOR_SIZE
                 INFO("VHD: Rewrite block %d sector bitmap" % BlockNumber)
-                VHD_FH.write(gen_bitmap_from_bitarray(blocks_bitmaps[BlockNumber]))
+                VHD_FH.write(blocks_bitmaps[BlockNumber])
                 vhd_file_offset += block_bitmap_size
 
     if (progress):
@@ -1182,109 +1247,211 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
 
     return 0
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def rbd2vhd_stream(rbd, VHD_FH, rbd_image_uuid, progress, mrout, rbd_map):
+    """
+    rbd2vhd to an output that can't seek back, a pipe or a socket: the BAT and the
+    sector bitmaps are known beforehand from the map of the diff, so that footer,
+    headers, then bitmap and data of each block go out in one forward pass. The map
+    is the output of `rbd diff --format json` in rbd_map, or a pre-scan of the diff
+    file, and the diff must write exactly the sectors it lists.
+    """
+
+    if rbd == "-":
+        RBDDIFF_FH = sys.stdin
+    else:
+        RBDDIFF_FH = open(rbd, "rb")
+
+    if rbd_map:
+        INFO("RBD: Load map of the diff from %s" % rbd_map)
+        block_map = load_vhd_block_map(rbd_map)
+    elif RBDDIFF_FH is not sys.stdin:
+        INFO("RBD: Scan diff for its map")
+        block_map = scan_vhd_block_map(RBDDIFF_FH)
+    else:
+        ERROR("VHD: Output can't seek, the map of a diff read from stdin is needed (--map)")
+        sys.exit(1)
+    if rbd_image_uuid == '':
+        ERROR("RBD: RBD image UUID is not specified")
+        sys.exit(1)
+
+    diff = rbddiff.Reader(RBDDIFF_FH)
+    records = iter(diff)
+
+    from_snap_name = ''
+    to_snap_name = ''
+    image_size = None
+    record = next(records, None)
+    while isinstance(record, (rbddiff.FromSnap, rbddiff.ToSnap, rbddiff.Size)):
+        INFO("RBD: Record %s" % (record,))
+        if isinstance(record, rbddiff.FromSnap):
+            from_snap_name = _snapshot_prefix_.sub('', record.name)
+        elif isinstance(record, rbddiff.ToSnap):
+            to_snap_name = _snapshot_prefix_.sub('', record.name)
+        else:
+            image_size = record.size
+        record = next(records, None)
+    if image_size is None:
+        raise rbddiff.DiffError("No image size record before data")
+
+    (VHD_FOOTER, vhd_dynamic_disk_header, vhd_bat, VHD_METADATA) = gen_vhd_metadata(image_size, rbd_image_uuid, from_snap_name, to_snap_name)
+    block_bitmap_size = vhdfile.get_bitmap_size(VHD_DEFAULT_BLOCK_SIZE)
+    data_offset = vhdfile.FOOTER_SIZE + vhdfile.DYNAMIC_DISK_HEADER_SIZE + len(vhdfile.pack_bat(vhd_bat)) + len(VHD_METADATA)
+    blocks = block_map.blocks()
+    if blocks and blocks[-1] >= len(vhd_bat):
+        raise rbddiff.DiffError("Map of the diff goes beyond image size %d" % image_size)
+    for (index, BlockNumber) in enumerate(blocks):
+        vhd_bat[BlockNumber] = (data_offset + index*(block_bitmap_size + VHD_DEFAULT_BLOCK_SIZE)) / SECTOR_SIZE
+    INFO("VHD: %d blocks allocated from the map of the diff" % len(blocks))
+
+    VHD_FH.write(VHD_FOOTER)
+    VHD_FH.write(vhd_dynamic_disk_header.pack())
+    VHD_FH.write(vhdfile.pack_bat(vhd_bat))
+    VHD_FH.write(VHD_METADATA)
+
+    # the block being written, the end of its data so far and the sectors the diff wrote to
+    block_in_progress = None
+    block_data_end = 0
+    block_bitmap = None
+    written_blocks = 0
+    read_buffer = memoryview(bytearray(VHD_DEFAULT_BLOCK_SIZE))
+    _total_blocks_ = max(len(blocks), 1)
+    _prev_percent_ = 0
+
+    def finish_block():
+        write_zeroes(VHD_FH, VHD_DEFAULT_BLOCK_SIZE - block_data_end)
+        if str(block_bitmap) != block_map.bitmap(block_in_progress):
+            raise rbddiff.DiffError("Sectors written in block %d differ from the map of the diff" % block_in_progress)
+
+    while record is not None and not isinstance(record, rbddiff.End):
+        INFO("RBD: Record %s" % (record,))
+        if isinstance(record, (rbddiff.Data, rbddiff.Zero)):
+            (offset, length) = record
+            while length > 0:
+                BlockNumber = offset // VHD_DEFAULT_BLOCK_SIZE
+                offset_in_block = offset % VHD_DEFAULT_BLOCK_SIZE
+                write_length = min(length, VHD_DEFAULT_BLOCK_SIZE - offset_in_block)
+                if BlockNumber != block_in_progress:
+                    if block_in_progress is not None:
+                        finish_block()
+                    if written_blocks >= len(blocks) or blocks[written_blocks] != BlockNumber:
+                        raise rbddiff.DiffError("Block %d at offset 0x%08x is not the next one in the map of the diff" % (BlockNumber, offset))
+                    DEBUG("VHD: Write block %d sector bitmap" % BlockNumber)
+                    VHD_FH.write(block_map.bitmap(BlockNumber))
+                    block_in_progress = BlockNumber
+                    block_data_end = 0
+                    block_bitmap = vhdfile.gen_empty_bitmap(block_bitmap_size)
+                    written_blocks += 1
+                if offset_in_block < block_data_end:
+                    raise rbddiff.DiffError("Record at offset 0x%08x overlaps the previous one" % offset)
+                write_zeroes(VHD_FH, offset_in_block - block_data_end)
+                if isinstance(record, rbddiff.Data):
+                    INFO("RBD->VHD: Write %d bytes of data" % write_length)
+                    VHD_FH.write(diff.read_into(read_buffer[:write_length]))
+                else:
+                    write_zeroes(VHD_FH, write_length)
+                vhdfile.set_bitmap_range(block_bitmap, offset_in_block/SECTOR_SIZE, write_length/SECTOR_SIZE)
+                block_data_end = offset_in_block + write_length
+                offset += write_length
+                length -= write_length
+
+                if (progress):
+                    _percent_ = (100*written_blocks)//_total_blocks_
+                    if _prev_percent_ != _percent_ :
+                        _prev_percent_ = _percent_
+                        if (mrout):
+                            MROUTPUT("Progress: %d" % _percent_)
+                        else:
+                            eprint("Progress: %d" % _percent_)
+        record = next(records, None)
+
+    if record is None:
+        INFO("RBD: Unexpected EOF")
+    if block_in_progress is not None:
+        finish_block()
+    if written_blocks != len(blocks):
+        raise rbddiff.DiffError("%d blocks of the map of the diff were not written" % (len(blocks) - written_blocks))
+    VHD_FH.write(VHD_FOOTER)
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+            MROUTPUT("")
+        else:
+            eprint("Progress: 100")
+
+    VHD_FH.close()
+    if RBDDIFF_FH is not sys.stdin:
+        RBDDIFF_FH.close()
+
+    return 0
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
 def vhd2rbd(vhd, rbd, progress, mrout):
 
     _prev_percent_ = 0
 
-    VHD_FH = open(vhd, "rb")
+    VHD = vhdfile.VHD(vhd)
+    VHD.advise_sequential()
     if rbd == "-":
         RBDDIFF_FH = sys.stdout
     else:
         RBDDIFF_FH = open(rbd, "wb")
 
-    VHD_FOOTER = unpack(VHD_FOTTER_FORMAT, VHD_FH.read(VHD_FOTTER_RECORD_SIZE))
-    DYNAMIC_DISK_HEADER = unpack(VHD_DYNAMIC_DISK_HEADER_FORMAT, VHD_FH.read(VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE))
-    BAT_TABLE = unpack("!%iI" % DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_],
-                       VHD_FH.read(DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]*4))
-    BATMAP_HEADER = unpack(VHD_BATMAP_HEADER_FORMAT, VHD_FH.read(VHD_BATMAP_HEADER_SIZE))
-
     # Write RBD diff header
     INFO("RBD: Writing RBD diff header")
     RBDDIFF_FH.write(RBD_HEADER)
 
     # Write RBD from_snap record
-    if DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_] != '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00':
+    if VHD.header.parent_unique_id != '\0'*16:
         INFO("RBD: Writing RBD from_snap record")
-        from_snap_uuid = uuid.UUID(bytes=DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_])
+        from_snap_uuid = uuid.UUID(bytes=VHD.header.parent_unique_id)
         from_snap = "%s%s" % (SNAPSHOT_PREFIX, str(from_snap_uuid))
         RBDDIFF_FH.write(pack("%s%s%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG, RBD_DIFF_META_SNAP, len(from_snap)), 'f', len(from_snap), from_snap))
 
     # Write RBD to_snap record
-    if VHD_FOOTER[_vhd_footter_unique_iq_] != VHD_FOOTER[_vhd_footter_rbd_image_uuid_]:
+    if VHD.footer.unique_id != VHD.footer.rbd_image_uuid:
         INFO("RBD: Writing RBD to_snap record")
-        to_snap_uuid = uuid.UUID(bytes=VHD_FOOTER[_vhd_footter_unique_iq_])
+        to_snap_uuid = uuid.UUID(bytes=VHD.footer.unique_id)
         to_snap = "%s%s" % (SNAPSHOT_PREFIX, str(to_snap_uuid))
         RBDDIFF_FH.write(pack("%s%s%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG, RBD_DIFF_META_SNAP, len(to_snap)), 't', len(to_snap), to_snap))
 
     # Write RBD Size record
     INFO("RBD: Writing RBD size record")
-    RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_META_SIZE, 's', VHD_FOOTER[_vhd_footter_current_size_]))
+    RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_META_SIZE, 's', VHD.footer.current_size))
 
     total_changed_sectors = 0
-    total_changed_sectors_ = 0
-    raw_first_sector = -1
-    raw_last_sector = -1
-    in_block_first_sector = -1
-    in_block_last_sector = -1
-
-    for block_index in range(DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]):
-        if BAT_TABLE[block_index] != 0xffffffff:
-            DATA_BLOCK = get_sector_bitmap_and_data(VHD_FH, BAT_TABLE[block_index], DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_])
-
-            BITMAP_SIZE = get_bitmap_size(DYNAMIC_DISK_HEADER)
-            INFO("VHD: Read VHD block %d" % block_index)
-
-            BITMAPARRAY = get_bitarray_from_bitmap(DATA_BLOCK[0], BITMAP_SIZE)
-
-            for sector_in_block_index in range(BITMAP_SIZE*8):
-                if BITMAPARRAY[sector_in_block_index] == 1:
-                    DEBUG("VHD: Read sector %d with data in block %d" % (sector_in_block_index, block_index))
-                    total_changed_sectors_ += 1
-                    if raw_first_sector == -1:
-                        raw_first_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                        in_block_first_sector = sector_in_block_index
-                        raw_last_sector = -1
-                else:
-                    if (raw_last_sector == -1) & (raw_first_sector != -1) :
-                        raw_last_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index-1, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                        in_block_last_sector = sector_in_block_index-1
-                        DEBUG("VHD: Data sectors range (raw) %d - %d" % (raw_first_sector, raw_last_sector))
-                        DEBUG("VHD: Data sectors range (in block) %d - %d" % (in_block_first_sector, in_block_last_sector))
-                        # Write RBD data record header
-                        INFO("RBD: Write RBD data record header ...")
-                        RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA, 'w', raw_first_sector*512,(raw_last_sector-raw_first_sector+1)*512))
-                        INFO("RBD: Write RBD data record data ...")
-                        for sector_index in range(in_block_first_sector, in_block_last_sector+1):
-                            DEBUG("VHD->RBD: Write sector %d from block %d" % (sector_index, block_index))
-                            total_changed_sectors += 1
-                            # Write RBD data record data
-                            RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+"512s",DATA_BLOCK[1][sector_index]))
-                        raw_first_sector = -1
-                        raw_last_sector = -1
-                        in_block_first_sector = -1
-                        in_block_last_sector = -1
-
-            if (sector_in_block_index == BITMAP_SIZE*8-1) and (raw_first_sector != -1) :
-                raw_last_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                in_block_last_sector = sector_in_block_index
-                DEBUG("VHD: Data sectors range (raw) %d - %d" % (raw_first_sector, raw_last_sector))
-                DEBUG("VHD: Data sectors range (in block) %d - %d" % (in_block_first_sector, in_block_last_sector))
-                # Write RBD data record header
-                INFO("RBD: Write RBD data record header ...")
-                RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA, 'w', raw_first_sector*512,(raw_last_sector-raw_first_sector+1)*512))
-                INFO("RBD: Write RBD data record data ...")
-                for sector_index in range(in_block_first_sector, in_block_last_sector+1):
-                    DEBUG("VHD->RBD: Write sector %d from block %d" % (sector_index, block_index))
-                    # Write RBD data record data
-                    total_changed_sectors += 1
-                    RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+"512s",DATA_BLOCK[1][sector_index]))
-                raw_first_sector = -1
-                raw_last_sector = -1
-                in_block_first_sector = -1
-                in_block_last_sector = -1
+    block_size = VHD.block_size
+    # blocks are read in the order they are in the file, so that reads go forward on disk
+    blocks = VHD.blocks_by_offset()
+
+    # data runs are merged into one record while they are contiguous
+    record_offset = 0
+    record_length = 0
+    record_data = []
+
+    def write_data_record(offset, length, data):
+        INFO("RBD: Write RBD data record offset 0x%08x, length %d" % (offset, length))
+        RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA, 'w', offset, length))
+        for _buffer_ in data:
+            RBDDIFF_FH.write(_buffer_)
+
+    for (index, block_index) in enumerate(blocks):
+        INFO("VHD: Read VHD block %d" % block_index)
+
+        for (first_sector, sectors) in VHD.sector_runs(block_index):
+            DEBUG("VHD: Data sectors range (in block %d) %d - %d" % (block_index, first_sector, first_sector+sectors-1))
+            offset = block_index*block_size + first_sector*SECTOR_SIZE
+            if (record_length > 0) and ((offset != record_offset+record_length) or (record_length >= VHD2RBD_MAX_RECORD_SIZE)):
+                write_data_record(record_offset, record_length, record_data)
+                record_length = 0
+                record_data = []
+            if record_length == 0:
+                record_offset = offset
+            record_data.append(VHD.block_data(block_index, first_sector, sectors))
+            record_length += sectors*SECTOR_SIZE
+            total_changed_sectors += sectors
 
         if (progress):
-            _percent_ = (100*block_index)//DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]
+            _percent_ = (100*index)//len(blocks)
             if _prev_percent_ != _percent_ :
                 _prev_percent_ = _percent_
                 if (mrout):
@@ -1292,6 +1459,9 @@ def vhd2rbd(vhd, rbd, progress, mrout):
                 else:
                     eprint("Progress: %d" % _percent_)
 
+    if record_length > 0:
+        write_data_record(record_offset, record_length, record_data)
+
     if (progress):
         if (mrout):
             MROUTPUT("Progress: 100")
@@ -1303,7 +1473,7 @@ def vhd2rbd(vhd, rbd, progress, mrout):
 
     RBDDIFF_FH.write('e')
 
-    VHD_FH.close
+    VHD.close()
     if RBDDIFF_FH is not sys.stdout:
         RBDDIFF_FH.close
 
@@ -1319,18 +1489,23 @@ def main(argv):
 
     if len(sys.argv) > 1:
         try:
-            opts, args = getopt.getopt(argv,"hvdpm",["vhd=","rbd=","nbd=","raw=","uuid="])
+            opts, args = getopt.getopt(argv,"hvdpm",["vhd=","rbd=","nbd=","raw=","uuid=","window=","connections=","chunk-size=","threads=","map="])
         except getopt.GetoptError:
             eprint('Usage:')
             eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [-p] [-m] [-v] [-d]')
+            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [--threads <n>] [--map <rbd_diff_json>] [-p] [-m] [-v] [-d]')
             eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [--window <requests>] [--connections <n>] [--chunk-size <bytes>] [-p] [-m] [-v] [-d]')
             sys.exit(2)
 
         vhd_file = ''
         rbd_file = ''
         vhd_uuid = ''
+        window = NBD_WINDOW
+        connections = NBD_CONNECTIONS
+        chunk_size = NBD_CHUNK_SIZE
+        threads = VHD_WRITER_THREADS
+        rbd_map = ''
         progress = False
         mrout = False
 
@@ -1338,9 +1513,9 @@ def main(argv):
             if opt == '-h':
                 eprint('Usage:')
                 eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-                eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [-p] [-m] [-v] [-d]')
+                eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [--threads <n>] [--map <rbd_diff_json>] [-p] [-m] [-v] [-d]')
                 eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-                eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+                eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [--window <requests>] [--connections <n>] [--chunk-size <bytes>] [-p] [-m] [-v] [-d]')
                 sys.exit()
             elif opt == '-v':
                 global verbose
@@ -1366,21 +1541,35 @@ def main(argv):
                 INFO("[main]: NBD destination is \'%s\'" % nbd_dest)
             elif opt == '--uuid':
                 vhd_uuid = arg
+            elif opt == '--window':
+                window = int(arg)
+            elif opt == '--connections':
+                connections = int(arg)
+            elif opt == '--chunk-size':
+                chunk_size = int(arg)
+            elif opt == '--threads':
+                threads = int(arg)
+            elif opt == '--map':
+                rbd_map = arg
 
-        if (cmdname == 'vhd2rbd'):
-            vhd2rbd(vhd_file, rbd_file, progress, mrout)
-        elif(cmdname == 'rbd2vhd'):
-            rbd2vhd(rbd_file, vhd_file, vhd_uuid, progress, mrout)
-        elif(cmdname == 'rbd2raw'):
-            rbd2raw(rbd_file, raw_file, progress, mrout)
-        elif(cmdname == 'rbd2nbd'):
-            rbd2nbd(rbd_file, nbd_dest, progress, mrout)
+        try:
+            if (cmdname == 'vhd2rbd'):
+                vhd2rbd(vhd_file, rbd_file, progress, mrout)
+            elif(cmdname == 'rbd2vhd'):
+                rbd2vhd(rbd_file, vhd_file, vhd_uuid, progress, mrout, threads, rbd_map)
+            elif(cmdname == 'rbd2raw'):
+                rbd2raw(rbd_file, raw_file, progress, mrout)
+            elif(cmdname == 'rbd2nbd'):
+                rbd2nbd(rbd_file, nbd_dest, progress, mrout, window, connections, chunk_size)
+        except rbddiff.DiffError, e:
+            ERROR("RBD: Error while reading rbd_diff file: %s" % e)
+            sys.exit(2)
     else:
             eprint('Usage:')
             eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [-p] [-m] [--uuid <vdi_uuid>] [-v] [-d]')
+            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [-p] [-m] [--uuid <vdi_uuid>] [--threads <n>] [--map <rbd_diff_json>] [-v] [-d]')
             eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [--window <requests>] [--connections <n>] [--chunk-size <bytes>] [-p] [-m] [-v] [-d]')
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmarks of rbd2vhd on synthetic rbd diff streams, not installed on hosts"""
+
+from __future__ import print_function
+from struct import pack, unpack
+import os
+import sys
+import time
+import uuid
+import socket
+import tempfile
+import threading
+import rbd2vhd
+import rbddiff
+import vhdfile
+
+
+def gen_rbd_diff(path, image_size, record_size, gap_size, to_snap=None, version=1):
+    """rbd diff with a data record of record_size bytes every record_size+gap_size bytes"""
+    with open(path, 'wb') as f:
+        def write_record(tag, record):
+            f.write(tag)
+            if version == 2:
+                f.write(pack("<Q", len(record)))
+            f.write(record)
+        f.write(rbddiff.RBD_DIFF_V2_HEADER if version == 2 else rbddiff.RBD_DIFF_V1_HEADER)
+        if to_snap:
+            write_record('t', pack("<I%ds" % len(to_snap), len(to_snap), to_snap))
+        write_record('s', pack("<Q", image_size))
+        data = os.urandom(record_size)
+        offset = 0
+        while offset + record_size <= image_size:
+            write_record('w', pack("<QQ", offset, record_size) + data)
+            offset += record_size + gap_size
+        f.write('e')
+
+
+def timed(func, *args):
+    t1 = time.time()
+    func(*args)
+    return time.time() - t1
+
+
+def legacy_set_bitmap_range(bitarray, first_sector, sectors):
+    # per sector list update of the former implementation
+    for sector_index in range(sectors):
+        if bitarray[first_sector+sector_index] == 0:
+            del bitarray[first_sector+sector_index]
+            bitarray.insert(first_sector+sector_index, 1)
+
+
+def legacy_gen_bitmap_from_bitarray(bitarray):
+    # bitmap serialization of the former implementation
+    _bytearray_ = {}
+    bitmap = ''
+    for bitarray_index in range(len(bitarray)):
+        bit = 0
+        byte_index = bitarray_index//8
+        bit_in_byte = bitarray_index%8
+        if bitarray[bitarray_index] == 1:
+            bit = 128 >> bit_in_byte
+        if _bytearray_.has_key(byte_index):
+            _bytearray_[byte_index] = _bytearray_[byte_index] | bit
+        else:
+            _bytearray_[byte_index] = bit
+    for byte_index in range(len(_bytearray_)):
+        bitmap = bitmap + pack('!c', chr(_bytearray_[byte_index]))
+    return bitmap
+
+
+def bench_bitmaps(blocks=64, record_sectors=8):
+    """Marking records of record_sectors every other record in 2 MB blocks, then serializing the bitmaps"""
+    sectors_in_block = rbd2vhd.VHD_DEFAULT_BLOCK_SIZE/rbd2vhd.SECTOR_SIZE
+    bitmap_size = sectors_in_block/8
+    starts = range(0, sectors_in_block - record_sectors + 1, record_sectors*2)
+
+    def legacy():
+        for block in range(blocks):
+            bitarray = [0]*sectors_in_block
+            for start in starts:
+                legacy_set_bitmap_range(bitarray, start, record_sectors)
+            legacy_gen_bitmap_from_bitarray(bitarray)
+
+    def current():
+        for block in range(blocks):
+            bitmap = vhdfile.gen_empty_bitmap(bitmap_size)
+            for start in starts:
+                vhdfile.set_bitmap_range(bitmap, start, record_sectors)
+            str(bitmap)
+
+    legacy_time = timed(legacy)
+    current_time = timed(current)
+    print("bitmaps: %d blocks, %d sectors records: list %.3fs, bytearray %.3fs (x%.1f)" %
+          (blocks, record_sectors, legacy_time, current_time, legacy_time/current_time))
+
+
+def legacy_checksum(vhd_record):
+    checksum = 0
+    b = bytearray()
+    b.extend(vhd_record)
+    for index in range(len(vhd_record)):
+        checksum += b[index]
+    checksum = ~checksum + 2**32
+    return checksum
+
+
+def legacy_pack_vhd_bat(bat_list):
+    bat = ''
+    for bat_index in range(len(bat_list)):
+        bat = bat + pack("!I", bat_list[bat_index])
+    return bat
+
+
+def legacy_reserved(size):
+    reserved = ''
+    for i in range(size):
+        reserved = reserved + pack('!c', chr(0))
+    return reserved
+
+
+def gen_headers(image_size):
+    vhd_uuid = uuid.uuid4().bytes
+    vhdfile.gen_footer(vhdfile.DYNAMIC_HARDDISK_TYPE, image_size, vhd_uuid, vhd_uuid, vhdfile.VHD_EPOCH).pack()
+    vhdfile.gen_dynamic_disk_header(0, image_size).pack()
+    VHD_BATMAP = '\0' * (rbd2vhd.SECTOR_SIZE*2)
+    vhdfile.gen_batmap_header(0, VHD_BATMAP).pack()
+
+
+def legacy_gen_headers(image_size):
+    # the former headers were built the same way, around byte by byte padding and checksums
+    for size in (410, 256, 483):
+        legacy_reserved(size)
+    legacy_checksum('\0' * vhdfile.FOOTER_SIZE)
+    legacy_checksum('\0' * vhdfile.DYNAMIC_DISK_HEADER_SIZE)
+    gen_headers(image_size)
+
+
+def bench_headers(max_gb=2048, repeat=100):
+    """BAT generation and checksum, and header emission, for disks from 1 GB to max_gb"""
+    size_gb = 1
+    while size_gb <= max_gb:
+        image_size = size_gb*1024*1024*1024
+        bat_list = vhdfile.gen_empty_bat(image_size/rbd2vhd.VHD_DEFAULT_BLOCK_SIZE)
+        bat = vhdfile.pack_bat(bat_list)
+        legacy = timed(legacy_pack_vhd_bat, bat_list)
+        current = timed(lambda: vhdfile.pack_bat(vhdfile.gen_empty_bat(image_size/rbd2vhd.VHD_DEFAULT_BLOCK_SIZE)))
+        print("%5d GB BAT pack:     legacy %8.4fs, current %8.4fs (x%.0f)" % (size_gb, legacy, current, legacy/current))
+        legacy = timed(legacy_checksum, bat)
+        current = timed(vhdfile.checksum, bat)
+        print("%5d GB BAT checksum: legacy %8.4fs, current %8.4fs (x%.0f)" % (size_gb, legacy, current, legacy/current))
+        legacy = timed(lambda: [legacy_gen_headers(image_size) for i in range(repeat)])
+        current = timed(lambda: [gen_headers(image_size) for i in range(repeat)])
+        print("%5d GB headers x%d:  legacy %8.4fs, current %8.4fs (x%.0f)" % (size_gb, repeat, legacy, current, legacy/current))
+        size_gb *= 8 if size_gb < 512 else 4
+
+
+def legacy_parse(path):
+    # record loop of the former converters, without its logging
+    RBDDIFF_FH = open(path, "rb")
+    RBDDIFF_FH.read(len(rbd2vhd.RBD_HEADER))
+    while True:
+        record_tag = RBDDIFF_FH.read(rbd2vhd.RBD_DIFF_META_RECORD_TAG_SIZE)
+        if not record_tag or record_tag == "e":
+            break
+        if record_tag == "f" or record_tag == "t":
+            record = RBDDIFF_FH.read(rbd2vhd.RBD_DIFF_META_SNAP_SIZE)
+            snap_name_length = int(unpack("%s%s" % (rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX, rbd2vhd.RBD_DIFF_META_SNAP), record)[0])
+            record = RBDDIFF_FH.read(snap_name_length)
+            snap_name = unpack("%s%ds" % (rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length), record)[0]
+        elif record_tag == "s":
+            record = RBDDIFF_FH.read(rbd2vhd.RBD_DIFF_META_SIZE_SIZE)
+            image_size = int(unpack("%s%s" % (rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX, rbd2vhd.RBD_DIFF_META_SIZE), record)[0])
+        elif record_tag == "w" or record_tag == "z":
+            record = RBDDIFF_FH.read(rbd2vhd.RBD_DIFF_DATA_SIZE)
+            _record_ = unpack("%s%s" % (rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX, rbd2vhd.RBD_DIFF_DATA), record)
+            offset = _record_[0]
+            length = _record_[1]
+            if record_tag == "w":
+                _buffer_ = RBDDIFF_FH.read(length)
+    RBDDIFF_FH.close()
+
+
+def parse(path):
+    with open(path, "rb") as f:
+        diff = rbddiff.Reader(f)
+        buffer = bytearray(rbd2vhd.RBD_READ_CHUNK_SIZE)
+        for record in diff:
+            if isinstance(record, rbddiff.Data):
+                for chunk in diff.read_chunks(buffer):
+                    pass
+
+
+def bench_parser(size_gb=2, record_kb=64, gap_kb=64):
+    """Parsing of size_gb of synthetic diff with record_kb records, v1 by the former loop and rbddiff, v2 by rbddiff"""
+    tmpdir = tempfile.mkdtemp()
+    rbd = os.path.join(tmpdir, 'diff.rbd')
+    image_size = size_gb*1024*1024*1024*(record_kb + gap_kb)//record_kb
+    try:
+        for version in (1, 2):
+            gen_rbd_diff(rbd, image_size, record_kb*1024, gap_kb*1024, version=version)
+            written = os.path.getsize(rbd)
+            runs = [('legacy', legacy_parse)] if version == 1 else []
+            for (name, func) in runs + [('rbddiff', parse)]:
+                delta = timed(func, rbd)
+                print("parser: v%d, %d MB of diff, %d KB records, %s: %.3fs, %.1f MB/s" %
+                      (version, written/1024/1024, record_kb, name, delta, written/delta/1024/1024))
+    finally:
+        if os.path.exists(rbd):
+            os.unlink(rbd)
+        os.rmdir(tmpdir)
+
+
+def bench_rbd2vhd(image_mb=256, record_kb=4, gap_kb=4, threads=rbd2vhd.VHD_WRITER_THREADS):
+    """rbd2vhd of a synthetic diff with record_kb records every record_kb+gap_kb, written by threads"""
+    tmpdir = tempfile.mkdtemp()
+    rbd = os.path.join(tmpdir, 'diff.rbd')
+    vhd = os.path.join(tmpdir, 'out.vhd')
+    gen_rbd_diff(rbd, image_mb*1024*1024, record_kb*1024, gap_kb*1024)
+    written = os.path.getsize(rbd)
+    try:
+        delta = timed(rbd2vhd.rbd2vhd, rbd, vhd, str(uuid.uuid4()), False, False, threads)
+        print("rbd2vhd: %d MB image, %d KB records, %d threads: %.3fs, %.1f MB/s of diff" %
+              (image_mb, record_kb, threads, delta, written/delta/1024/1024))
+    finally:
+        for path in (rbd, vhd):
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(tmpdir)
+
+
+class NBDServer(object):
+    """
+    Stand-in of the xapi nbd endpoint on localhost: answers the HTTP PUT, runs the
+    oldstyle negotiation and writes the requests of each connection to path. Each
+    connection handles its requests one after another, replying after latency seconds,
+    as a server backed by remote storage would.
+    """
+
+    def __init__(self, path, size, latency=0,
+                 flags=rbd2vhd.NBD_FLAG_HAS_FLAGS | rbd2vhd.NBD_FLAG_SEND_WRITE_ZEROES | rbd2vhd.NBD_FLAG_CAN_MULTI_CONN):
+        self.size = size
+        self.latency = latency
+        self.flags = flags
+        self.connections = 0
+        self.requests = 0
+        self.out = open(path, 'r+b')
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.uri = "http://127.0.0.1:%d/services/SM/nbd/%s/%s/%s?session_id=OpaqueRef%%3a%s" % \
+                   ((self.sock.getsockname()[1],) + tuple(uuid.uuid4() for i in range(4)))
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                (conn, address) = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        request = ''
+        while not request.endswith("\r\n\r\n"):
+            request += conn.recv(1)
+        conn.sendall("HTTP/1.1 200 OK\r\nTransfer-encoding: nbd\r\n\r\n")
+        conn.sendall(pack(rbd2vhd.NBD_NEGOTIATION_FORMAT, rbd2vhd.NBD_INIT_PASSWD, rbd2vhd.NBD_CLISERVER_MAGIC,
+                          self.size, 0, self.flags, '\0'*124))
+        while True:
+            (magic, flags, cmd, handle, offset, length) = \
+                unpack(rbd2vhd.NBD_REQUEST_HEADER_FORMAT, rbd2vhd.nbd_recv(conn, rbd2vhd.NBD_REQUEST_HEADER_SIZE))
+            if cmd == rbd2vhd.NBD_CMD_DISC:
+                break
+            self.requests += 1
+            if cmd == rbd2vhd.NBD_CMD_WRITE:
+                data = rbd2vhd.nbd_recv(conn, length)
+            else:
+                data = '\0'*length
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                self.out.seek(offset)
+                self.out.write(data)
+            conn.sendall(pack(rbd2vhd.NBD_REPLY_HEADER_FORMAT, rbd2vhd.NBD_REPLY_MAGIC, 0, handle))
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+        self.out.close()
+
+
+def bench_nbd(image_mb=256, record_kb=64, latency_ms=1, gap_kb=64, chunk_kb=rbd2vhd.NBD_CHUNK_SIZE/1024):
+    """rbd2nbd to a stand-in server with latency_ms per request, over 1 to 8 connections"""
+    tmpdir = tempfile.mkdtemp()
+    rbd = os.path.join(tmpdir, 'diff.rbd')
+    raw = os.path.join(tmpdir, 'ref.raw')
+    nbd = os.path.join(tmpdir, 'nbd.raw')
+    image_size = image_mb*1024*1024
+    gen_rbd_diff(rbd, image_size, record_kb*1024, gap_kb*1024)
+    written = image_size//((record_kb + gap_kb)*1024)*record_kb*1024
+    rbd2vhd.rbd2raw(rbd, raw, False, False)
+    with open(raw, 'rb') as f:
+        expected = f.read()
+    try:
+        connections = 1
+        while connections <= 8:
+            with open(nbd, 'wb') as f:
+                f.truncate(image_size)
+            server = NBDServer(nbd, image_size, latency_ms/1000.0)
+            delta = timed(rbd2vhd.rbd2nbd, rbd, server.uri, False, False, rbd2vhd.NBD_WINDOW, connections, chunk_kb*1024)
+            server.close()
+            with open(nbd, 'rb') as f:
+                same = f.read(len(expected)) == expected
+            print("rbd2nbd: %d MB image, %d KB records, %d KB gaps, %d ms latency, %d connection(s): "
+                  "%d requests, %.3fs, %.1f MB/s%s" %
+                  (image_mb, record_kb, gap_kb, latency_ms, server.connections, server.requests, delta,
+                   written/delta/1024/1024, '' if same else ', MISMATCH'))
+            connections *= 2
+    finally:
+        for path in (rbd, raw, nbd):
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(tmpdir)
+
+
+BENCHMARKS = {'bitmaps': bench_bitmaps,
+              'headers': bench_headers,
+              'nbd': bench_nbd,
+              'parser': bench_parser,
+              'rbd2vhd': bench_rbd2vhd}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: %s <%s> [args...]" % (sys.argv[0], '|'.join(sorted(BENCHMARKS.keys()))), file=sys.stderr)
+        sys.exit(2)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Streaming parser of the rbd export-diff formats v1 and v2"""
+
+import os
+import stat
+from struct import unpack_from
+from collections import namedtuple
+
+RBD_DIFF_V1_HEADER = "rbd diff v1\n"
+RBD_DIFF_V2_HEADER = "rbd diff v2\n"
+
+# records of the diff, as they are yielded by Reader
+FromSnap = namedtuple('FromSnap', 'name')
+ToSnap = namedtuple('ToSnap', 'name')
+Size = namedtuple('Size', 'size')
+Data = namedtuple('Data', 'offset length')
+Zero = namedtuple('Zero', 'offset length')
+End = namedtuple('End', '')
+
+# metadata of the records, little endian
+_snap_name_length_ = "<I"
+_size_ = "<Q"
+_extent_ = "<QQ"
+_record_length_ = "<Q"
+# tag, v2 record length and extent of data and zero records, decoded at once
+_extent_record_ = {1: ("<BQQ", 17), 2: ("<BQQQ", 25)}
+_data_tag_ = ord('w')
+_zero_tag_ = ord('z')
+# records built from their fields without the argument checks of namedtuple
+_new_record_ = tuple.__new__
+
+READ_BUFFER_SIZE = 1024*1024
+
+
+class DiffError(Exception):
+    pass
+
+
+class Reader(object):
+    """
+    Iterates over the records of a diff read from fh, through a buffer of its own
+    filled with readinto. The data of a Data record is read with read_into or
+    read_chunks before the next record; what is left of it is skipped.
+
+    v2 records carry their length, so unknown ones, like the snapshot protection
+    status, are skipped. Iteration stops at End, or at EOF between records. Data
+    skipped in regular files is seeked over.
+    """
+
+    def __init__(self, fh, buffer_size=READ_BUFFER_SIZE):
+        self.fh = fh
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # data of the current Data record not read yet
+        self.remaining = 0
+        self.file_size = None
+        if hasattr(fh, 'fileno'):
+            fh_stat = os.fstat(fh.fileno())
+            if stat.S_ISREG(fh_stat.st_mode):
+                self.file_size = fh_stat.st_size
+        header = self._read(len(RBD_DIFF_V1_HEADER))
+        if header == RBD_DIFF_V1_HEADER:
+            self.version = 1
+        elif header == RBD_DIFF_V2_HEADER:
+            self.version = 2
+        else:
+            raise DiffError("Unknown rbd diff header %r" % header)
+
+    def _fill(self, size):
+        """Have at least size bytes in the buffer, unless EOF comes first"""
+        if self.end - self.start >= size:
+            return True
+        if self.start > 0:
+            self.buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        while self.end < size:
+            read_length = self.fh.readinto(self.view[self.end:])
+            if not read_length:
+                return False
+            self.end += read_length
+        return True
+
+    def _read(self, size):
+        if not self._fill(size):
+            raise DiffError("Unexpected EOF in record")
+        self.start += size
+        return str(self.buffer[self.start - size:self.start])
+
+    def _unpack(self, fmt, size):
+        if not self._fill(size):
+            raise DiffError("Unexpected EOF in record")
+        self.start += size
+        return unpack_from(fmt, self.buffer, self.start - size)
+
+    def _skip(self, size):
+        buffered = min(size, self.end - self.start)
+        self.start += buffered
+        size -= buffered
+        if size > 0 and self.file_size is not None:
+            self.fh.seek(size, 1)
+            if self.fh.tell() > self.file_size:
+                raise DiffError("Unexpected EOF in record")
+            return
+        while size > 0:
+            read_length = self.fh.readinto(self.view[:min(size, len(self.view))])
+            if not read_length:
+                raise DiffError("Unexpected EOF in record")
+            size -= read_length
+
+    def read_into(self, view):
+        """Fill view with the next data of the current Data record"""
+        size = len(view)
+        if size > self.remaining:
+            raise DiffError("Read of %d bytes beyond the %d left in data record" % (size, self.remaining))
+        buffered = min(size, self.end - self.start)
+        view[:buffered] = self.view[self.start:self.start + buffered]
+        self.start += buffered
+        read = buffered
+        while read < size:
+            read_length = self.fh.readinto(view[read:])
+            if not read_length:
+                raise DiffError("Unexpected EOF in data record, %d bytes of %d read" % (read, size))
+            read += read_length
+        self.remaining -= size
+        return view
+
+    def read_chunks(self, buffer):
+        """
+        Yields the rest of the current Data record in slices of at most len(buffer),
+        each one valid until the next is read. Data already in the buffer of the
+        reader is yielded from there, the rest is read into buffer.
+        """
+        while self.remaining > 0:
+            size = min(self.remaining, self.end - self.start, len(buffer))
+            if size > 0:
+                self.start += size
+                self.remaining -= size
+                yield self.view[self.start - size:self.start]
+            else:
+                yield self.read_into(memoryview(buffer)[:min(self.remaining, len(buffer))])
+
+    def __iter__(self):
+        (extent_record, extent_record_size) = _extent_record_[self.version]
+        while True:
+            if self.remaining:
+                self._skip(self.remaining)
+                self.remaining = 0
+            start = self.start
+            if self.end - start >= extent_record_size and \
+               (self.buffer[start] == _data_tag_ or self.buffer[start] == _zero_tag_):
+                record = unpack_from(extent_record, self.buffer, start)
+                self.start = start + extent_record_size
+                if record[0] == _data_tag_:
+                    self.remaining = record[-1]
+                    yield _new_record_(Data, record[-2:])
+                else:
+                    yield _new_record_(Zero, record[-2:])
+                continue
+            if not self._fill(1):
+                return
+            tag = self._read(1)
+            if tag == 'e':
+                yield End()
+                return
+            if self.version == 2:
+                (length,) = self._unpack(_record_length_, 8)
+            if tag == 'f' or tag == 't':
+                (name_length,) = self._unpack(_snap_name_length_, 4)
+                name = self._read(name_length)
+                yield FromSnap(name) if tag == 'f' else ToSnap(name)
+            elif tag == 's':
+                yield Size(*self._unpack(_size_, 8))
+            elif tag == 'w':
+                record = Data(*self._unpack(_extent_, 16))
+                self.remaining = record.length
+                yield record
+            elif tag == 'z':
+                yield Zero(*self._unpack(_extent_, 16))
+            elif self.version == 2:
+                self._skip(length)
+            else:
+                raise DiffError("Unknown record tag %r" % tag)
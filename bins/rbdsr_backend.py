@@ -0,0 +1,550 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Backends executing rbd image operations for cephutils"""
+
+import util
+import json
+import time
+import atexit
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import rados
+    import rbd
+    HAVE_LIBRBD = True
+except ImportError:
+    HAVE_LIBRBD = False
+
+CEPH_CONF = '/etc/ceph/ceph.conf'
+
+BACKEND_LIBRBD = 'librbd'
+BACKEND_CLI = 'cli'
+BACKEND_TYPES = [BACKEND_LIBRBD, BACKEND_CLI]
+
+# rbd processes run at once when the CLI backend fetches metadata in bulk
+CLI_WORKERS = 8
+
+
+class Sleeper(object):
+    """Lock watcher of backends that can't be notified: just waits out the timeout."""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class CLIBackend(object):
+    """Runs every operation through the `rbd` command line utility."""
+
+    def __init__(self, pool, ceph_user):
+        util.SMlog("rbdsr_backend.CLIBackend.__init__: pool=%s, ceph_user=%s" % (pool, ceph_user))
+        self.pool = pool
+        self.ceph_user = ceph_user
+
+    def _rbd(self, args):
+        return util.pread2(["rbd"] + args + ["--pool", self.pool, "--name", self.ceph_user])
+
+    def close(self):
+        pass
+
+    def list_images(self):
+        """Same records as `rbd ls -l --format json`"""
+        cmdout = self._rbd(["ls", "-l", "--format", "json"])
+        if len(cmdout) != 0:
+            return json.loads(cmdout)
+        else:
+            return []
+
+    def image_info(self, image):
+        cmdout = self._rbd(["info", image, "--format", "json"])
+        if len(cmdout) != 0:
+            return json.loads(cmdout)
+        else:
+            return {}
+
+    def image_exists(self, image):
+        try:
+            self._rbd(["info", image, "--format", "json"])
+            return True
+        except Exception:
+            return False
+
+    def image_meta_list(self, image):
+        cmdout = self._rbd(["image-meta", "list", image, "--format", "json"])
+        if len(cmdout) != 0:
+            return json.loads(cmdout)
+        else:
+            return {}
+
+    def images_meta_list(self, images):
+        """Metadata of several images, fetched by a bounded pool of rbd processes"""
+        images = list(images)
+        if not images:
+            return {}
+        pool = ThreadPool(min(CLI_WORKERS, len(images)))
+        try:
+            metas = pool.map(self.image_meta_list, images)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(images, metas))
+
+    def image_meta_set(self, image, key, value):
+        self._rbd(["image-meta", "set", image, key, value])
+
+    def image_meta_remove(self, image, key):
+        self._rbd(["image-meta", "remove", image, key])
+
+    def create(self, image, size_M, object_size, image_format):
+        self._rbd(["create", image, "--size", str(size_M), "--object-size", str(object_size),
+                   "--image-format", str(image_format)])
+
+    def resize(self, image, size_M):
+        self._rbd(["resize", "--size", str(size_M), "--allow-shrink", image])
+
+    def remove(self, image):
+        self._rbd(["rm", image])
+
+    def rename(self, image, new_image):
+        self._rbd(["mv", image, new_image])
+
+    def flatten(self, image):
+        self._rbd(["flatten", image])
+
+    def clone(self, image, snap, clone_image):
+        self._rbd(["clone", "%s@%s" % (image, snap), clone_image])
+
+    def snap_create(self, image, snap):
+        self._rbd(["snap", "create", "%s@%s" % (image, snap)])
+
+    def snap_protect(self, image, snap):
+        self._rbd(["snap", "protect", "%s@%s" % (image, snap)])
+
+    def snap_unprotect(self, image, snap):
+        self._rbd(["snap", "unprotect", "%s@%s" % (image, snap)])
+
+    def snap_remove(self, image, snap):
+        self._rbd(["snap", "rm", "%s@%s" % (image, snap)])
+
+    def snap_rollback(self, image, snap):
+        self._rbd(["snap", "rollback", "%s@%s" % (image, snap)])
+
+    def lock_owner(self, image, cookie):
+        locks = json.loads(self._rbd(["--format", "json", "lock", "list", image]) or '{}')
+        try:
+            return locks[cookie]['locker']
+        except (KeyError, TypeError):
+            return None
+
+    def lock_acquire(self, image, cookie):
+        try:
+            self._rbd(["lock", "add", image, cookie])
+            return True
+        except Exception:
+            return False
+
+    def lock_release(self, image, cookie, locker):
+        self._rbd(["lock", "rm", image, cookie, locker])
+
+    def lock_notify(self, image):
+        pass
+
+    def lock_watcher(self, image):
+        return Sleeper()
+
+
+class LibrbdBackend(object):
+    """Runs every operation over one rados connection held for the life of the SM command."""
+
+    def __init__(self, pool, ceph_user):
+        util.SMlog("rbdsr_backend.LibrbdBackend.__init__: pool=%s, ceph_user=%s" % (pool, ceph_user))
+        self.pool = pool
+        self.ceph_user = ceph_user
+        self.cluster = rados.Rados(conffile=CEPH_CONF, name=ceph_user)
+        self.cluster.connect()
+        try:
+            self.ioctx = self.cluster.open_ioctx(pool)
+        except Exception:
+            self.cluster.shutdown()
+            raise
+        self.rbd = rbd.RBD()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.cluster is not None:
+            self.ioctx.close()
+            self.cluster.shutdown()
+            self.cluster = None
+
+    def _image(self, image, snap=None, read_only=False):
+        return rbd.Image(self.ioctx, str(image), snapshot=snap, read_only=read_only)
+
+    def list_images(self):
+        """Same records as `rbd ls -l --format json`"""
+        images = []
+        for name in self.rbd.list(self.ioctx):
+            try:
+                img = self._image(name, read_only=True)
+            except rbd.ImageNotFound:
+                continue
+            try:
+                images.append({'image': name, 'size': img.size(), 'format': 2})
+                for snap in img.list_snaps():
+                    images.append({'image': name, 'snapshot': snap['name'], 'size': snap['size'], 'format': 2})
+            finally:
+                img.close()
+        return images
+
+    def image_info(self, image):
+        img = self._image(image, read_only=True)
+        try:
+            stat = img.stat()
+            return {'name': image, 'size': stat['size'], 'objects': stat['num_objs'],
+                    'order': stat['order'], 'object_size': stat['obj_size'],
+                    'block_name_prefix': stat['block_name_prefix'], 'format': 2}
+        finally:
+            img.close()
+
+    def image_exists(self, image):
+        try:
+            self._image(image, read_only=True).close()
+            return True
+        except rbd.ImageNotFound:
+            return False
+
+    def image_meta_list(self, image):
+        img = self._image(image, read_only=True)
+        try:
+            return dict(img.metadata_list())
+        finally:
+            img.close()
+
+    def images_meta_list(self, images):
+        return dict((image, self.image_meta_list(image)) for image in images)
+
+    def image_meta_set(self, image, key, value):
+        img = self._image(image)
+        try:
+            img.metadata_set(str(key), str(value))
+        finally:
+            img.close()
+
+    def image_meta_remove(self, image, key):
+        img = self._image(image)
+        try:
+            img.metadata_remove(str(key))
+        finally:
+            img.close()
+
+    def create(self, image, size_M, object_size, image_format):
+        order = object_size.bit_length() - 1
+        self.rbd.create(self.ioctx, str(image), size_M * 1024 * 1024, order=order,
+                        old_format=(image_format == 1), features=self._default_features())
+
+    def _default_features(self):
+        # older bindings create images without any feature unless told otherwise
+        try:
+            return int(self.cluster.conf_get('rbd_default_features'))
+        except (TypeError, ValueError):
+            return None
+
+    def resize(self, image, size_M):
+        img = self._image(image)
+        try:
+            img.resize(size_M * 1024 * 1024)
+        finally:
+            img.close()
+
+    def remove(self, image):
+        self.rbd.remove(self.ioctx, str(image))
+
+    def rename(self, image, new_image):
+        self.rbd.rename(self.ioctx, str(image), str(new_image))
+
+    def flatten(self, image):
+        img = self._image(image)
+        try:
+            img.flatten()
+        finally:
+            img.close()
+
+    def clone(self, image, snap, clone_image):
+        self.rbd.clone(self.ioctx, str(image), str(snap), self.ioctx, str(clone_image))
+
+    def _snap_op(self, image, op, snap):
+        img = self._image(image)
+        try:
+            getattr(img, op)(str(snap))
+        finally:
+            img.close()
+
+    def snap_create(self, image, snap):
+        self._snap_op(image, 'create_snap', snap)
+
+    def snap_protect(self, image, snap):
+        self._snap_op(image, 'protect_snap', snap)
+
+    def snap_unprotect(self, image, snap):
+        self._snap_op(image, 'unprotect_snap', snap)
+
+    def snap_remove(self, image, snap):
+        self._snap_op(image, 'remove_snap', snap)
+
+    def snap_rollback(self, image, snap):
+        self._snap_op(image, 'rollback_to_snap', snap)
+
+    def lock_owner(self, image, cookie):
+        img = self._image(image, read_only=True)
+        try:
+            lockers = img.list_lockers()
+        finally:
+            img.close()
+        if lockers:
+            for client, lock_cookie, address in lockers['lockers']:
+                if lock_cookie == cookie:
+                    return client
+        return None
+
+    def lock_acquire(self, image, cookie):
+        img = self._image(image)
+        try:
+            img.lock_exclusive(str(cookie))
+            return True
+        except (rbd.ImageBusy, rbd.ImageExists):
+            return False
+        finally:
+            img.close()
+
+    def lock_release(self, image, cookie, locker):
+        img = self._image(image)
+        try:
+            img.break_lock(str(locker), str(cookie))
+        finally:
+            img.close()
+
+    def _header_oid(self, image):
+        img = self._image(image, read_only=True)
+        try:
+            prefix = img.stat()['block_name_prefix']
+        finally:
+            img.close()
+        if prefix.startswith('rbd_data.'):
+            return 'rbd_header.%s' % prefix[len('rbd_data.'):]
+        else:
+            return '%s.rbd' % image
+
+    def lock_notify(self, image):
+        """Wake up the waiters watching the header of the lock image"""
+        if hasattr(self.ioctx, 'notify'):
+            try:
+                self.ioctx.notify(self._header_oid(image))
+            except Exception, e:
+                util.SMlog("rbdsr_backend.LibrbdBackend.lock_notify: %s" % str(e))
+
+    def lock_watcher(self, image):
+        if not hasattr(self.ioctx, 'watch'):
+            return Sleeper()
+        try:
+            return LibrbdWatcher(self.ioctx, self._header_oid(image))
+        except Exception, e:
+            util.SMlog("rbdsr_backend.LibrbdBackend.lock_watcher: %s" % str(e))
+            return Sleeper()
+
+
+class LibrbdWatcher(object):
+    """Watch on an rbd header object, woken up by lock_notify of any client."""
+
+    def __init__(self, ioctx, oid):
+        self.event = threading.Event()
+        self.watch = ioctx.watch(oid, self._notified)
+
+    def _notified(self, *args):
+        self.event.set()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        notified = self.event.is_set()
+        self.event.clear()
+        return notified
+
+    def close(self):
+        self.watch.close()
+
+
+class FakeBackend(object):
+    """In-memory pool used to exercise cephutils without a cluster.
+
+    Pools are kept at class level, so every FakeBackend opened on the
+    same pool name in one process sees the same images. get_backend never
+    returns it, it has to be passed explicitly."""
+
+    pools = {}
+    notifications = threading.Condition()
+    clients = itertools.count(1)
+
+    def __init__(self, pool, ceph_user):
+        self.pool = pool
+        self.ceph_user = ceph_user
+        self.images = FakeBackend.pools.setdefault(pool, {})
+        # every instance stands for one rados client, like a separate SM process would
+        self.client = "client.%d" % FakeBackend.clients.next()
+        self.lock_attempts = 0
+
+    def close(self):
+        pass
+
+    def _get(self, image):
+        if image not in self.images:
+            raise KeyError("image %s not found in pool %s" % (image, self.pool))
+        return self.images[image]
+
+    def list_images(self):
+        images = []
+        for name in sorted(self.images.keys()):
+            img = self.images[name]
+            images.append({'image': name, 'size': img['size'], 'format': 2})
+            for snap in sorted(img['snaps'].keys()):
+                images.append({'image': name, 'snapshot': snap, 'size': img['snaps'][snap]['size'], 'format': 2})
+        return images
+
+    def image_info(self, image):
+        img = self._get(image)
+        return {'name': image, 'size': img['size'], 'format': 2}
+
+    def image_exists(self, image):
+        return image in self.images
+
+    def image_meta_list(self, image):
+        return dict(self._get(image)['meta'])
+
+    def images_meta_list(self, images):
+        return dict((image, self.image_meta_list(image)) for image in images)
+
+    def image_meta_set(self, image, key, value):
+        self._get(image)['meta'][key] = str(value)
+
+    def image_meta_remove(self, image, key):
+        del self._get(image)['meta'][key]
+
+    def create(self, image, size_M, object_size, image_format):
+        if image in self.images:
+            raise KeyError("image %s already exists in pool %s" % (image, self.pool))
+        self.images[image] = {'size': size_M * 1024 * 1024, 'meta': {}, 'snaps': {}, 'parent': None,
+                              'lockers': {}, 'notifies': 0}
+
+    def resize(self, image, size_M):
+        self._get(image)['size'] = size_M * 1024 * 1024
+
+    def remove(self, image):
+        if self._get(image)['snaps']:
+            raise KeyError("image %s has snapshots" % image)
+        del self.images[image]
+
+    def rename(self, image, new_image):
+        self.images[new_image] = self.images.pop(image)
+
+    def flatten(self, image):
+        self._get(image)['parent'] = None
+
+    def clone(self, image, snap, clone_image):
+        if not self._get(image)['snaps'][snap]['protected']:
+            raise KeyError("snapshot %s@%s is not protected" % (image, snap))
+        self.create(clone_image, 0, 0, 2)
+        self.images[clone_image]['size'] = self._get(image)['snaps'][snap]['size']
+        self.images[clone_image]['parent'] = (image, snap)
+
+    def snap_create(self, image, snap):
+        img = self._get(image)
+        img['snaps'][snap] = {'size': img['size'], 'protected': False}
+
+    def snap_protect(self, image, snap):
+        self._get(image)['snaps'][snap]['protected'] = True
+
+    def snap_unprotect(self, image, snap):
+        self._get(image)['snaps'][snap]['protected'] = False
+
+    def snap_remove(self, image, snap):
+        if self._get(image)['snaps'][snap]['protected']:
+            raise KeyError("snapshot %s@%s is protected" % (image, snap))
+        del self._get(image)['snaps'][snap]
+
+    def snap_rollback(self, image, snap):
+        img = self._get(image)
+        img['size'] = img['snaps'][snap]['size']
+
+    def lock_owner(self, image, cookie):
+        return self._get(image)['lockers'].get(cookie)
+
+    def lock_acquire(self, image, cookie):
+        self.lock_attempts += 1
+        with FakeBackend.notifications:
+            lockers = self._get(image)['lockers']
+            if lockers:
+                return False
+            lockers[cookie] = self.client
+            return True
+
+    def lock_release(self, image, cookie, locker):
+        with FakeBackend.notifications:
+            lockers = self._get(image)['lockers']
+            if lockers.get(cookie) != locker:
+                raise KeyError("%s doesn't hold lock %s on %s" % (locker, cookie, image))
+            del lockers[cookie]
+
+    def lock_notify(self, image):
+        with FakeBackend.notifications:
+            self._get(image)['notifies'] += 1
+            FakeBackend.notifications.notify_all()
+
+    def lock_watcher(self, image):
+        return FakeWatcher(self._get(image))
+
+
+class FakeWatcher(object):
+    """Lock watcher of the fake backend, woken up by lock_notify on the same image."""
+
+    def __init__(self, img):
+        self.img = img
+        self.seen = img['notifies']
+
+    def wait(self, timeout):
+        with FakeBackend.notifications:
+            if self.img['notifies'] == self.seen:
+                FakeBackend.notifications.wait(timeout)
+            notified = self.img['notifies'] != self.seen
+            self.seen = self.img['notifies']
+        return notified
+
+    def close(self):
+        pass
+
+
+def get_backend(pool, ceph_user, backend_type=None):
+    """Open the requested backend, falling back to the rbd CLI when librbd can't be used."""
+    util.SMlog("rbdsr_backend.get_backend: pool=%s, ceph_user=%s, backend_type=%s" % (pool, ceph_user, backend_type))
+    if backend_type in (None, BACKEND_LIBRBD) and HAVE_LIBRBD:
+        try:
+            return LibrbdBackend(pool, ceph_user)
+        except Exception, e:
+            util.SMlog("rbdsr_backend.get_backend: can't connect with librbd (%s), using rbd CLI" % str(e))
+    return CLIBackend(pool, ceph_user)
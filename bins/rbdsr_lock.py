@@ -18,30 +18,171 @@
 """Serialization for concurrent operations using rbd locking mechanism"""
 
 import util
-import json
 import os
 import time
+import fcntl
+import errno
+import random
+import thread
+import threading
+import rbdsr_backend
 from cephutils import RBDPOOL_PREFIX, DEFAULT_CEPH_USER
 
 VERBOSE = True
 SRLOCK_IMAGE = '__srlock__'
+SRLOCK_COOKIE = '__locked__'
+# bounds of the randomized backoff between attempts on the cluster lock, in seconds
+BACKOFF_MIN = 0.05
 TIMEOUT = 1
+# bounds of the interval of local waiters polling their turn in the host queue, in seconds
+QUEUE_POLL = 0.01
+QUEUE_POLL_MAX = 0.2
+LOCK_DIR = '/run/rbdsr'
+
+
+def _make_lock_dir():
+    if not os.path.isdir(LOCK_DIR):
+        try:
+            os.makedirs(LOCK_DIR)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+
+class LocalLock(object):
+    """flock-based lock of this host, for critical sections which don't touch cross-host state."""
+
+    def __init__(self, name):
+        util.SMlog("rbdsr_lock.LocalLock.__init__: name = %s" % name)
+        _make_lock_dir()
+        self.path = "%s/%s.lock" % (LOCK_DIR, name)
+        # flock excludes other processes, the thread lock other threads sharing this object
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        util.SMlog("rbdsr_lock.LocalLock.acquire")
+        self._thread_lock.acquire()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except:
+                os.close(fd)
+                raise
+        except:
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+
+    def release(self):
+        util.SMlog("rbdsr_lock.LocalLock.release")
+        fd = self._fd
+        self._fd = None
+        # closing the file drops the flock
+        os.close(fd)
+        self._thread_lock.release()
+
+    def held(self):
+        return self._fd is not None
+
+
+class LocalQueue(object):
+    """FIFO of the waiters on this host, so that only its head polls the cluster lock."""
+
+    def __init__(self, sr_uuid):
+        _make_lock_dir()
+        self.path = "%s/%s.queue" % (LOCK_DIR, sr_uuid)
+        self.token = "%d.%d" % (os.getpid(), thread.get_ident())
+
+    def _alive(self, token):
+        return pid_alive(int(token.split('.')[0]))
+
+    def _update(self, change):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            f = os.fdopen(os.dup(fd), 'r+')
+            try:
+                # waiters which died in the queue are dropped on the way
+                tokens = [token for token in f.read().split() if self._alive(token)]
+                change(tokens)
+                f.seek(0)
+                f.truncate()
+                f.write('\n'.join(tokens))
+            finally:
+                f.close()
+        finally:
+            os.close(fd)
+
+    def _read(self):
+        """Live waiters, read under a shared flock so that polling never rewrites the queue"""
+        fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            f = os.fdopen(os.dup(fd), 'r')
+            try:
+                return [token for token in f.read().split() if self._alive(token)]
+            finally:
+                f.close()
+        finally:
+            os.close(fd)
+
+    def join(self):
+        self._update(lambda tokens: tokens.append(self.token))
+
+    def leave(self):
+        def remove(tokens):
+            if self.token in tokens:
+                tokens.remove(self.token)
+        self._update(remove)
+
+    def ahead(self):
+        """Number of waiters ahead of this one"""
+        tokens = self._read()
+        if self.token in tokens:
+            return tokens.index(self.token)
+        return len(tokens)
+
+    def is_head(self):
+        return self.ahead() == 0
+
+    def is_empty(self):
+        return len(self._read()) == 0
+
+    def wait_head(self):
+        # the further from the head, the less often a waiter polls
+        ahead = self.ahead()
+        while ahead > 0:
+            time.sleep(min(QUEUE_POLL * ahead, QUEUE_POLL_MAX))
+            ahead = self.ahead()
 
 
 class Lock(object):
     """rdb-based locks on a rbd image."""
 
-    def __init__(self, sr_uuid, cephx_id="client.%s" % DEFAULT_CEPH_USER):
+    def __init__(self, sr_uuid, cephx_id="client.%s" % DEFAULT_CEPH_USER, backend=None):
         util.SMlog("rbdsr_lock.Lock.__int__: sr_uuid = %s, cephx_id = %s" % (sr_uuid, cephx_id))
 
         self.sr_uuid = sr_uuid
         self._pool = "%s%s" % (RBDPOOL_PREFIX, sr_uuid)
         self._cephx_id = cephx_id
         self._srlock_image = SRLOCK_IMAGE
+        if backend is None:
+            backend = rbdsr_backend.get_backend(self._pool, self._cephx_id)
+        self._backend = backend
+        self._queue = LocalQueue(sr_uuid)
 
         if not self._if_rbd_exist(self._srlock_image):
-            util.pread2(["rbd", "create", self._srlock_image, "--size", "0", "--pool", self._pool, "--name",
-                         self._cephx_id])
+            self._backend.create(self._srlock_image, 0, 4194304, 2)
 
     def _if_rbd_exist(self, rbd_name):
         """
@@ -50,46 +191,30 @@ class Lock(object):
         """
         util.SMlog("rbdsr_lock.Lock._if_vdi_exist: rbd_name=%s" % rbd_name)
 
-        try:
-            util.pread2(["rbd", "info", rbd_name, "--pool", self._pool, "--format", "json", "--name",
-                         self._cephx_id])
-            return True
-        except Exception:
-            return False
+        return self._backend.image_exists(rbd_name)
 
     def _get_srlocker(self):
         util.SMlog("rbdsr_lock.Lock._get_srlocker")
-        locks = json.loads(util.pread2(["rbd", "--format", "json", "--name", self._cephx_id, "--pool", self._pool,
-                                        "lock", "list", self._srlock_image]))
-        try:
-            return locks['__locked__']['locker']
-        except KeyError:
-            return None
+        return self._backend.lock_owner(self._srlock_image, SRLOCK_COOKIE)
 
     def cleanup(self):
         """Release a previously acquired lock."""
         util.SMlog("rbdsr_lock.Lock.cleanup")
 
-        _locker = self._get_srlocker()
-        try:
-            util.pread2(["rbd", "--name", self._cephx_id, "--pool", self._pool,
-                         "lock", "rm", self._srlock_image, '__locked__', _locker])
-            if VERBOSE:
-                util.SMlog("rbdsr_lock: released %s" % _locker)
-            return True
-        except Exception:
-            if VERBOSE:
-                util.SMlog("rbdsr_lock: Can't release %s" % _locker)
-            return False
-
+        return self._release()
 
     def acquire(self):
         """Blocking lock aquisition, with warnings."""
         util.SMlog("rbdsr_lock.Lock.acquire")
-        if not self._trylock():
-            _locker = self._get_srlocker()
-            util.SMlog("rbdsr_lock: Failed to lock on first attempt, blocked by %s" % _locker)
-            self._lock()
+        self._queue.join()
+        try:
+            self._queue.wait_head()
+            if not self._trylock():
+                _locker = self._get_srlocker()
+                util.SMlog("rbdsr_lock: Failed to lock on first attempt, blocked by %s" % _locker)
+                self._lock()
+        finally:
+            self._queue.leave()
         if VERBOSE:
             _locker = self._get_srlocker()
             util.SMlog("rbdsr_lock: acquired '%s'" % _locker)
@@ -98,7 +223,8 @@ class Lock(object):
         """Acquire lock if possible, or return false if lock already held"""
         util.SMlog("rbdsr_lock.Lock.acquireNoblock")
 
-        ret = self._trylock()
+        # don't overtake the waiters queued on this host
+        ret = self._queue.is_empty() and self._trylock()
         exists = self.held()
 
         if VERBOSE:
@@ -119,10 +245,13 @@ class Lock(object):
         """Release a previously acquired lock."""
         util.SMlog("rbdsr_lock.Lock.release")
 
+        return self._release()
+
+    def _release(self):
         _locker = self._get_srlocker()
         try:
-            util.pread2(["rbd", "--name", self._cephx_id, "--pool", self._pool,
-                         "lock", "rm", self._srlock_image, '__locked__', _locker])
+            self._backend.lock_release(self._srlock_image, SRLOCK_COOKIE, _locker)
+            self._backend.lock_notify(self._srlock_image)
             if VERBOSE:
                 util.SMlog("rbdsr_lock: released %s" % _locker)
             return True
@@ -135,23 +264,26 @@ class Lock(object):
         util.SMlog("rbdsr_lock.Lock._trylock")
         if VERBOSE:
             util.SMlog("rbdsr_lock: Trying to lock '%s'" % self._srlock_image)
-        if not self.held():
-            try:
-                util.pread2(["rbd", "--name", self._cephx_id, "--pool", self._pool,
-                         "lock", "add", self._srlock_image, '__locked__'])
-                if VERBOSE:
-                    util.SMlog("rbdsr_lock: acquired")
-                return True
-            except Exception:
-                return False
+        if self._backend.lock_acquire(self._srlock_image, SRLOCK_COOKIE):
+            if VERBOSE:
+                util.SMlog("rbdsr_lock: acquired")
+            return True
         else:
             return False
 
     def _lock(self):
         util.SMlog("rbdsr_lock.Lock._lock")
 
-        while not self._trylock():
-            time.sleep(TIMEOUT)
+        # Sleep a randomized, exponentially growing delay between attempts,
+        # unless the holder notifies the release earlier.
+        watcher = self._backend.lock_watcher(self._srlock_image)
+        try:
+            delay = BACKOFF_MIN
+            while not self._trylock():
+                watcher.wait(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, TIMEOUT)
+        finally:
+            watcher.close()
 
 if __debug__:
     import sys
@@ -195,7 +327,102 @@ if __debug__:
 
         #lock.cleanup('test')
 
+    def bench(waiters=30, hold=0.01):
+        """Contention of concurrent waiters on one SR lock, run against the fake backend"""
+        import threading
+        import tempfile
+        global LOCK_DIR
+        LOCK_DIR = tempfile.mkdtemp()
+        sr_uuid = '5aab7115-2d2c-466d-818c-909cff689467'
+        pool = "%s%s" % (RBDPOOL_PREFIX, sr_uuid)
+        waits = []
+        backends = []
+
+        def waiter():
+            backend = rbdsr_backend.FakeBackend(pool, "client.%s" % DEFAULT_CEPH_USER)
+            backends.append(backend)
+            lock = Lock(sr_uuid, backend=backend)
+            t1 = time.time()
+            lock.acquire()
+            waits.append(time.time() - t1)
+            time.sleep(hold)
+            lock.release()
+
+        t1 = time.time()
+        threads = [threading.Thread(target=waiter) for i in range(int(waiters))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print("%d waiters holding %s seconds each take %s seconds" % (waiters, hold, time.time() - t1))
+        print("wait: max %s seconds, average %s seconds" % (max(waits), sum(waits) / len(waits)))
+        print("attempts on the cluster lock: %d" % sum([backend.lock_attempts for backend in backends]))
+
+    def bench_attach(attaches=30, map_time=0.05):
+        """Throughput of concurrent attaches and detaches on one host, each in a process of its
+        own like SM commands, allocating and freeing its slot with rbdsr_slots. The device map
+        and unmap take map_time seconds. They run under the cluster lock of a fake backend
+        shared by the processes, as attaches did before, or under the local lock of the slot
+        table only."""
+        import tempfile
+        import multiprocessing
+        from multiprocessing.managers import BaseManager
+        import rbdsr_slots
+        global LOCK_DIR
+        LOCK_DIR = tempfile.mkdtemp()
+        # rbdsr_slots has its own copy of this module when it runs as a script
+        rbdsr_slots.rbdsr_lock.LOCK_DIR = LOCK_DIR
+        sr_uuid = '5aab7115-2d2c-466d-818c-909cff689467'
+        pool = "%s%s" % (RBDPOOL_PREFIX, sr_uuid)
+        cephx_id = "client.%s" % DEFAULT_CEPH_USER
+
+        class Cluster(BaseManager):
+            pass
+        # the fake pool lives in the manager process, where the attach processes reach it
+        Cluster.register('FakeBackend', rbdsr_backend.FakeBackend, method_to_typeid={'lock_watcher': 'FakeWatcher'})
+        Cluster.register('FakeWatcher', create_method=False)
+        cluster = Cluster()
+        cluster.start()
+        cluster.FakeBackend(pool, cephx_id).create(SRLOCK_IMAGE, 0, 4194304, 2)
+
+        def attach_detach(vdi_uuid, use_cluster_lock, start):
+            slots = rbdsr_slots.SlotAllocator(int(attaches) + 1, lambda vdi_uuid: True)
+            lock = Lock(sr_uuid, backend=cluster.FakeBackend(pool, cephx_id))
+            start.wait()
+            for step in (lambda: slots.alloc(sr_uuid, vdi_uuid), lambda: slots.free(vdi_uuid)):
+                if use_cluster_lock:
+                    lock.acquire()
+                try:
+                    step()
+                    time.sleep(map_time)
+                finally:
+                    if use_cluster_lock:
+                        lock.release()
+
+        try:
+            for name, use_cluster_lock in (('cluster lock', True), ('local lock', False)):
+                start = multiprocessing.Event()
+                processes = [multiprocessing.Process(target=attach_detach, args=("vdi-%d" % i, use_cluster_lock, start))
+                             for i in range(int(attaches))]
+                for p in processes:
+                    p.start()
+                t1 = time.time()
+                start.set()
+                for p in processes:
+                    p.join()
+                delta = time.time() - t1
+                print("%s: %d attaches and detaches take %s seconds, %s attaches/s" % (name, attaches, delta, attaches / delta))
+        finally:
+            cluster.shutdown()
+
     if __name__ == '__main__':
-        print >>sys.stderr, "Running self tests..."
-        test()
-        print >>sys.stderr, "OK."
\ No newline at end of file
+        if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+            print >>sys.stderr, "Running lock contention benchmark..."
+            bench(*[float(arg) for arg in sys.argv[2:]])
+        elif len(sys.argv) > 1 and sys.argv[1] == 'bench_attach':
+            print >>sys.stderr, "Running attach benchmark..."
+            bench_attach(*[float(arg) for arg in sys.argv[2:]])
+        else:
+            print >>sys.stderr, "Running self tests..."
+            test()
+        print >>sys.stderr, "OK."
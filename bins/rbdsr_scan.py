@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Listings of the cluster kept on this host from an SM command to the next"""
+
+import util
+import os
+import json
+import time
+import uuid
+import errno
+import rbdsr_lock
+
+SCAN_NAME = 'scan'
+POOL_STATS_NAME = 'pool_stats'
+# image-meta key of the SR lock image holding the generation of the images of the pool
+GENERATION_KEY = 'generation'
+# seconds a listing is reused for, so that changes made outside of the SR show up anyway
+MAX_AGE = 600
+
+
+def _load(path, max_age):
+    """Content of the file at path, None if there is none or it is more than max_age seconds old"""
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            util.SMlog("rbdsr_scan._load: %s" % str(e))
+        return None
+    except ValueError, e:
+        util.SMlog("rbdsr_scan._load: %s" % str(e))
+        return None
+    if not 0 <= time.time() - cached['time'] <= max_age:
+        return None
+    return cached
+
+
+def _save(path, cached):
+    """Replace the file at path, at once for the processes reading it"""
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    cached['time'] = time.time()
+    try:
+        rbdsr_lock._make_lock_dir()
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        # it is listed again next time
+        util.SMlog("rbdsr_scan._save: %s" % str(e))
+
+
+class ScanCache(object):
+    """
+    Images of an SR pool, as listed by the backend, kept in a file under
+    rbdsr_lock.LOCK_DIR with the generation of the pool they were listed at.
+
+    The generation is a random stamp in the metadata of the SR lock image,
+    replaced by bump() after every change of the images or snapshots of the
+    pool, from any host. A listing is valid while the generation of the pool
+    is the one it was made at. The generation is read before the listing is
+    made, so that a change made meanwhile leaves the listing stale.
+    """
+
+    def __init__(self, sr_uuid, backend):
+        util.SMlog("rbdsr_scan.ScanCache.__init__: sr_uuid = %s" % sr_uuid)
+        self.backend = backend
+        self.path = "%s/%s-%s.json" % (rbdsr_lock.LOCK_DIR, SCAN_NAME, sr_uuid)
+
+    def generation(self):
+        """
+        Generation of the images of the pool, stamped now if it has none yet.
+        None if the SR lock image can't be read, e.g. before its creation:
+        nothing is cached then.
+        """
+        try:
+            generation = self.backend.image_meta_list(rbdsr_lock.SRLOCK_IMAGE).get(GENERATION_KEY)
+        except Exception, e:
+            util.SMlog("rbdsr_scan.ScanCache.generation: %s" % str(e))
+            return None
+        if generation is None:
+            generation = self.bump()
+        return generation
+
+    def bump(self):
+        """Start a new generation, after a change of the images of the pool"""
+        generation = uuid.uuid4().hex
+        try:
+            self.backend.image_meta_set(rbdsr_lock.SRLOCK_IMAGE, GENERATION_KEY, generation)
+        except Exception, e:
+            # no listing is cached without the lock image, otherwise it expires after MAX_AGE
+            util.SMlog("rbdsr_scan.ScanCache.bump: %s" % str(e))
+            return None
+        return generation
+
+    def load(self, generation):
+        """Images listed at generation, or None if there is no such listing"""
+        if generation is None:
+            return None
+        cached = _load(self.path, MAX_AGE)
+        if cached is None or cached['generation'] != generation:
+            return None
+        util.SMlog("rbdsr_scan.ScanCache.load: reusing the listing of generation %s" % generation)
+        return cached['images']
+
+    def save(self, generation, images):
+        """Keep images, as listed at generation"""
+        if generation is not None:
+            _save(self.path, {'generation': generation, 'images': images})
+
+
+class PoolStatsCache(object):
+    """
+    Stats of the pools of the cluster, as read by a cephx user with `ceph df`,
+    shared by the SM commands run on this host within ttl seconds.
+    """
+
+    def __init__(self, ceph_user, ttl):
+        self.ttl = ttl
+        self.path = "%s/%s-%s.json" % (rbdsr_lock.LOCK_DIR, POOL_STATS_NAME, ceph_user)
+
+    def load(self):
+        """Pools stats read less than ttl seconds ago, or None"""
+        if self.ttl <= 0:
+            return None
+        cached = _load(self.path, self.ttl)
+        if cached is None:
+            return None
+        util.SMlog("rbdsr_scan.PoolStatsCache.load: reusing pools stats of %.1f seconds ago" % (time.time() - cached['time']))
+        return cached['pools']
+
+    def save(self, pools):
+        if self.ttl > 0:
+            _save(self.path, {'pools': pools})
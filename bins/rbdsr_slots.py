@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Allocation of the device slots (/dev/nbdN) of this host"""
+
+import util
+import os
+import json
+import errno
+import rbdsr_lock
+from cephutils import NBD_MODULE_NBDS_MAX
+
+SLOTS_NAME = 'dev_slots'
+NBD_PID = '/sys/block/nbd%d/pid'
+# slots the table starts with, it doubles on demand up to the devices of the host
+INITIAL_SLOTS = 16
+
+
+class SlotAllocator(object):
+    """
+    Device slots of this host, shared by all its SRs and kept in a file
+    under rbdsr_lock.LOCK_DIR, which is gone with the devices on reboot.
+
+    Free slots are kept on a stack, so that allocation and release are O(1).
+    Slot 0 is reserved. Slots whose device is bound by a mapping the table
+    doesn't know of, e.g. made before the table was lost, are passed over.
+    When the stack runs out, the table doubles its size up to the number of
+    nbd devices of the host, which no SR can lower, then slots are reclaimed
+    from the VDIs left behind by a crashed attach or detach: those for which
+    in_use(vdi_uuid) is False and whose allocating process is gone.
+    """
+
+    def __init__(self, nbds_max, in_use):
+        util.SMlog("rbdsr_slots.SlotAllocator.__init__: nbds_max = %s" % nbds_max)
+        self.nbds_max = nbds_max
+        self.in_use = in_use
+        self.lock = rbdsr_lock.LocalLock(SLOTS_NAME)
+        self.path = "%s/%s.json" % (rbdsr_lock.LOCK_DIR, SLOTS_NAME)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                table = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            table = {'size': 1, 'free': [], 'slots': {}}
+            self._grow(table, INITIAL_SLOTS)
+        return table
+
+    def _max_size(self):
+        """
+        Devices of the loaded nbd module, shared by all the SRs of the host
+        whatever their nbds-max. Until it is loaded, the nbds-max of this SR,
+        which it is loaded with.
+        """
+        try:
+            with open(NBD_MODULE_NBDS_MAX) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return self.nbds_max
+
+    def _grow(self, table, size):
+        size = min(size, self._max_size())
+        # a table written with a lower size may hold slots beyond it
+        taken = set(entry['slot'] for entry in table['slots'].values()) | set(table['free'])
+        # lowest slots on top of the stack
+        table['free'][0:0] = [slot for slot in range(size - 1, table['size'] - 1, -1) if slot not in taken]
+        table['size'] = max(size, table['size'])
+
+    def _save(self, table):
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(table, f)
+        os.rename(tmp_path, self.path)
+
+    def _update(self, change):
+        self.lock.acquire()
+        try:
+            table = self._load()
+            result = change(table)
+            self._save(table)
+            return result
+        finally:
+            self.lock.release()
+
+    def _bound(self, slot):
+        return os.path.exists(NBD_PID % slot)
+
+    def _pop(self, table):
+        """Top free slot whose device isn't bound, None if there is none"""
+        for i in range(len(table['free'])):
+            slot = table['free'].pop()
+            if not self._bound(slot):
+                return slot
+            util.SMlog("rbdsr_slots.SlotAllocator._pop: slot %d is bound outside of the table" % slot)
+            # tried again once the ones above are used up
+            table['free'].insert(0, slot)
+        return None
+
+    def _reclaim(self, table):
+        for vdi_uuid, entry in table['slots'].items():
+            # the device of a paused VDI is unbound while it holds the slot, and an attach
+            # in progress holds its slot before the VDI is marked attached
+            if not rbdsr_lock.pid_alive(entry['pid']) and not self.in_use(vdi_uuid):
+                util.SMlog("rbdsr_slots.SlotAllocator._reclaim: slot %d of vdi_uuid %s" % (entry['slot'], vdi_uuid))
+                del table['slots'][vdi_uuid]
+                self._push(table, entry['slot'])
+
+    def _push(self, table, slot):
+        if slot < table['size']:
+            table['free'].append(slot)
+
+    def alloc(self, sr_uuid, vdi_uuid):
+        """Slot of vdi_uuid, taken from the free ones unless it already holds one"""
+        util.SMlog("rbdsr_slots.SlotAllocator.alloc: sr_uuid = %s, vdi_uuid = %s" % (sr_uuid, vdi_uuid))
+
+        def alloc(table):
+            slots = table['slots']
+            if vdi_uuid not in slots:
+                slot = self._pop(table)
+                if slot is None:
+                    self._grow(table, table['size'] * 2)
+                    slot = self._pop(table)
+                if slot is None:
+                    self._reclaim(table)
+                    slot = self._pop(table)
+                if slot is None:
+                    raise util.SMException("No free device slot for vdi_uuid=%s" % vdi_uuid)
+                slots[vdi_uuid] = {'slot': slot, 'sr': sr_uuid}
+            slots[vdi_uuid]['pid'] = os.getpid()
+            return slots[vdi_uuid]['slot']
+        return self._update(alloc)
+
+    def free(self, vdi_uuid):
+        util.SMlog("rbdsr_slots.SlotAllocator.free: vdi_uuid = %s" % vdi_uuid)
+
+        def free(table):
+            if vdi_uuid in table['slots']:
+                self._push(table, table['slots'].pop(vdi_uuid)['slot'])
+        self._update(free)
+
+    def free_sr(self, sr_uuid):
+        """Free the slots of all VDIs of sr_uuid"""
+        util.SMlog("rbdsr_slots.SlotAllocator.free_sr: sr_uuid = %s" % sr_uuid)
+
+        def free_sr(table):
+            for vdi_uuid, entry in table['slots'].items():
+                if entry['sr'] == sr_uuid:
+                    del table['slots'][vdi_uuid]
+                    self._push(table, entry['slot'])
+        self._update(free_sr)
@@ -0,0 +1,413 @@
+#!/usr/bin/python
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Records of the vhd format and a model of dynamic and differencing vhd files"""
+
+import os
+import re
+import sys
+import mmap
+from array import array
+from struct import Struct
+try:
+    import ctypes
+    import ctypes.util
+    _posix_fadvise_ = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fadvise64
+    _posix_fadvise_.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    _posix_fadvise_ = None
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 2097152
+DYNAMIC_HARDDISK_TYPE = 0x00000003
+DIFF_HARDDISK_TYPE = 0x00000004
+BAT_ENTRY_UNUSED = 0xffffffff
+PARENT_LOCATORS_COUNT = 8
+# vhd time stamps count seconds from 2000-01-01 00:00:00 UTC
+VHD_EPOCH = 946684800
+
+PLATFORM_CODE_NONE = 0x0
+PLATFORM_CODE_W2RU = 0x57327275
+PLATFORM_CODE_W2KU = 0x57326B75
+PLATFORM_CODE_MACX = 0x4D616358
+
+POSIX_FADV_SEQUENTIAL = 2
+
+
+class VHDError(Exception):
+    pass
+
+
+def checksum(record):
+    # one's complement of the sum of all bytes
+    return ~sum(bytearray(record)) & 0xffffffff
+
+
+class Record(object):
+    """
+    Fixed size big endian record of a vhd, whose fields are the attributes named in
+    _fields_, packed with _struct_. The checksum field, when there is one, is computed
+    by pack.
+    """
+    __slots__ = ()
+    _fields_ = ()
+    _struct_ = None
+
+    def __init__(self, *values):
+        for (name, value) in zip(self._fields_, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        return cls(*cls._struct_.unpack_from(data, offset))
+
+    def values(self):
+        return [getattr(self, name) for name in self._fields_]
+
+    def pack(self):
+        if 'checksum' in self._fields_:
+            self.checksum = 0
+            self.checksum = checksum(self._struct_.pack(*self.values()))
+        return self._struct_.pack(*self.values())
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(["%s=%r" % (name, getattr(self, name)) for name in self._fields_]))
+
+
+class Footer(Record):
+    # rbd_image_uuid takes the start of the reserved space
+    _fields_ = ('cookie', 'features', 'file_format_version', 'data_offset', 'time_stamp',
+                'creator_application', 'creator_version', 'creator_host_os', 'original_size',
+                'current_size', 'disk_geometry', 'disk_type', 'checksum', 'unique_id',
+                'saved_state', 'hidden', 'rbd_image_uuid', 'reserved')
+    __slots__ = _fields_
+    _struct_ = Struct("!8sIIQI4sIIQQ4sII16sBB16s410s")
+
+
+class DynamicDiskHeader(Record):
+    _fields_ = ('cookie', 'data_offset', 'table_offset', 'header_version', 'max_table_entries',
+                'block_size', 'checksum', 'parent_unique_id', 'parent_time_stamp', 'reserved1',
+                'parent_unicode_name') + \
+               tuple(['parent_locator_entry_%d' % (index + 1) for index in range(PARENT_LOCATORS_COUNT)]) + \
+               ('reserved2',)
+    __slots__ = _fields_
+    _struct_ = Struct("!8sQQIIII16sII512s" + "24s"*PARENT_LOCATORS_COUNT + "256s")
+
+    def set_parent_locator_entry(self, index, entry):
+        setattr(self, 'parent_locator_entry_%d' % (index + 1), entry.pack())
+
+
+class ParentLocatorEntry(Record):
+    _fields_ = ('platform_code', 'platform_data_space', 'platform_data_length', 'reserved', 'platform_data_offset')
+    __slots__ = _fields_
+    _struct_ = Struct("!IIIIQ")
+
+
+class BatmapHeader(Record):
+    # the checksum of a batmap header is the one of the batmap
+    _fields_ = ('cookie', 'batmap_offset', 'batmap_size', 'batmap_version', 'batmap_checksum', 'marker', 'reserved')
+    __slots__ = _fields_
+    _struct_ = Struct("!8sQIIIB483s")
+
+
+FOOTER_SIZE = Footer._struct_.size
+DYNAMIC_DISK_HEADER_SIZE = DynamicDiskHeader._struct_.size
+PARENT_LOCATOR_ENTRY_SIZE = ParentLocatorEntry._struct_.size
+BATMAP_HEADER_SIZE = BatmapHeader._struct_.size
+
+
+def get_size_aligned_to_sector_boundary(size):
+    return (size + SECTOR_SIZE - 1)//SECTOR_SIZE*SECTOR_SIZE
+
+
+def get_bitmap_size(block_size):
+    return get_size_aligned_to_sector_boundary(block_size/SECTOR_SIZE/8)
+
+
+def gen_geometry(image_size):
+    totalSectors = image_size / SECTOR_SIZE
+    if totalSectors > 65535*16*255:
+        totalSectors = 65535*16*255
+    if totalSectors >= 65535*16*63:
+        sectorsPerTrack = 255
+        heads = 16
+        cylinderTimesHeads = totalSectors / sectorsPerTrack
+    else:
+        sectorsPerTrack = 17
+        cylinderTimesHeads = totalSectors / sectorsPerTrack
+        heads = (cylinderTimesHeads + 1023) / 1024
+        if heads < 4:
+            heads = 4
+        if (cylinderTimesHeads >= (heads * 1024)) or (heads > 16):
+            sectorsPerTrack = 31
+            heads = 16
+            cylinderTimesHeads = totalSectors / sectorsPerTrack
+        if cylinderTimesHeads >= (heads * 1024):
+            sectorsPerTrack = 63
+            heads = 16
+            cylinderTimesHeads = totalSectors / sectorsPerTrack
+    cylinders = cylinderTimesHeads / heads
+    return Struct("!HBB").pack(cylinders, heads, sectorsPerTrack)
+
+
+def gen_footer(disk_type, image_size, unique_id, rbd_image_uuid, time_stamp):
+    return Footer('conectix', 0x00000002, 0x00010000, 0x00000200, int(time_stamp) - VHD_EPOCH, 'tap', 0x00010003,
+                  0x00000000, image_size, image_size, gen_geometry(image_size), disk_type, 0, unique_id, 0, 0,
+                  rbd_image_uuid, '')
+
+
+def gen_dynamic_disk_header(table_offset, image_size, parent_unique_id='', parent_unicode_name='', parent_time_stamp=VHD_EPOCH,
+                            block_size=DEFAULT_BLOCK_SIZE):
+    empty_entry = ParentLocatorEntry(PLATFORM_CODE_NONE, 0, 0, 0, 0).pack()
+    return DynamicDiskHeader(*(('cxsparse', 0xffffffffffffffff, table_offset, 0x00010000, image_size / block_size,
+                                block_size, 0, parent_unique_id, int(parent_time_stamp) - VHD_EPOCH, 0,
+                                parent_unicode_name.encode("UTF-16BE")) +
+                               (empty_entry,)*PARENT_LOCATORS_COUNT + ('',)))
+
+
+def gen_batmap_header(batmap_offset, batmap):
+    return BatmapHeader('tdbatmap', batmap_offset, len(batmap)/SECTOR_SIZE, 0x00010002, checksum(batmap), 0, '')
+
+
+def gen_empty_bat(max_table_entries):
+    return array('I', [BAT_ENTRY_UNUSED]) * max_table_entries
+
+
+def pack_bat(bat):
+    # BAT entries are big endian uint32, in whole sectors
+    if sys.byteorder == 'little':
+        bat = array('I', bat)
+        bat.byteswap()
+    packed = bat.tostring()
+    return packed + '\0' * (max(get_size_aligned_to_sector_boundary(len(packed)), SECTOR_SIZE) - len(packed))
+
+
+def unpack_bat(data, max_table_entries):
+    bat = array('I')
+    bat.fromstring(data[:max_table_entries*4])
+    if sys.byteorder == 'little':
+        bat.byteswap()
+    return bat
+
+
+def gen_empty_bitmap(bitmap_size):
+    return bytearray(bitmap_size)
+
+
+def set_bitmap_range(bitmap, first_sector, sectors):
+    # sector 0 is the most significant bit of the first byte
+    if sectors <= 0:
+        return
+    last_sector = first_sector + sectors - 1
+    first_byte = first_sector//8
+    last_byte = last_sector//8
+    first_mask = 0xff >> (first_sector%8)
+    last_mask = (0xff << (7 - last_sector%8)) & 0xff
+    if first_byte == last_byte:
+        bitmap[first_byte] |= first_mask & last_mask
+    else:
+        bitmap[first_byte] |= first_mask
+        bitmap[first_byte+1:last_byte] = '\xff'*(last_byte-first_byte-1)
+        bitmap[last_byte] |= last_mask
+
+_bits_of_byte_ = [''.join([str((byte >> (7 - bit)) & 1) for bit in range(8)]) for byte in range(256)]
+_runs_of_bits_ = re.compile('1+')
+
+def get_bitmap_runs(bitmap, sectors):
+    # (first sector, sectors count) of each run of set bits
+    bitmap = bitmap[:sectors//8]
+    if bitmap == '\xff'*len(bitmap):
+        return [(0, sectors)]
+    if bitmap == '\0'*len(bitmap):
+        return []
+    bits = ''.join([_bits_of_byte_[byte] for byte in bytearray(bitmap)])
+    return [(run.start(), run.end() - run.start()) for run in _runs_of_bits_.finditer(bits)]
+
+
+class VHD(object):
+    """
+    Dynamic or differencing vhd file, opened for random access to its virtual sectors.
+
+    Footer, header and BAT are loaded on open, the BAT as an array('I') of sector
+    offsets so that finding a block is an index. Data is read through an mmap of the
+    file, and handed out as buffers of it, without copies. Sector bitmaps are read
+    on use and only those changed by writes are kept. Writes allocate the blocks
+    they need at the end of the file, where the footer moves; close writes back the
+    bitmaps, the BAT and the footers. Sectors not in the file read as zeroes, a
+    differencing disk's parent is not followed.
+    """
+    __slots__ = ('fh', 'writable', 'footer', 'header', 'bat', 'block_size', 'sectors_per_block',
+                 'bitmap_size', 'bitmaps', 'bat_changed', 'end', 'map')
+
+    def __init__(self, path, writable=False):
+        self.fh = open(path, 'r+b' if writable else 'rb')
+        self.writable = writable
+        self.map = None
+        self.footer = Footer.unpack(self._pread(0, FOOTER_SIZE))
+        if self.footer.cookie != 'conectix':
+            raise VHDError("%s: bad footer cookie %r" % (path, self.footer.cookie))
+        if self.footer.disk_type not in (DYNAMIC_HARDDISK_TYPE, DIFF_HARDDISK_TYPE):
+            raise VHDError("%s: disk type %d is not dynamic or differencing" % (path, self.footer.disk_type))
+        self.header = DynamicDiskHeader.unpack(self._pread(self.footer.data_offset, DYNAMIC_DISK_HEADER_SIZE))
+        if self.header.cookie != 'cxsparse':
+            raise VHDError("%s: bad dynamic disk header cookie %r" % (path, self.header.cookie))
+        self.block_size = self.header.block_size
+        self.sectors_per_block = self.block_size/SECTOR_SIZE
+        self.bitmap_size = get_bitmap_size(self.block_size)
+        self.bat = unpack_bat(self._pread(self.header.table_offset, self.header.max_table_entries*4), self.header.max_table_entries)
+        self.bat_changed = False
+        self.bitmaps = {}
+        # new blocks go where the footer is
+        self.end = os.fstat(self.fh.fileno()).st_size - FOOTER_SIZE
+        self._remap()
+
+    def _pread(self, offset, length):
+        self.fh.seek(offset, os.SEEK_SET)
+        data = self.fh.read(length)
+        if len(data) != length:
+            raise VHDError("Short read of %d bytes at offset 0x%08x" % (length, offset))
+        return data
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fh.flush()
+        size = os.fstat(self.fh.fileno()).st_size
+        try:
+            self.map = mmap.mmap(self.fh.fileno(), size, access=mmap.ACCESS_READ)
+        except (mmap.error, OverflowError, ValueError):
+            # empty files and files larger than the address space are read through the file
+            self.map = None
+
+    def _view(self, offset, length):
+        if self.writable:
+            self.fh.flush()
+        if self.map is not None and offset + length > len(self.map):
+            self._remap()
+        if self.map is not None:
+            return buffer(self.map, offset, length)
+        return self._pread(offset, length)
+
+    def block_offset(self, block):
+        """Byte offset of the sector bitmap of block, or None if it is not allocated"""
+        sector = self.bat[block]
+        if sector == BAT_ENTRY_UNUSED:
+            return None
+        return sector*SECTOR_SIZE
+
+    def allocated_blocks(self):
+        """Allocated blocks, in BAT order"""
+        return [block for (block, sector) in enumerate(self.bat) if sector != BAT_ENTRY_UNUSED]
+
+    def blocks_by_offset(self):
+        """Allocated blocks, in the order of their offsets in the file"""
+        return sorted(self.allocated_blocks(), key=self.bat.__getitem__)
+
+    def advise_sequential(self):
+        """
+        Let the kernel read ahead more of the file, which is about to be read in order.
+        The readahead of the file applies to faults on its mmap too.
+        """
+        if _posix_fadvise_ is not None:
+            _posix_fadvise_(self.fh.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def bitmap(self, block):
+        """Sector bitmap of block, empty if it is not allocated"""
+        if block in self.bitmaps:
+            return self.bitmaps[block]
+        offset = self.block_offset(block)
+        if offset is None:
+            return '\0'*self.bitmap_size
+        return self._view(offset, self.bitmap_size)[:]
+
+    def sector_runs(self, block):
+        """(first sector, sectors count) of the runs of sectors of block in the file"""
+        return get_bitmap_runs(self.bitmap(block), self.sectors_per_block)
+
+    def block_data(self, block, first_sector=0, sectors=None):
+        """Buffer over the data of sectors of an allocated block, without copy"""
+        if sectors is None:
+            sectors = self.sectors_per_block - first_sector
+        return self._view(self.block_offset(block) + self.bitmap_size + first_sector*SECTOR_SIZE, sectors*SECTOR_SIZE)
+
+    def read(self, offset, length):
+        """length bytes of the virtual disk at offset, both sector aligned"""
+        data = bytearray(length)
+        start = offset
+        end = offset + length
+        while offset < end:
+            block = offset // self.block_size
+            first_sector = offset % self.block_size / SECTOR_SIZE
+            sectors = min(end - offset, self.block_size - offset % self.block_size) / SECTOR_SIZE
+            if self.bat[block] != BAT_ENTRY_UNUSED:
+                for (run_sector, run_sectors) in self.sector_runs(block):
+                    run_first = max(run_sector, first_sector)
+                    run_last = min(run_sector + run_sectors, first_sector + sectors)
+                    if run_first < run_last:
+                        position = block*self.block_size + run_first*SECTOR_SIZE - start
+                        data[position:position + (run_last - run_first)*SECTOR_SIZE] = self.block_data(block, run_first, run_last - run_first)
+            offset += sectors*SECTOR_SIZE
+        return str(data)
+
+    def allocate(self, block):
+        """Byte offset of block, allocated at the end of the file if it is not yet"""
+        if self.bat[block] == BAT_ENTRY_UNUSED:
+            self.bat[block] = self.end/SECTOR_SIZE
+            self.bat_changed = True
+            self.bitmaps[block] = gen_empty_bitmap(self.bitmap_size)
+            self.end += self.bitmap_size + self.block_size
+        return self.bat[block]*SECTOR_SIZE
+
+    def write(self, offset, data):
+        """Write data at offset of the virtual disk, both sector aligned"""
+        if not self.writable:
+            raise VHDError("VHD is opened read only")
+        data = memoryview(data)
+        written = 0
+        while written < len(data):
+            block = offset // self.block_size
+            offset_in_block = offset % self.block_size
+            length = min(len(data) - written, self.block_size - offset_in_block)
+            block_offset = self.allocate(block)
+            if block not in self.bitmaps:
+                self.bitmaps[block] = bytearray(self.bitmap(block))
+            set_bitmap_range(self.bitmaps[block], offset_in_block/SECTOR_SIZE, length/SECTOR_SIZE)
+            self.fh.seek(block_offset + self.bitmap_size + offset_in_block, os.SEEK_SET)
+            self.fh.write(data[written:written + length])
+            offset += length
+            written += length
+
+    def close(self):
+        if self.writable:
+            for (block, bitmap) in self.bitmaps.items():
+                self.fh.seek(self.bat[block]*SECTOR_SIZE, os.SEEK_SET)
+                self.fh.write(bitmap)
+            self.bitmaps = {}
+            if self.bat_changed:
+                self.fh.seek(self.header.table_offset, os.SEEK_SET)
+                self.fh.write(pack_bat(self.bat))
+            footer = self.footer.pack()
+            self.fh.seek(self.end, os.SEEK_SET)
+            self.fh.write(footer)
+            self.fh.truncate()
+            self.fh.seek(0, os.SEEK_SET)
+            self.fh.write(footer)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fh.close()
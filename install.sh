@@ -85,6 +85,11 @@ function installFiles {
   copyFile "bins/RBDSR.py"              "/opt/xensource/sm/RBDSR"
   copyFile "bins/cephutils.py"          "/opt/xensource/sm/cephutils.py"
   copyFile "bins/rbdsr_lock.py"         "/opt/xensource/sm/rbdsr_lock.py"
+  copyFile "bins/rbdsr_backend.py"      "/opt/xensource/sm/rbdsr_backend.py"
+  copyFile "bins/rbdsr_slots.py"        "/opt/xensource/sm/rbdsr_slots.py"
+  copyFile "bins/rbdsr_scan.py"         "/opt/xensource/sm/rbdsr_scan.py"
+  copyFile "bins/rbddiff.py"            "/opt/xensource/sm/rbddiff.py"
+  copyFile "bins/vhdfile.py"            "/opt/xensource/sm/vhdfile.py"
 
   copyFile "bins/tap-ctl"              "/sbin/tap-ctl"
   copyFile "bins/vhd-tool"             "/bin/vhd-tool"
@@ -104,6 +109,11 @@ function removeFiles {
   rm -f "/opt/xensource/sm/RBDSR"
   rm -f "/opt/xensource/sm/cephutils.py"
   rm -f "/opt/xensource/sm/rbdsr_lock.py"
+  rm -f "/opt/xensource/sm/rbdsr_backend.py"
+  rm -f "/opt/xensource/sm/rbdsr_slots.py"
+  rm -f "/opt/xensource/sm/rbdsr_scan.py"
+  rm -f "/opt/xensource/sm/rbddiff.py"
+  rm -f "/opt/xensource/sm/vhdfile.py"
 
   rm -f "/sbin/tap-ctl"
   rm -f "/bin/vhd-tool"